@@ -0,0 +1,147 @@
+"""
+AQIPredictor.predict benchmark
+Compares the array-based predict() with the previous DataFrame-based loop
+(kept below as legacy_predict) for several history lengths, and one
+predict() per station with a single predict_many() call. Checks that the
+forecasts are identical and writes the timings as JSON.
+
+Usage (from the backend directory, after training the model):
+    python benchmarks/bench_predict.py --days 7 --repeat 50 --output bench_predict.json
+"""
+
+import argparse
+import json
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+backend_dir = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(backend_dir))
+
+from ml.backends import PREDICT_BACKEND
+from ml.predict import AQIPredictor
+from ml.registry import model_registry, version_path
+
+
+def legacy_predict(predictor, historical_data, days_ahead=7):
+    """The DataFrame-based loop predict() used before: copy, prepare_features, pd.concat per day"""
+    predictions = []
+    current_data = historical_data.copy()
+
+    if 'date' in current_data.columns:
+        current_data['date'] = pd.to_datetime(current_data['date'])
+        last_date = current_data['date'].max()
+    else:
+        last_date = datetime.now()
+
+    for i in range(1, days_ahead + 1):
+        target_date = last_date + timedelta(days=i)
+        features = predictor.prepare_features(current_data, target_date)
+        aqi_pred = predictor.model.predict(features)[0]
+        aqi_pred = max(0, aqi_pred)
+
+        predictions.append({
+            'date': target_date.strftime('%Y-%m-%d'),
+            'aqi': round(float(aqi_pred), 1)
+        })
+
+        new_row = current_data.iloc[-1].copy() if len(current_data) > 0 else pd.Series()
+        new_row['date'] = target_date
+        new_row['aqi'] = aqi_pred
+        current_data = pd.concat([current_data, pd.DataFrame([new_row])], ignore_index=True)
+
+    return predictions
+
+
+def history(df: pd.DataFrame, rows: int) -> pd.DataFrame:
+    """One station's history, repeated if the sample data is shorter than rows"""
+    city = df[df['city'] == df['city'].iloc[0]]
+    repeats = -(-rows // len(city))
+    history = pd.concat([city] * repeats, ignore_index=True).tail(rows).reset_index(drop=True)
+    history['date'] = pd.date_range(end=city['date'].max(), periods=rows).strftime('%Y-%m-%d')
+    return history
+
+
+def timed(fn, repeat: int) -> float:
+    """Median seconds per call"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return float(np.median(samples))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark AQIPredictor.predict")
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--repeat", type=int, default=30)
+    parser.add_argument("--history", default="1,3,30,365,3650", help="comma-separated history lengths")
+    parser.add_argument("--stations", type=int, default=300, help="histories for the predict_many comparison")
+    parser.add_argument("--backend", default=None, help="sklearn, booster or numpy (default: PREDICT_BACKEND)")
+    parser.add_argument("--output", default="bench_predict.json")
+    args = parser.parse_args()
+
+    model_dir = version_path(model_registry.target_version())
+    predictor = AQIPredictor(args.backend or PREDICT_BACKEND, model_dir=model_dir)
+    # legacy_predict needs the pickled model, which the numpy backend does not load
+    legacy = predictor if predictor.model is not None else AQIPredictor("sklearn", model_dir=model_dir)
+    df = pd.read_csv(backend_dir / "data" / "air_quality_data.csv")
+
+    results = []
+    if predictor.horizons > 1:
+        # legacy_predict is the recursive loop; it has no equivalent for a direct model
+        args.history = ""
+        print(f"Direct {predictor.horizons}-horizon model: skipping the legacy comparison")
+    print("=" * 50)
+    print(f"{'history':>8} {'legacy ms':>10} {'array ms':>10} {'speedup':>8}  identical")
+    for rows in (int(r) for r in args.history.split(",") if r):
+        data = history(df, rows)
+        identical = legacy_predict(legacy, data, args.days) == predictor.predict(data, args.days)
+        legacy_s = timed(lambda: legacy_predict(legacy, data, args.days), args.repeat)
+        current = timed(lambda: predictor.predict(data, args.days), args.repeat)
+        results.append({
+            "history_rows": rows,
+            "legacy_ms": round(legacy_s * 1000, 3),
+            "array_ms": round(current * 1000, 3),
+            "speedup": round(legacy_s / current, 1),
+            "identical": identical,
+        })
+        print(f"{rows:>8} {legacy_s * 1000:>10.3f} {current * 1000:>10.3f} {legacy_s / current:>7.1f}x  {identical}")
+    print("=" * 50)
+
+    # Many stations: one predict() per history vs predict_many() over all of them
+    histories = [history(df, 30 + i % 60) for i in range(args.stations)]
+    for data in histories:
+        data['date'] = pd.to_datetime(data['date'])
+    calls = predictor.backend.calls
+    looped_forecasts = [predictor.predict(data, args.days) for data in histories]
+    loop_calls, calls = predictor.backend.calls - calls, predictor.backend.calls
+    identical = looped_forecasts == predictor.predict_many(histories, args.days)
+    batch_calls = predictor.backend.calls - calls
+    repeat = max(1, args.repeat // 10)
+    looped = timed(lambda: [predictor.predict(data, args.days) for data in histories], repeat)
+    batched = timed(lambda: predictor.predict_many(histories, args.days), repeat)
+    batch = {
+        "stations": args.stations,
+        "loop_ms": round(looped * 1000, 3),
+        "predict_many_ms": round(batched * 1000, 3),
+        "speedup": round(looped / batched, 1),
+        "model_calls": {"loop": loop_calls, "predict_many": batch_calls},
+        "identical": identical,
+    }
+    print(f"{args.stations} stations: loop {looped * 1000:.1f} ms ({loop_calls} model calls), "
+          f"predict_many {batched * 1000:.1f} ms ({batch_calls} calls), {looped / batched:.1f}x  identical {identical}")
+    print("=" * 50)
+
+    with open(args.output, "w") as f:
+        json.dump({"run_at": datetime.now().isoformat(), "backend": predictor.backend.name, "days": args.days, "results": results, "batch": batch}, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+"""
+WebSocket load test for /ws/realtime-monitoring
+Starts the app in a separate process with stubbed upstream APIs, opens many
+simulated clients against it and reports:
+  - connection setup rate and handshake latency
+  - per-update delivery latency (update timestamp -> client receipt) and jitter
+  - server memory per connection
+  - server event-loop lag while the clients are connected
+Results are written as JSON so runs can be compared.
+
+Usage (from the backend directory):
+    python benchmarks/ws_loadtest.py --clients 2000 --locations 50 --interval 2 --duration 30
+    python benchmarks/ws_loadtest.py --url ws://localhost:8020 --clients 500   # against a running server
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import requests
+import websockets
+
+backend_dir = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(backend_dir))
+
+LAG_SAMPLE_PERIOD = 0.05  # seconds between event-loop lag probes on the server
+
+
+def percentiles(values, scale: float = 1.0) -> dict:
+    if not values:
+        return {"count": 0}
+    data = np.asarray(values, dtype=float) * scale
+    p50, p90, p99 = np.percentile(data, [50, 90, 99])
+    return {
+        "count": int(data.size),
+        "mean": round(float(data.mean()), 3),
+        "p50": round(float(p50), 3),
+        "p90": round(float(p90), 3),
+        "p99": round(float(p99), 3),
+        "max": round(float(data.max()), 3),
+    }
+
+
+def read_rss_bytes() -> int:
+    """Resident memory of this process"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def raise_open_file_limit(wanted: int):
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < wanted:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+# Server side (runs in the child process)
+
+def serve(port: int, upstream_latency: float):
+    """Run the app with stubbed upstreams plus an endpoint exposing loop lag and memory"""
+    os.chdir(backend_dir)
+    raise_open_file_limit(65536)
+
+    import uvicorn
+    import services.http_client as http_client
+
+    async def fake_get_json(self, url, params=None, timeout=10):
+        if upstream_latency:
+            await asyncio.sleep(upstream_latency)
+        return {"current": {
+            "european_aqi": random.randint(20, 180),
+            "pm2_5": round(random.uniform(5, 90), 1),
+            "pm10": round(random.uniform(10, 150), 1),
+            "carbon_monoxide": round(random.uniform(100, 600), 1),
+            "nitrogen_dioxide": round(random.uniform(5, 60), 1),
+            "ozone": round(random.uniform(10, 120), 1),
+            "sulphur_dioxide": round(random.uniform(1, 20), 1),
+        }}
+
+    http_client.AsyncHTTPClient.get_json = fake_get_json
+
+    from main import app
+    lag_samples = []
+
+    async def monitor_lag():
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(LAG_SAMPLE_PERIOD)
+            lag_samples.append(loop.time() - start - LAG_SAMPLE_PERIOD)
+
+    @app.on_event("startup")
+    async def start_lag_monitor():
+        asyncio.create_task(monitor_lag())
+
+    @app.get("/_loadtest/stats")
+    async def loadtest_stats(reset: bool = False):
+        stats = {"rss_bytes": read_rss_bytes(), "event_loop_lag_ms": percentiles(lag_samples, 1000)}
+        if reset:
+            lag_samples.clear()
+        return stats
+
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning", ws_max_size=1 << 20)
+
+
+def start_server(args) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        REALTIME_UPDATE_INTERVAL=str(args.interval),
+        REALTIME_TICK=str(min(1.0, args.interval)),
+        CACHE_SNAPSHOT_ENABLED="false",
+        # Every update goes "upstream" so the stub latency is part of each tick
+        CACHE_TTL_AQI="0",
+        CACHE_STALE_AQI="0",
+    )
+    process = subprocess.Popen(
+        [sys.executable, __file__, "--serve", str(args.port), "--upstream-latency", str(args.upstream_latency)],
+        env=env,
+        # The app prints a line per connection; keep stderr for errors
+        stdout=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{args.port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            if requests.get(f"{base_url}/health", timeout=1).status_code == 200:
+                return process
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("Server did not start within 30 seconds")
+
+
+# Client side
+
+class ClientStats:
+    def __init__(self):
+        self.connect_latencies = []
+        self.connect_failures = 0
+        self.delivery_latencies = []
+        self.gaps = []
+        self.updates = 0
+        self.bytes_received = 0
+        self.errors = 0
+
+
+def update_timestamp(message) -> float:
+    """Epoch seconds at which the server built an update, or None for other messages"""
+    if isinstance(message, bytes):
+        import msgpack
+        message = msgpack.unpackb(message)
+    else:
+        message = json.loads(message)
+    if message.get("type") == "realtime_update":
+        return datetime.fromisoformat(message["timestamp"]).timestamp()
+    if message.get("t") in ("snapshot", "delta"):
+        return message["ts"]
+    return None
+
+
+async def run_client(url: str, stats: ClientStats, connect_gate: asyncio.Semaphore,
+                     measuring: asyncio.Event, stop: asyncio.Event, connected: list):
+    async with connect_gate:
+        start = time.perf_counter()
+        try:
+            ws = await websockets.connect(url, max_size=1 << 20, open_timeout=30, ping_interval=None)
+        except Exception:
+            stats.connect_failures += 1
+            return
+        stats.connect_latencies.append(time.perf_counter() - start)
+        connected.append(ws)
+
+    last_arrival = None
+    try:
+        while not stop.is_set():
+            try:
+                message = await asyncio.wait_for(ws.recv(), timeout=1)
+            except asyncio.TimeoutError:
+                continue
+            built_at = update_timestamp(message)
+            if built_at is None or not measuring.is_set():
+                continue
+            now = time.time()
+            stats.updates += 1
+            stats.bytes_received += len(message)
+            stats.delivery_latencies.append(now - built_at)
+            if last_arrival is not None:
+                stats.gaps.append(now - last_arrival)
+            last_arrival = now
+    except websockets.ConnectionClosed:
+        stats.errors += 1
+    finally:
+        await ws.close()
+
+
+def client_url(args, index: int) -> str:
+    # Locations are spaced well apart so each one is its own cell
+    location = index % args.locations
+    latitude = 12.0 + (location // 50) * 0.1
+    longitude = 77.0 + (location % 50) * 0.1
+    url = f"{args.url}/ws/realtime-monitoring?latitude={latitude:.4f}&longitude={longitude:.4f}"
+    if args.protocol == 2:
+        url += "&protocol=2"
+    return url
+
+
+async def run_load(args, http_base: str) -> dict:
+    stats = ClientStats()
+    stop, measuring = asyncio.Event(), asyncio.Event()
+    connected = []
+    server_before = requests.get(f"{http_base}/_loadtest/stats", timeout=5).json() if args.local else None
+
+    connect_gate = asyncio.Semaphore(args.connect_concurrency)
+    connect_start = time.perf_counter()
+    tasks = [
+        asyncio.create_task(run_client(client_url(args, i), stats, connect_gate, measuring, stop, connected))
+        for i in range(args.clients)
+    ]
+    while len(connected) + stats.connect_failures < args.clients:
+        await asyncio.sleep(0.05)
+    connect_seconds = time.perf_counter() - connect_start
+    print(f"Connected {len(connected)}/{args.clients} clients in {connect_seconds:.2f}s")
+
+    # Let the first round of updates settle before measuring
+    await asyncio.sleep(args.interval)
+    server_connected = None
+    if args.local:
+        server_connected = await asyncio.to_thread(
+            lambda: requests.get(f"{http_base}/_loadtest/stats", params={"reset": True}, timeout=10).json()
+        )
+    measuring.set()
+    print(f"Measuring for {args.duration}s...")
+    await asyncio.sleep(args.duration)
+    measuring.clear()
+
+    server_after = None
+    if args.local:
+        server_after = await asyncio.to_thread(
+            lambda: requests.get(f"{http_base}/_loadtest/stats", timeout=10).json()
+        )
+    realtime_metrics = await asyncio.to_thread(
+        lambda: requests.get(f"{http_base}/metrics", timeout=10).json().get("realtime")
+    )
+    stop.set()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    results = {
+        "connect": {
+            "clients": args.clients,
+            "connected": len(connected),
+            "failures": stats.connect_failures,
+            "seconds": round(connect_seconds, 3),
+            "per_second": round(len(connected) / connect_seconds, 1) if connect_seconds else None,
+            "handshake_ms": percentiles(stats.connect_latencies, 1000),
+        },
+        "delivery": {
+            "updates": stats.updates,
+            "updates_per_second": round(stats.updates / args.duration, 1),
+            "bytes_received": stats.bytes_received,
+            "latency_ms": percentiles(stats.delivery_latencies, 1000),
+            # Deviation of the time between two updates from the configured interval
+            "jitter_ms": percentiles([abs(gap - args.interval) for gap in stats.gaps], 1000),
+            "closed_unexpectedly": stats.errors,
+        },
+        "server_realtime_metrics": realtime_metrics,
+    }
+    if args.local:
+        rss_growth = server_connected["rss_bytes"] - server_before["rss_bytes"]
+        results["server"] = {
+            "rss_idle_mb": round(server_before["rss_bytes"] / 2**20, 1),
+            "rss_connected_mb": round(server_connected["rss_bytes"] / 2**20, 1),
+            "bytes_per_connection": round(rss_growth / max(len(connected), 1)),
+            "event_loop_lag_ms": server_after["event_loop_lag_ms"],
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test /ws/realtime-monitoring")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--locations", type=int, default=20, help="distinct locations shared by the clients")
+    parser.add_argument("--interval", type=float, default=2.0, help="REALTIME_UPDATE_INTERVAL for the server")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of measurement")
+    parser.add_argument("--protocol", type=int, choices=(1, 2), default=1)
+    parser.add_argument("--connect-concurrency", type=int, default=200, help="handshakes in flight at once")
+    parser.add_argument("--upstream-latency", type=float, default=0.05, help="seconds added to each stubbed upstream call")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--url", help="ws:// base URL of a running server instead of starting one")
+    parser.add_argument("--output", default="ws_loadtest_results.json")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.upstream_latency)
+        return
+
+    raise_open_file_limit(args.clients + 1024)
+    args.local = args.url is None
+    process = start_server(args) if args.local else None
+    if args.local:
+        args.url = f"ws://127.0.0.1:{args.port}"
+    http_base = args.url.replace("ws://", "http://").replace("wss://", "https://")
+
+    try:
+        results = asyncio.run(run_load(args, http_base))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+
+    results = {
+        "run_at": datetime.now().isoformat(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("serve", "output")},
+        **results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print("=" * 50)
+    print(f"Connect rate:      {results['connect']['per_second']} conn/s "
+          f"(p99 handshake {results['connect']['handshake_ms'].get('p99')} ms)")
+    print(f"Delivery latency:  p50 {results['delivery']['latency_ms'].get('p50')} ms, "
+          f"p99 {results['delivery']['latency_ms'].get('p99')} ms")
+    print(f"Update jitter:     p99 {results['delivery']['jitter_ms'].get('p99')} ms")
+    if "server" in results:
+        print(f"Memory/connection: {results['server']['bytes_per_connection']} bytes")
+        print(f"Event-loop lag:    p99 {results['server']['event_loop_lag_ms'].get('p99')} ms")
+    print(f"Results written to {args.output}")
+    print("=" * 50)
+
+
+if __name__ == "__main__":
+    main()
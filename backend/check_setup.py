@@ -29,9 +29,11 @@ required_packages = [
 ]
 
 missing_packages = []
+# pip name -> import name where they differ
+import_names = {'scikit-learn': 'sklearn'}
 for package in required_packages:
     try:
-        __import__(package)
+        __import__(import_names.get(package, package))
         print(f"  [OK] {package}")
     except ImportError:
         print(f"  [MISSING] {package}")
@@ -52,11 +54,19 @@ else:
     print(f"  [MISSING] Data file: {data_file}")
     print("  Run: cd data && python generate_data_simple.py")
 
-# Check model file
+# Check model file (the version the server would load: ml/models/CURRENT, else ml/)
 print("\n[4] Checking ML Model...")
-model_file = Path(__file__).parent / "ml" / "aqi_model.pkl"
+sys.path.insert(0, str(Path(__file__).parent))
+try:
+    from ml.registry import MODEL_DIR, UNVERSIONED, current_version, version_path
+    model_version = current_version(MODEL_DIR) or UNVERSIONED
+    model_file = Path(version_path(model_version, MODEL_DIR)) / "aqi_model.pkl"
+except ImportError as e:
+    print(f"  [ERROR] Could not import ml.registry: {e}")
+    model_version = None
+    model_file = Path(__file__).parent / "ml" / "aqi_model.pkl"
 if model_file.exists():
-    print(f"  [OK] Model file exists: {model_file}")
+    print(f"  [OK] Model file exists: {model_file} (version {model_version})")
 else:
     print(f"  [MISSING] Model file: {model_file}")
     print("  Run: cd ml && python train_model.py")
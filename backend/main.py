@@ -12,9 +12,22 @@ current_dir = Path(__file__).parent
 sys.path.insert(0, str(current_dir))
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from routes import aqi_routes, recommendations_routes, travel_routes, geocoding_routes, agent_routes, personalized_recommendations_routes
+from services.http_client import client as upstream_client
+from services.cache import cache
+from services.spatial import quantizer
+from services.singleflight import inflight
+from services.revalidate import revalidator
+from services.circuit_breaker import breakers
+from services import cache_snapshot
+from services.historical_store import historical_store
+from services.rollups import rollups
+from ml.registry import model_registry
+from realtime.hub import manager, hub, DEFAULT_SUBSCRIPTION
+from realtime.protocol import negotiate
 import asyncio
 import json
 from datetime import datetime
@@ -46,27 +59,6 @@ env_safety_path = current_dir / ".adk" / "artifacts" / "env-safety-agent" / "env
 if env_safety_path.exists():
     app.mount("/env-safety-agent", StaticFiles(directory=str(env_safety_path), html=True), name="env-safety-agent")
 
-# WebSocket connection manager
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: list[WebSocket] = []
-
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
-
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
-
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except:
-                # Remove broken connections
-                self.active_connections.remove(connection)
-
-manager = ConnectionManager()
 
 # Include routers
 app.include_router(aqi_routes.router)
@@ -76,6 +68,59 @@ app.include_router(geocoding_routes.router)
 app.include_router(agent_routes.router)
 app.include_router(personalized_recommendations_routes.router)
 
+snapshot_task = None
+
+@app.on_event("startup")
+async def restore_cache_snapshot():
+    """Warm the cache from the last snapshot and start periodic snapshots"""
+    global snapshot_task
+    if not cache_snapshot.SNAPSHOT_ENABLED:
+        return
+    try:
+        result = await asyncio.to_thread(cache_snapshot.load_snapshot, cache)
+        if result["restored"]:
+            print(f"Restored {result['restored']} cache entries from snapshot taken {result['age_seconds']}s ago")
+    except Exception as e:
+        print(f"Could not load cache snapshot: {e}")
+    if cache_snapshot.SNAPSHOT_INTERVAL > 0:
+        snapshot_task = asyncio.create_task(cache_snapshot.run_periodic_snapshots(cache))
+
+@app.on_event("startup")
+async def load_model():
+    """Load and warm the forecast model (see MODEL_WARMUP) and watch for new versions"""
+    await model_registry.start()
+
+@app.on_event("shutdown")
+async def save_cache_snapshot():
+    """Stop periodic snapshots and write a final one"""
+    if snapshot_task is not None:
+        snapshot_task.cancel()
+    if cache_snapshot.SNAPSHOT_ENABLED:
+        try:
+            await asyncio.to_thread(cache_snapshot.save_snapshot, cache)
+        except Exception as e:
+            print(f"Could not save cache snapshot: {e}")
+
+@app.on_event("shutdown")
+async def close_cache():
+    """Write pending cache bookkeeping and close shared-cache connections"""
+    await cache.aclose()
+
+@app.on_event("shutdown")
+async def close_upstream_client():
+    """Close pooled upstream connections"""
+    await upstream_client.close()
+
+@app.on_event("shutdown")
+async def stop_model_registry():
+    """Stop watching for new model versions"""
+    await model_registry.close()
+
+@app.on_event("shutdown")
+async def stop_realtime_hub():
+    """Stop the realtime update scheduler"""
+    await hub.close()
+
 @app.get("/")
 async def root():
     """Root endpoint"""
@@ -92,101 +137,95 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    """Health check endpoint"""
-    return {"status": "healthy"}
+    """Health check endpoint; 503 while the forecast model is still loading at startup"""
+    model = model_registry.health()
+    if not model["ready"] and model["state"] == "loading":
+        return JSONResponse(status_code=503, content={"status": "starting", "model": model})
+    return {"status": "healthy", "model": model}
+
+@app.get("/metrics")
+async def metrics():
+    """Cache and upstream counters"""
+    return {
+        "cache": await cache.astats(),
+        "spatial_keys": quantizer.stats(),
+        "coalescing": inflight.stats(),
+        "revalidation": revalidator.stats(),
+        "upstreams": breakers.stats(),
+        "realtime": hub.stats(),
+        "historical": historical_store.stats(),
+        "rollups": rollups.stats(),
+        "model": model_registry.stats()
+    }
 
 @app.websocket("/ws/realtime-monitoring")
-async def realtime_monitoring(websocket: WebSocket, latitude: float = 40.7128, longitude: float = -74.006):
+async def realtime_monitoring(
+    websocket: WebSocket,
+    latitude: float = 40.7128,
+    longitude: float = -74.006,
+    protocol: int = 1,
+    encoding: str = None,
+    compress: bool = False,
+    auto_subscribe: bool = True
+):
     """
     WebSocket endpoint for real-time environmental monitoring
     Streams live AQI, weather, and air quality data updates
+
+    Clients watching the same location cell share one update; each update
+    is built and serialized once and fanned out to all of them. Clients
+    that cannot keep up have stale updates coalesced and are eventually
+    disconnected with close code 1013
+
+    Protocol 2 (protocol=2 or subprotocol "greenguard.v2[.msgpack|.cbor|.json][+deflate]")
+    sends a snapshot followed by deltas of the changed fields in a compact
+    binary encoding; see realtime/protocol.py. An encoding that is not
+    installed is refused with close code 1003
+
+    One socket can watch several locations: the latitude/longitude query
+    parameters create the "default" subscription (skip it with
+    auto_subscribe=false) and control messages add, move or remove others
+    and set their update intervals (see RealtimeHub.handle_control)
     """
-    await manager.connect(websocket)
     try:
-        # Send initial connection message
-        await websocket.send_json({
+        codec, subprotocol = negotiate(protocol, encoding, compress, websocket.scope.get("subprotocols", []))
+    except ValueError as e:
+        # 1003: the requested encoding cannot be served
+        await websocket.accept()
+        await websocket.close(code=1003, reason=str(e))
+        return
+    await manager.connect(websocket, codec, subprotocol)
+    try:
+        # Send initial connection message; all sends go through the connection's queue
+        established = {
             "type": "connection_established",
             "message": "Real-time monitoring connected",
             "timestamp": datetime.now().isoformat()
-        })
+        }
+        if codec.protocol == 2:
+            established.update(protocol=2, encoding=codec.encoding, deflate=codec.deflate)
+        manager.send(websocket, established)
 
-        while True:
+        if auto_subscribe:
             try:
-                # Get real-time data
-                from services.weather_service import get_weather_data
-                from services.air_quality_service import get_current_aqi as get_aqi_data
-
-                # Fetch current weather and AQI data
-                weather_data = get_weather_data(latitude, longitude)
-                aqi_data = get_aqi_data(latitude, longitude)
-
-                # Create real-time data packet
-                realtime_data = {
-                    "type": "realtime_update",
-                    "timestamp": datetime.now().isoformat(),
-                    "location": {
-                        "latitude": latitude,
-                        "longitude": longitude
-                    },
-                    "aqi": {
-                        "value": aqi_data.get("aqi", 50) if "error" not in aqi_data else 50,
-                        "status": "Good" if (aqi_data.get("aqi", 50) if "error" not in aqi_data else 50) <= 50 else
-                                "Moderate" if (aqi_data.get("aqi", 50) if "error" not in aqi_data else 50) <= 100 else "Unhealthy",
-                        "pm25": aqi_data.get("pm25", 0),
-                        "pm10": aqi_data.get("pm10", 0),
-                        "co": aqi_data.get("co", 0),
-                        "no2": aqi_data.get("no2", 0),
-                        "o3": aqi_data.get("o3", 0),
-                        "so2": aqi_data.get("so2", 0)
-                    },
-                    "weather": {
-                        "temperature": weather_data.get("temperature", 22),
-                        "humidity": weather_data.get("humidity", 60),
-                        "wind_speed": weather_data.get("wind_speed", 5),
-                        "description": weather_data.get("description", "Clear sky")
-                    },
-                    "alerts": []
-                }
-
-                # Add alerts based on conditions
-                aqi_value = realtime_data["aqi"]["value"]
-                if aqi_value > 150:
-                    realtime_data["alerts"].append({
-                        "level": "danger",
-                        "message": "Very unhealthy air quality - avoid outdoor activities"
-                    })
-                elif aqi_value > 100:
-                    realtime_data["alerts"].append({
-                        "level": "warning",
-                        "message": "Unhealthy air quality for sensitive groups"
-                    })
-
-                # Send data to client
-                try:
-                    await websocket.send_json(realtime_data)
-                except WebSocketDisconnect:
-                    break
-
-                # Wait 15 seconds before next update (reduced from 30 for better responsiveness)
-                await asyncio.sleep(15)
-
-            except WebSocketDisconnect:
-                # Client disconnected, break out of the loop
-                break
-            except Exception as e:
-                try:
-                    await websocket.send_json({
-                        "type": "error",
-                        "message": f"Data fetch error: {str(e)}",
-                        "timestamp": datetime.now().isoformat()
-                    })
-                except WebSocketDisconnect:
-                    break
-                await asyncio.sleep(10)  # Retry after error
+                hub.subscribe(websocket, latitude, longitude)
+            except ValueError as e:
+                manager.send(websocket, {"type": "error", "id": DEFAULT_SUBSCRIPTION, "message": str(e)})
+
+        # Updates are pushed by the hub; incoming frames are control messages
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            data = message.get("text")
+            reply = hub.handle_control(websocket, data if data is not None else message.get("bytes"))
+            if reply is not None:
+                manager.send(websocket, reply)
 
     except WebSocketDisconnect:
-        manager.disconnect(websocket)
         print(f"Client disconnected from real-time monitoring")
+    finally:
+        hub.leave(websocket)
 
 if __name__ == "__main__":
     import uvicorn
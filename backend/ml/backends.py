@@ -0,0 +1,317 @@
+"""
+Inference backends for the AQI model
+All backends take the float feature matrix predict.py builds and return
+one AQI value per row, or one per forecast horizon (n x outputs) for
+models trained with FORECAST_STRATEGY=direct:
+
+- sklearn: XGBRegressor.predict (input validation + DMatrix on every call)
+- booster: Booster.inplace_predict straight on the NumPy matrix
+- numpy: the trees compiled into flat arrays (aqi_model_trees.npz), walked
+  with NumPy only, so serving needs neither xgboost nor the pickled model
+
+PREDICT_BACKEND selects one. booster and numpy are checked against the
+pickled model when they are built and refuse to serve if they disagree.
+"""
+
+import json
+import os
+import time
+
+import numpy as np
+
+# sklearn | booster | numpy
+PREDICT_BACKEND = os.getenv("PREDICT_BACKEND", "booster")
+PREDICT_THREADS = int(os.getenv("PREDICT_THREADS", "1"))  # booster threads; forecast batches are small
+PREDICT_PARITY_ROWS = int(os.getenv("PREDICT_PARITY_ROWS", "512"))  # 0 skips the parity check
+PREDICT_PARITY_TOLERANCE = float(os.getenv("PREDICT_PARITY_TOLERANCE", "1e-3"))
+
+# Objectives whose prediction is the raw margin (no link function)
+IDENTITY_OBJECTIVES = {"reg:squarederror", "reg:absoluteerror", "reg:pseudohubererror", "reg:quantileerror"}
+
+
+class InferenceBackend:
+    """Interface shared by the backends: predict(X), outputs and stats()"""
+
+    name = "base"
+
+    def __init__(self):
+        # Values per row: 1 for a next-day model, the horizon count for a direct one
+        self.outputs = 1
+        self.calls = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.parity_max_error = None
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        started = time.perf_counter()
+        result = self._predict(X)
+        self.seconds += time.perf_counter() - started
+        self.calls += 1
+        self.rows += len(X)
+        return result
+
+    def _predict(self, X: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.name,
+            "outputs": self.outputs,
+            "calls": self.calls,
+            "rows": self.rows,
+            "avg_call_ms": round(self.seconds / self.calls * 1000, 4) if self.calls else None,
+            "parity_max_error": self.parity_max_error,
+        }
+
+
+class SklearnBackend(InferenceBackend):
+    """The pickled XGBRegressor as is"""
+
+    name = "sklearn"
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.outputs = model_outputs(model)
+
+    def _predict(self, X):
+        return self.model.predict(X)
+
+
+class BoosterBackend(InferenceBackend):
+    """Booster.inplace_predict with the iteration range XGBRegressor.predict uses"""
+
+    name = "booster"
+
+    def __init__(self, model, threads: int = PREDICT_THREADS):
+        super().__init__()
+        self.model = model
+        self.booster = model.get_booster()
+        if threads > 0:
+            self.booster.set_param({"nthread": threads})
+        best_iteration = getattr(model, "best_iteration", None)
+        self.iteration_range = (0, best_iteration + 1) if best_iteration is not None else (0, 0)
+        self.missing = model.missing
+        self.outputs = model_outputs(model)
+
+    def _predict(self, X):
+        return self.booster.inplace_predict(X, iteration_range=self.iteration_range, missing=self.missing)
+
+
+class CompiledTrees(InferenceBackend):
+    """
+    Tree ensemble as flat node arrays. Node i splits on feature[i] at
+    threshold[i] (go left when x < threshold, missing goes to the default
+    side); leaves point to themselves and hold their output in value[i].
+    roots[t] is the first node of tree t, which adds to output target[t].
+    """
+
+    name = "numpy"
+
+    def __init__(self, feature, threshold, left, right, default_left, value, roots, depth: int,
+                 base_score, target=None, parity_X=None, parity_y=None):
+        super().__init__()
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.default_left = default_left
+        self.value = value
+        self.roots = roots
+        self.depth = depth
+        self.target = target if target is not None else np.zeros(len(roots), dtype=np.int64)
+        self.outputs = int(self.target.max()) + 1 if len(self.target) else 1
+        self.base_score = np.broadcast_to(np.asarray(base_score, dtype=np.float32), (self.outputs,))
+        self._target_trees = [np.flatnonzero(self.target == k) for k in range(self.outputs)]
+        # Rows and pickled-model outputs recorded at compile time for the parity check
+        self.parity_X = parity_X
+        self.parity_y = parity_y
+
+    def __len__(self):
+        return len(self.roots)
+
+    def _predict(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        rows = np.arange(len(X))[:, None]
+        node = np.broadcast_to(self.roots, (len(X), len(self.roots)))
+        for _ in range(self.depth):
+            x = X[rows, self.feature[node]]
+            go_left = np.where(np.isnan(x), self.default_left[node], x < self.threshold[node])
+            node = np.where(go_left, self.left[node], self.right[node])
+        # XGBoost adds each output's trees one by one in float32 onto the base
+        # score; accumulate keeps that order (sum() would add pairwise)
+        values = self.value[node]
+        result = np.empty((len(X), self.outputs), dtype=np.float32)
+        for k, trees in enumerate(self._target_trees):
+            leaves = np.empty((len(X), len(trees) + 1), dtype=np.float32)
+            leaves[:, 0] = self.base_score[k]
+            leaves[:, 1:] = values[:, trees]
+            result[:, k] = np.add.accumulate(leaves, axis=1)[:, -1]
+        return result[:, 0] if self.outputs == 1 else result
+
+    def save(self, path: str):
+        np.savez(
+            path, feature=self.feature, threshold=self.threshold, left=self.left, right=self.right,
+            default_left=self.default_left, value=self.value, roots=self.roots,
+            depth=np.int64(self.depth), base_score=self.base_score, target=self.target,
+            parity_X=self.parity_X if self.parity_X is not None else np.zeros((0, 0), dtype=np.float32),
+            parity_y=self.parity_y if self.parity_y is not None else np.zeros(0, dtype=np.float32),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "CompiledTrees":
+        with np.load(path) as f:
+            return cls(
+                f["feature"], f["threshold"], f["left"], f["right"], f["default_left"], f["value"],
+                f["roots"], int(f["depth"]), f["base_score"], f["target"] if "target" in f else None,
+                f["parity_X"], f["parity_y"],
+            )
+
+
+def compile_trees(model) -> CompiledTrees:
+    """Compile an XGBRegressor (up to its best iteration) into CompiledTrees"""
+    config = json.loads(model.get_booster().save_raw("json"))["learner"]
+    objective = config["objective"]["name"]
+    if objective not in IDENTITY_OBJECTIVES:
+        raise ValueError(f"Cannot compile objective {objective}")
+    booster = config["gradient_booster"]
+    if booster["name"] != "gbtree":
+        raise ValueError(f"Cannot compile {booster['name']} boosters")
+    trees = booster["model"]["trees"]
+    best_iteration = getattr(model, "best_iteration", None)
+    if best_iteration is not None:
+        trees = trees[:booster["model"]["iteration_indptr"][best_iteration + 1]]
+    target = np.asarray(booster["model"]["tree_info"][:len(trees)], dtype=np.int64)
+
+    features, thresholds, lefts, rights, defaults, values, roots = [], [], [], [], [], [], []
+    depth = 0
+    offset = 0
+    for tree in trees:
+        if any(tree["split_type"]):
+            raise ValueError("Cannot compile categorical splits")
+        left = np.asarray(tree["left_children"], dtype=np.int64)
+        right = np.asarray(tree["right_children"], dtype=np.int64)
+        condition = np.asarray(tree["split_conditions"], dtype=np.float32)
+        leaf = left == -1
+        index = np.arange(len(left))
+        features.append(np.where(leaf, 0, tree["split_indices"]))
+        thresholds.append(np.where(leaf, np.float32(0), condition))
+        lefts.append(np.where(leaf, index, left) + offset)
+        rights.append(np.where(leaf, index, right) + offset)
+        defaults.append(np.asarray(tree["default_left"], dtype=bool))
+        values.append(np.where(leaf, condition, np.float32(0)))
+        roots.append(offset)
+        depth = max(depth, _tree_depth(left, right))
+        offset += len(left)
+
+    return CompiledTrees(
+        np.concatenate(features).astype(np.int64),
+        np.concatenate(thresholds).astype(np.float32),
+        np.concatenate(lefts),
+        np.concatenate(rights),
+        np.concatenate(defaults),
+        np.concatenate(values).astype(np.float32),
+        np.asarray(roots, dtype=np.int64),
+        depth,
+        _parse_base_score(config["learner_model_param"]["base_score"]),
+        target,
+    )
+
+
+def _parse_base_score(value: str) -> np.ndarray:
+    # A single number, or "[a,b,...]" with one value per output
+    return np.asarray([float(v) for v in value.strip("[]").split(",")], dtype=np.float32)
+
+
+def model_outputs(model) -> int:
+    """Values per row the model predicts (num_target)"""
+    config = json.loads(model.get_booster().save_config())
+    return max(int(config["learner"]["learner_model_param"].get("num_target", "1")), 1)
+
+
+def _tree_depth(left: np.ndarray, right: np.ndarray) -> int:
+    depth = np.zeros(len(left), dtype=np.int64)
+    # Children always come after their parent in XGBoost's node order
+    for node in range(len(left)):
+        if left[node] != -1:
+            depth[left[node]] = depth[right[node]] = depth[node] + 1
+    return int(depth.max())
+
+
+def parity_rows(trees: CompiledTrees, n_features: int, rows: int = PREDICT_PARITY_ROWS) -> np.ndarray:
+    """
+    Feature rows that exercise the model's splits: every value is a split
+    threshold of its feature, a float32 step either side of one, or missing
+    """
+    rng = np.random.default_rng(0)
+    X = np.empty((rows, n_features), dtype=np.float32)
+    splits = trees.left != np.arange(len(trees.left))
+    for j in range(n_features):
+        thresholds = trees.threshold[splits & (trees.feature == j)]
+        if len(thresholds) == 0:
+            thresholds = np.zeros(1, dtype=np.float32)
+        picked = rng.choice(thresholds, rows)
+        step = rng.integers(-1, 2, rows)
+        X[:, j] = np.where(step < 0, np.nextafter(picked, np.float32(-np.inf)),
+                           np.where(step > 0, np.nextafter(picked, np.float32(np.inf)), picked))
+    X[rng.random(X.shape) < 0.05] = np.nan
+    return X
+
+
+def check_parity(backend: InferenceBackend, X: np.ndarray, expected: np.ndarray,
+                 tolerance: float = PREDICT_PARITY_TOLERANCE):
+    """Raise if the backend's output differs from the pickled model's by more than tolerance"""
+    error = float(np.max(np.abs(np.asarray(backend._predict(X), dtype=np.float64) - expected))) if len(X) else 0.0
+    backend.parity_max_error = error
+    if not error <= tolerance:
+        raise RuntimeError(
+            f"{backend.name} backend disagrees with the pickled model (max error {error}, tolerance {tolerance})"
+        )
+
+
+def create_backend(backend: str, model_path: str, trees_path: str, n_features: int) -> InferenceBackend:
+    """
+    Build the configured backend. The numpy backend loads trees_path when it
+    is newer than the pickle and otherwise compiles the pickle and writes it.
+    """
+    if backend == "numpy" and os.path.exists(trees_path) and (
+        not os.path.exists(model_path) or os.path.getmtime(trees_path) >= os.path.getmtime(model_path)
+    ):
+        trees = CompiledTrees.load(trees_path)
+        if PREDICT_PARITY_ROWS > 0 and trees.parity_X.size:
+            check_parity(trees, trees.parity_X, trees.parity_y)
+        return trees
+
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(f"Model not found at {model_path}. Please train the model first.")
+    import joblib
+
+    model = joblib.load(model_path)
+    if backend == "sklearn":
+        return SklearnBackend(model)
+    if backend not in ("booster", "numpy"):
+        raise ValueError(f"Unknown predict backend: {backend}")
+
+    if backend == "numpy":
+        trees = compile_trees_checked(model, n_features)
+        try:
+            trees.save(trees_path)
+        except OSError:
+            pass
+        return trees
+
+    booster = BoosterBackend(model)
+    if PREDICT_PARITY_ROWS > 0:
+        X = parity_rows(compile_trees(model), n_features)
+        check_parity(booster, X, model.predict(X))
+    return booster
+
+
+def compile_trees_checked(model, n_features: int) -> CompiledTrees:
+    """compile_trees() plus the parity check, keeping the checked rows for later loads"""
+    trees = compile_trees(model)
+    X = parity_rows(trees, n_features, max(PREDICT_PARITY_ROWS, 1))
+    expected = np.asarray(model.predict(X), dtype=np.float32)
+    check_parity(trees, X, expected)
+    trees.parity_X, trees.parity_y = X, expected
+    return trees
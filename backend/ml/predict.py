@@ -7,25 +7,48 @@ import pandas as pd
 import numpy as np
 import joblib
 import os
-from datetime import datetime, timedelta
+from datetime import datetime
+
+from ml.backends import PREDICT_BACKEND, create_backend
+
+LAG_DAYS = 3
+# Environmental feature values used when the history does not have them
+ENV_DEFAULTS = {
+    'pm25': 50,
+    'pm10': 70,
+    'co2': 400,
+    'temperature': 25,
+    'humidity': 60,
+    'wind_speed': 3
+}
 
 class AQIPredictor:
-    def __init__(self):
-        """Initialize predictor with trained model"""
-        self.model = None
+    def __init__(self, backend=PREDICT_BACKEND, model_dir=None):
+        """Initialize predictor with trained model (model_dir defaults to this directory)"""
+        self.backend_name = backend
+        self.model_dir = model_dir or os.path.dirname(__file__)
+        self.backend = None
         self.feature_names = None
         self.load_model()
     
     def load_model(self):
-        """Load trained XGBoost model and feature names"""
-        model_path = os.path.join(os.path.dirname(__file__), 'aqi_model.pkl')
-        feature_path = os.path.join(os.path.dirname(__file__), 'feature_names.pkl')
+        """Load feature names and the trained model through the configured inference backend"""
+        model_path = os.path.join(self.model_dir, 'aqi_model.pkl')
+        feature_path = os.path.join(self.model_dir, 'feature_names.pkl')
+        trees_path = os.path.join(self.model_dir, 'aqi_model_trees.npz')
         
-        if not os.path.exists(model_path):
+        if not os.path.exists(feature_path):
             raise FileNotFoundError(f"Model not found at {model_path}. Please train the model first.")
         
-        self.model = joblib.load(model_path)
         self.feature_names = joblib.load(feature_path)
+        self.backend = create_backend(self.backend_name, model_path, trees_path, len(self.feature_names))
+        # Direct models (FORECAST_STRATEGY=direct) output one value per forecast day
+        self.horizons = self.backend.outputs
+    
+    @property
+    def model(self):
+        """The pickled XGBRegressor (None for the numpy backend, which does not load it)"""
+        return getattr(self.backend, 'model', None)
     
     def prepare_features(self, historical_data, target_date):
         """
@@ -94,39 +117,135 @@ class AQIPredictor:
         Returns:
             List of predictions with dates
         """
-        if self.model is None:
+        return self.predict_many([historical_data], days_ahead)[0]
+    
+    def predict_many(self, histories, days_ahead=7):
+        """
+        Predict AQI for next N days for many histories at once
+        
+        All histories advance together: each forecast day is one model call
+        over an N x features matrix, so N stations cost days_ahead calls.
+        Every history gets exactly the forecast predict() would give it.
+        A direct multi-horizon model predicts all days from the first day's
+        features in a single call instead.
+        
+        Args:
+            histories: List of DataFrames like predict() takes
+            days_ahead: Number of days to predict (default: 7)
+        
+        Returns:
+            List of prediction lists, in the order of histories
+        """
+        if self.backend is None:
             raise ValueError("Model not loaded. Call load_model() first.")
         
-        predictions = []
-        current_data = historical_data.copy()
+        if self.horizons > 1 and days_ahead > self.horizons:
+            raise ValueError(f"Model forecasts at most {self.horizons} days ahead")
         
-        # Ensure date column is datetime
-        if 'date' in current_data.columns:
-            current_data['date'] = pd.to_datetime(current_data['date'])
-            last_date = current_data['date'].max()
-        else:
-            last_date = datetime.now()
+        n = len(histories)
+        if n == 0:
+            return []
+        
+        # Per-history state: features are those prepare_features() computes on
+        # the history extended with each prediction
+        last_dates = np.empty(n, dtype='datetime64[ns]')
+        lengths = np.zeros(n, dtype=np.int64)
+        # The last LAG_DAYS AQI values (history, then predictions) in a ring
+        # buffer; the newest value starts in the last slot for every history
+        window = np.full((n, LAG_DAYS), np.nan)
+        # For histories shorter than LAG_DAYS the missing lags are the mean AQI
+        aqi_sum = np.zeros(n)
+        aqi_count = np.zeros(n, dtype=np.int64)
+        env_first = np.zeros((n, len(ENV_DEFAULTS)))
+        env_later = np.zeros((n, len(ENV_DEFAULTS)))
+        now = np.datetime64(datetime.now(), 'ns')
         
-        for i in range(1, days_ahead + 1):
-            target_date = last_date + timedelta(days=i)
+        for row, history in enumerate(histories):
+            length = len(history)
+            lengths[row] = length
+            if 'date' in history.columns and length > 0:
+                dates = history['date']
+                if not pd.api.types.is_datetime64_any_dtype(dates):
+                    dates = pd.to_datetime(dates)
+                last_dates[row] = dates.max().to_datetime64()
+            else:
+                last_dates[row] = now
             
-            # Prepare features
-            features = self.prepare_features(current_data, target_date)
+            aqi = history['aqi'].to_numpy(dtype=np.float64) if length else np.empty(0)
+            recent = aqi[-LAG_DAYS:]
+            window[row, LAG_DAYS - len(recent):] = recent
+            valid = ~np.isnan(aqi)
+            aqi_sum[row] = aqi[valid].sum()
+            aqi_count[row] = valid.sum()
             
-            # Predict
-            aqi_pred = self.model.predict(features)[0]
-            aqi_pred = max(0, aqi_pred)  # Ensure non-negative
+            latest = history.iloc[-1] if length else None
+            for j, (name, default) in enumerate(ENV_DEFAULTS.items()):
+                if length == 0:
+                    # Rows appended to an empty frame lack the column unless the frame had it
+                    env_first[row, j] = default
+                    env_later[row, j] = np.nan if name in history.columns else default
+                elif name in history.columns:
+                    env_first[row, j] = env_later[row, j] = latest[name]
+                else:
+                    env_first[row, j] = env_later[row, j] = default
+        
+        target_dates = last_dates[:, None] + np.arange(1, days_ahead + 1) * np.timedelta64(1, 'D')
+        calendar = pd.DatetimeIndex(target_dates.ravel())
+        date_features = {
+            'day': calendar.day.to_numpy().reshape(n, days_ahead),
+            'month': calendar.month.to_numpy().reshape(n, days_ahead),
+            'weekday': calendar.weekday.to_numpy().reshape(n, days_ahead),
+        }
+        
+        # One feature matrix reused for every day
+        X = np.zeros((n, len(self.feature_names)))
+        column = {name: index for index, name in enumerate(self.feature_names)}
+        env_columns = [(j, column[name]) for j, name in enumerate(ENV_DEFAULTS) if name in column]
+        lag_columns = [(lag, column[f'aqi_lag_{lag + 1}']) for lag in range(LAG_DAYS) if f'aqi_lag_{lag + 1}' in column]
+        
+        forecast = np.empty((n, days_ahead))
+        newest = LAG_DAYS - 1
+        for i in range(days_ahead):
+            for name, values in date_features.items():
+                if name in column:
+                    X[:, column[name]] = values[:, i]
+            env = env_first if i == 0 else env_later
+            for j, index in env_columns:
+                X[:, index] = env[:, j]
+            
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean_aqi = np.where(aqi_count > 0, aqi_sum / np.maximum(aqi_count, 1), np.where(lengths > 0, np.nan, 100))
+            full = lengths >= LAG_DAYS
+            for lag, index in lag_columns:
+                if lag == 0:
+                    short = np.where(lengths > 0, window[:, newest], mean_aqi)
+                else:
+                    short = mean_aqi
+                X[:, index] = np.where(full, window[:, (newest - lag) % LAG_DAYS], short)
+            
+            if self.horizons > 1:
+                # Column h is the forecast h + 1 days after the last history day
+                aqi_pred = self._predict_rows(X)[:, :days_ahead]
+                forecast[:] = np.where(aqi_pred > 0, aqi_pred, 0)
+                break
             
-            predictions.append({
-                'date': target_date.strftime('%Y-%m-%d'),
-                'aqi': round(float(aqi_pred), 1)
-            })
+            aqi_pred = self._predict_rows(X)
+            aqi_pred = np.where(aqi_pred > 0, aqi_pred, 0)  # Ensure non-negative
+            forecast[:, i] = aqi_pred
             
-            # Update historical data with prediction for next iteration
-            new_row = current_data.iloc[-1].copy() if len(current_data) > 0 else pd.Series()
-            new_row['date'] = target_date
-            new_row['aqi'] = aqi_pred
-            current_data = pd.concat([current_data, pd.DataFrame([new_row])], ignore_index=True)
+            # Feed the predictions back as the newest lags
+            newest = (newest + 1) % LAG_DAYS
+            window[:, newest] = aqi_pred
+            aqi_sum += forecast[:, i]
+            aqi_count += 1
+            lengths += 1
         
-        return predictions
-
+        dates = np.datetime_as_string(target_dates, unit='D')
+        return [
+            [{'date': date, 'aqi': round(value, 1)} for date, value in zip(dates[row].tolist(), forecast[row].tolist())]
+            for row in range(n)
+        ]
+    
+    def _predict_rows(self, X):
+        """Model output for a feature matrix"""
+        return self.backend.predict(X)
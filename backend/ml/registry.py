@@ -0,0 +1,295 @@
+"""
+Model registry
+Trained models are versioned directories under MODEL_DIR:
+
+    MODEL_DIR/<version>/aqi_model.pkl, feature_names.pkl, aqi_model_trees.npz, manifest.json
+    MODEL_DIR/CURRENT      name of the version to serve
+
+train_model.py writes a new version into a staging directory, renames it
+into place and then replaces CURRENT, so a version is complete before any
+worker can see it. Pointing CURRENT at an older version rolls back.
+
+The registry loads and warms the current version at startup (in the
+background unless MODEL_WARMUP=blocking), then checks CURRENT every
+MODEL_RELOAD_CHECK seconds. A new version is loaded and warmed next to the
+serving one and swapped in as a single reference; requests already holding
+the previous version finish on it. Without MODEL_DIR/CURRENT the files in
+ml/ are served as version "unversioned".
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from ml.backends import PREDICT_BACKEND
+from ml.predict import AQIPredictor, ENV_DEFAULTS, LAG_DAYS
+
+ML_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL_DIR = os.getenv("MODEL_DIR", os.path.join(ML_DIR, "models"))
+# background (serve other endpoints while loading) | blocking (finish before serving) | lazy (first request)
+MODEL_WARMUP = os.getenv("MODEL_WARMUP", "background")
+MODEL_RELOAD_CHECK = float(os.getenv("MODEL_RELOAD_CHECK", "10"))  # seconds between CURRENT checks, 0 disables
+MODEL_KEEP_VERSIONS = int(os.getenv("MODEL_KEEP_VERSIONS", "5"))  # versions train_model.py keeps
+
+CURRENT_FILE = "CURRENT"
+MANIFEST_FILE = "manifest.json"
+UNVERSIONED = "unversioned"
+
+
+def current_version(model_dir: str = MODEL_DIR):
+    """Version named by MODEL_DIR/CURRENT, or None"""
+    try:
+        with open(os.path.join(model_dir, CURRENT_FILE)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def version_path(version: str, model_dir: str = MODEL_DIR) -> str:
+    """Directory holding the files of a version"""
+    if version == UNVERSIONED:
+        return ML_DIR
+    return os.path.join(model_dir, version)
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_manifest(path: str) -> dict:
+    """manifest.json of a version directory, after checking the files it lists"""
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    for name, expected in manifest.get("files", {}).items():
+        if file_digest(os.path.join(path, name)) != expected:
+            raise ValueError(f"{name} in {path} does not match its manifest")
+    return manifest
+
+
+def new_version(model_dir: str = MODEL_DIR) -> str:
+    """Name for a new version: a timestamp, so names sort by age, with a suffix if it is taken"""
+    base = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    version, suffix = base, 0
+    while os.path.exists(version_path(version, model_dir)) or os.path.exists(_staging_path(version, model_dir)):
+        suffix += 1
+        version = f"{base}-{suffix}"
+    return version
+
+
+def _staging_path(version: str, model_dir: str) -> str:
+    return os.path.join(model_dir, f".staging-{version}")
+
+
+def stage_version(version: str, model_dir: str = MODEL_DIR) -> str:
+    """Empty staging directory to write a new version's files into"""
+    staging = _staging_path(version, model_dir)
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    return staging
+
+
+def publish_version(staging: str, version: str, manifest: dict, model_dir: str = MODEL_DIR) -> str:
+    """Write the manifest, move the staged version into place and make it CURRENT"""
+    manifest = {
+        "version": version,
+        **manifest,
+        "files": {
+            name: file_digest(os.path.join(staging, name))
+            for name in sorted(os.listdir(staging)) if name != MANIFEST_FILE
+        },
+    }
+    with open(os.path.join(staging, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    path = version_path(version, model_dir)
+    if os.path.exists(path):
+        raise FileExistsError(f"Model version {version} already exists")
+    os.rename(staging, path)
+
+    pointer = os.path.join(model_dir, f".{CURRENT_FILE}-{version}")
+    with open(pointer, "w") as f:
+        f.write(version + "\n")
+    os.replace(pointer, os.path.join(model_dir, CURRENT_FILE))
+    return path
+
+
+def prune_versions(keep: int = MODEL_KEEP_VERSIONS, model_dir: str = MODEL_DIR) -> list:
+    """Delete all but the newest keep versions (never the current one); returns the deleted versions"""
+    if keep <= 0 or not os.path.isdir(model_dir):
+        return []
+    current = current_version(model_dir)
+    versions = sorted(
+        name for name in os.listdir(model_dir)
+        if not name.startswith(".") and os.path.isdir(os.path.join(model_dir, name))
+    )
+    removed = [version for version in versions[:-keep] if version != current]
+    for version in removed:
+        shutil.rmtree(os.path.join(model_dir, version), ignore_errors=True)
+    return removed
+
+
+class LoadedModel:
+    """One loaded and warmed version; replaced as a whole on reload"""
+
+    __slots__ = ("version", "predictor", "manifest", "loaded_at")
+
+    def __init__(self, version: str, predictor: AQIPredictor, manifest: dict):
+        self.version = version
+        self.predictor = predictor
+        self.manifest = manifest
+        self.loaded_at = time.time()
+
+
+def warm_up(predictor: AQIPredictor):
+    """Run forecasts once so first-call setup in the backend is not paid by a request"""
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    history = pd.DataFrame({
+        "date": pd.to_datetime([today - timedelta(days=LAG_DAYS - i) for i in range(LAG_DAYS)]),
+        "aqi": [100.0] * LAG_DAYS,
+        **{name: [float(value)] * LAG_DAYS for name, value in ENV_DEFAULTS.items()},
+    })
+    predictor.predict(history)
+    predictor.predict_many([history] * 64)
+
+
+class ModelRegistry:
+    """The model version requests are served with, loaded ahead of time and hot-swapped"""
+
+    def __init__(self, model_dir: str = MODEL_DIR, backend: str = PREDICT_BACKEND):
+        self.model_dir = model_dir
+        self.backend = backend
+        self._current = None
+        # Serializes loads; get() never waits on it once a version is loaded
+        self._lock = threading.Lock()
+        self._tasks = []
+        self.state = "idle"
+        self.error = None
+        # A version that failed to load is not retried by the watcher until CURRENT changes again
+        self._failed_version = None
+        self.loads = 0
+        self.swaps = 0
+        self.failed_loads = 0
+        self.last_load_seconds = None
+
+    @property
+    def ready(self) -> bool:
+        return self._current is not None
+
+    @property
+    def version(self):
+        current = self._current
+        return current.version if current is not None else None
+
+    def get(self) -> LoadedModel:
+        """The serving version, loading it first if nothing is loaded yet"""
+        current = self._current
+        if current is not None:
+            return current
+        return self.load()
+
+    def target_version(self) -> str:
+        """Version that should be served: CURRENT, else the files in ml/"""
+        return current_version(self.model_dir) or UNVERSIONED
+
+    def load(self, version: str = None) -> LoadedModel:
+        """Load and warm a version (default: target_version()) and make it the serving one"""
+        with self._lock:
+            version = version or self.target_version()
+            current = self._current
+            if current is not None and current.version == version:
+                return current
+            self.state = "loading" if current is None else "reloading"
+            started = time.perf_counter()
+            try:
+                path = version_path(version, self.model_dir)
+                if version != UNVERSIONED and not os.path.isdir(path):
+                    raise FileNotFoundError(f"Model version {version} not found in {self.model_dir}")
+                manifest = read_manifest(path)
+                predictor = AQIPredictor(self.backend, model_dir=path)
+                warm_up(predictor)
+            except Exception as e:
+                self.failed_loads += 1
+                self._failed_version = version
+                self.error = f"{version}: {e}"
+                self.state = "ready" if current is not None else "failed"
+                raise
+            loaded = LoadedModel(version, predictor, manifest)
+            self._current = loaded
+            self.loads += 1
+            if current is not None:
+                self.swaps += 1
+            self.error = None
+            self.state = "ready"
+            self.last_load_seconds = round(time.perf_counter() - started, 4)
+            return loaded
+
+    def _load_logged(self, version: str = None):
+        try:
+            loaded = self.load(version)
+            print(f"Serving model version {loaded.version}")
+        except Exception as e:
+            print(f"Could not load model: {e}")
+
+    async def start(self, warmup: str = MODEL_WARMUP, reload_check: float = MODEL_RELOAD_CHECK):
+        """Load the model as configured and start watching CURRENT"""
+        if warmup == "blocking":
+            await asyncio.to_thread(self._load_logged)
+        elif warmup == "background":
+            self.state = "loading"
+            self._tasks.append(asyncio.create_task(asyncio.to_thread(self._load_logged)))
+        if reload_check > 0:
+            self._tasks.append(asyncio.create_task(self._watch(reload_check)))
+
+    async def _watch(self, interval: float):
+        """Background task swapping in a new version when CURRENT changes"""
+        while True:
+            await asyncio.sleep(interval)
+            # Before the first load the next request (or the startup load) picks the version
+            if self._current is None:
+                continue
+            version = self.target_version()
+            if version not in (self._current.version, self._failed_version) and not self._lock.locked():
+                await asyncio.to_thread(self._load_logged, version)
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def health(self) -> dict:
+        current = self._current
+        return {
+            "ready": current is not None,
+            "state": self.state,
+            "version": current.version if current is not None else None,
+            "error": self.error,
+        }
+
+    def stats(self) -> dict:
+        current = self._current
+        return {
+            **self.health(),
+            "loaded_at": datetime.fromtimestamp(current.loaded_at).isoformat() if current is not None else None,
+            "loads": self.loads,
+            "swaps": self.swaps,
+            "failed_loads": self.failed_loads,
+            "last_load_seconds": self.last_load_seconds,
+            "inference": current.predictor.backend.stats() if current is not None else None,
+        }
+
+
+model_registry = ModelRegistry()
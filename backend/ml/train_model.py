@@ -1,6 +1,10 @@
 """
 XGBoost Model Training for AQI Prediction
 Trains a model to predict AQI for the next 1-7 days
+
+FORECAST_STRATEGY=recursive (default) trains a next-day model that predict()
+feeds its own predictions back into; direct trains one multi-output model
+with a target per horizon (t+1 ... t+7), forecast in a single call.
 """
 
 import pandas as pd
@@ -10,8 +14,17 @@ from sklearn.metrics import mean_squared_error, r2_score
 import xgboost as xgb
 import joblib
 import os
+import sys
 from datetime import datetime, timedelta
 
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ml.backends import compile_trees_checked
+from ml.predict import LAG_DAYS
+from ml.registry import MODEL_DIR, MODEL_KEEP_VERSIONS, new_version, stage_version, publish_version, prune_versions
+
+FORECAST_STRATEGY = os.getenv("FORECAST_STRATEGY", "recursive")  # recursive | direct
+FORECAST_HORIZONS = 7
+
 def load_data(file_path):
     """Load air quality data from CSV"""
     df = pd.read_csv(file_path)
@@ -51,8 +64,54 @@ def create_features(df):
     
     return df
 
-def prepare_training_data(df):
-    """Prepare features and target for training"""
+def create_direct_features(df, horizons=FORECAST_HORIZONS):
+    """
+    Features and horizon targets for direct multi-horizon training
+    Each row is an origin day t with the features predict() builds for its
+    first forecast day: date features of t+1, AQI of t, t-1, t-2 as lags and
+    the environment of t. Targets target_1..target_N are the AQI of t+1..t+N.
+    All lags and targets come from one pass of offset indexing over the rows
+    sorted by station and date; an offset is only used when it lands on the
+    same station exactly that many days away, otherwise it is NaN.
+    """
+    df = df.sort_values(['city', 'lat', 'lon', 'date']).reset_index(drop=True)
+    n = len(df)
+    aqi = df['aqi'].to_numpy(dtype=np.float64)
+    station = df.groupby(['city', 'lat', 'lon'], sort=False).ngroup().to_numpy()
+    days = df['date'].to_numpy().astype('datetime64[D]').astype(np.int64)
+    
+    offsets = np.arange(-(LAG_DAYS - 1), horizons + 1)
+    index = np.arange(n)[:, None] + offsets
+    clipped = index.clip(0, n - 1)
+    same_station = (index >= 0) & (index < n) & (station[clipped] == station[:, None])
+    shifted = np.where(same_station & (days[clipped] - days[:, None] == offsets), aqi[clipped], np.nan)
+    
+    out = pd.DataFrame({'date': df['date']})
+    target_date = df['date'] + pd.Timedelta(days=1)
+    out['day'] = target_date.dt.day
+    out['month'] = target_date.dt.month
+    out['weekday'] = target_date.dt.weekday
+    
+    # Missing lags get the station's mean AQI, as short histories do in predict()
+    station_mean = df.groupby(station)['aqi'].transform('mean').to_numpy()
+    for lag in range(1, LAG_DAYS + 1):
+        values = shifted[:, LAG_DAYS - lag]
+        out[f'aqi_lag_{lag}'] = np.where(np.isnan(values), station_mean, values)
+    
+    for col in ['pm25', 'pm10', 'co2', 'temperature', 'humidity', 'wind_speed']:
+        if col in df.columns:
+            out[col] = df[col].fillna(df[col].mean())
+    
+    target_cols = [f'target_{h}' for h in range(1, horizons + 1)]
+    for h, col in enumerate(target_cols, start=1):
+        out[col] = shifted[:, LAG_DAYS - 1 + h]
+    
+    # Origins without every horizon observed cannot train a multi-output model
+    out = out.dropna(subset=target_cols)
+    return out.sort_values('date', kind='stable').reset_index(drop=True), target_cols
+
+def prepare_training_data(df, target_cols=None):
+    """Prepare features and target (or one target column per horizon) for training"""
     feature_cols = [
         'day', 'month', 'weekday',
         'aqi_lag_1', 'aqi_lag_2', 'aqi_lag_3',
@@ -64,10 +123,10 @@ def prepare_training_data(df):
     available_features = [col for col in feature_cols if col in df.columns]
     
     X = df[available_features].copy()
-    y = df['aqi'].copy()
+    y = df[target_cols].copy() if target_cols else df['aqi'].copy()
     
     # Remove rows with NaN in target
-    valid_idx = ~y.isna()
+    valid_idx = y.notna().all(axis=1) if target_cols else ~y.isna()
     X = X[valid_idx]
     y = y[valid_idx]
     
@@ -107,10 +166,14 @@ def main():
     print("GreenGuard AI - Model Training")
     print("=" * 50)
     
-    # Paths
+    # Paths (the model files go into a new version directory, see ml/registry.py)
     data_path = os.path.join(os.path.dirname(__file__), '..', 'data', 'air_quality_data.csv')
-    model_path = os.path.join(os.path.dirname(__file__), 'aqi_model.pkl')
-    feature_path = os.path.join(os.path.dirname(__file__), 'feature_names.pkl')
+    os.makedirs(MODEL_DIR, exist_ok=True)
+    version = new_version()
+    staging = stage_version(version)
+    model_path = os.path.join(staging, 'aqi_model.pkl')
+    feature_path = os.path.join(staging, 'feature_names.pkl')
+    trees_path = os.path.join(staging, 'aqi_model_trees.npz')
     
     # Load data
     print("\n[1/5] Loading data...")
@@ -118,13 +181,19 @@ def main():
     print(f"Loaded {len(df)} records")
     
     # Feature engineering
-    print("\n[2/5] Creating features...")
-    df = create_features(df)
+    print(f"\n[2/5] Creating features ({FORECAST_STRATEGY} strategy)...")
+    if FORECAST_STRATEGY == 'direct':
+        df, target_cols = create_direct_features(df)
+    elif FORECAST_STRATEGY == 'recursive':
+        target_cols = None
+        df = create_features(df)
+    else:
+        raise ValueError(f"Unknown FORECAST_STRATEGY: {FORECAST_STRATEGY}")
     print("Features created successfully")
     
     # Prepare training data
     print("\n[3/5] Preparing training data...")
-    X, y, feature_names = prepare_training_data(df)
+    X, y, feature_names = prepare_training_data(df, target_cols)
     print(f"Features: {feature_names}")
     print(f"Training samples: {len(X)}")
     
@@ -149,6 +218,16 @@ def main():
     print(f"\nModel Performance:")
     print(f"  RMSE: {rmse:.2f}")
     print(f"  R² Score: {r2:.4f}")
+    horizon_metrics = None
+    if target_cols:
+        # Averages above are over all horizons
+        horizon_metrics = {}
+        for h, col in enumerate(target_cols):
+            horizon_metrics[col] = {
+                "rmse": round(float(np.sqrt(mean_squared_error(y_test[col], y_pred[:, h]))), 4),
+                "r2": round(float(r2_score(y_test[col], y_pred[:, h])), 4),
+            }
+            print(f"  t+{h + 1}: RMSE {horizon_metrics[col]['rmse']:.2f}, R² {horizon_metrics[col]['r2']:.4f}")
     
     if r2 >= 0.85:
         print("[SUCCESS] Model meets quality requirement (R² >= 0.85)")
@@ -159,8 +238,28 @@ def main():
     print("\nSaving model...")
     joblib.dump(model, model_path)
     joblib.dump(feature_names, feature_path)
-    print(f"Model saved to: {model_path}")
-    print(f"Feature names saved to: {feature_path}")
+    
+    # Trees for PREDICT_BACKEND=numpy (checked against the model before saving)
+    trees = compile_trees_checked(model, len(feature_names))
+    trees.save(trees_path)
+    
+    # Make the version visible to the running servers in one step
+    path = publish_version(staging, version, {
+        "created_at": datetime.now().isoformat(),
+        "xgboost_version": xgb.__version__,
+        "feature_names": feature_names,
+        "training_samples": len(X_train_split),
+        "best_iteration": getattr(model, 'best_iteration', None),
+        "trees": len(trees),
+        "metrics": {"rmse": round(float(rmse), 4), "r2": round(float(r2), 4)},
+        "strategy": FORECAST_STRATEGY,
+        "horizons": len(target_cols) if target_cols else 1,
+        "horizon_metrics": horizon_metrics,
+    })
+    print(f"Model version {version} saved to: {path}")
+    removed = prune_versions(MODEL_KEEP_VERSIONS)
+    if removed:
+        print(f"Removed old versions: {', '.join(removed)}")
     
     print("\n" + "=" * 50)
     print("Training completed successfully!")
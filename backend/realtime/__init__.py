@@ -0,0 +1 @@
+# Realtime package
@@ -0,0 +1,148 @@
+"""
+Per-connection outbound queue with backpressure
+Fan-out only enqueues; a writer task per connection does the actual sends.
+When a queue is full, an update for the same stream replaces the queued
+one (coalescing) or the oldest queued message is dropped. Connections that
+keep timing out or overflowing are evicted so they cannot hold others back.
+"""
+
+import asyncio
+import os
+from collections import OrderedDict
+from itertools import count
+
+from fastapi import WebSocket
+
+from realtime.protocol import FrameCodec, LEGACY_CODEC
+
+QUEUE_SIZE = int(os.getenv("REALTIME_QUEUE_SIZE", "8"))
+SEND_TIMEOUT = float(os.getenv("REALTIME_SEND_TIMEOUT", "5"))
+# Consecutive send timeouts / overflows before a consumer is evicted
+MAX_SLOW_STRIKES = int(os.getenv("REALTIME_MAX_SLOW_STRIKES", "3"))
+
+# Close code 1013: try again later
+EVICTION_CLOSE_CODE = 1013
+
+_message_ids = count()
+
+
+class ClientConnection:
+    def __init__(self, websocket: WebSocket, on_evict=None, codec: FrameCodec = LEGACY_CODEC,
+                 queue_size: int = QUEUE_SIZE, send_timeout: float = SEND_TIMEOUT):
+        self.websocket = websocket
+        self.codec = codec
+        # Location subscriptions by client-chosen id (managed by the hub)
+        self.subscriptions: dict = {}
+        # Last stream seq queued per subscription, and subscriptions whose queued frame was replaced or dropped
+        self.seqs: dict[str, int] = {}
+        self.lost: set[str] = set()
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
+        self._on_evict = on_evict
+        # key -> (message, subscription ids it carries); keyed messages coalesce, others get a unique key
+        self._pending: OrderedDict = OrderedDict()
+        self._ready = asyncio.Event()
+        self._strikes = 0
+        self.closed = False
+        self.sent = 0
+        self.bytes_sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.send_timeouts = 0
+        self._writer = asyncio.create_task(self._write_loop())
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._pending)
+
+    def take_pending(self, key: str) -> list:
+        """
+        Remove an unsent keyed message so a newer one can supersede it.
+        Returns the subscription ids it carried, which are marked lost.
+        """
+        pending = self._pending.pop(key, None)
+        if pending is None:
+            return []
+        self.coalesced += 1
+        self.lost.update(pending[1])
+        return list(pending[1])
+
+    def enqueue(self, message, key: str = None, subscriptions=()):
+        """
+        Queue a message without blocking. Messages with a key replace an
+        unsent message with the same key, so a slow client only ever gets
+        the latest update of each stream.
+        """
+        if self.closed:
+            return
+        if key is not None and key in self._pending:
+            self.take_pending(key)
+
+        if len(self._pending) >= self.queue_size:
+            _, (_, lost) = self._pending.popitem(last=False)
+            self.dropped += 1
+            self.lost.update(lost)
+            self._strike()
+            if self.closed:
+                return
+
+        self._pending[key if key is not None else ("_", next(_message_ids))] = (message, subscriptions)
+        self._ready.set()
+
+    def _strike(self):
+        self._strikes += 1
+        if self._strikes >= MAX_SLOW_STRIKES:
+            self.evict()
+
+    async def _write_loop(self):
+        while True:
+            await self._ready.wait()
+            while self._pending:
+                _, (message, _) = self._pending.popitem(last=False)
+                try:
+                    if isinstance(message, bytes):
+                        await asyncio.wait_for(self.websocket.send_bytes(message), self.send_timeout)
+                    else:
+                        await asyncio.wait_for(self.websocket.send_text(message), self.send_timeout)
+                except asyncio.TimeoutError:
+                    self.send_timeouts += 1
+                    self._strike()
+                    if self.closed:
+                        return
+                    continue
+                except Exception:
+                    # Broken socket; the endpoint handler sees the disconnect as well
+                    self.evict(close=False)
+                    return
+                self.sent += 1
+                self.bytes_sent += len(message)
+                self._strikes = 0
+            self._ready.clear()
+
+    def evict(self, close: bool = True):
+        """Stop writing, let the owner forget this connection and close the socket"""
+        if self.closed:
+            return
+        self.closed = True
+        self._pending.clear()
+        if self._writer is not asyncio.current_task():
+            self._writer.cancel()
+        if self._on_evict is not None:
+            self._on_evict(self.websocket)
+        if close:
+            asyncio.ensure_future(self._close_socket())
+
+    async def _close_socket(self):
+        try:
+            await asyncio.wait_for(
+                self.websocket.close(code=EVICTION_CLOSE_CODE, reason="Consumer too slow"),
+                self.send_timeout
+            )
+        except Exception:
+            pass
+
+    def close(self):
+        """Stop the writer after a normal disconnect"""
+        self.closed = True
+        self._pending.clear()
+        self._writer.cancel()
@@ -0,0 +1,547 @@
+"""
+Location-multiplexed realtime hub
+A connection holds one or more location subscriptions, each with its own
+update interval. Subscriptions are grouped by quantized location cell and a
+single scheduler builds each due cell's update once, in a task of its own so
+a slow cell does not delay the others, and encodes it once per wire format
+(see realtime.protocol). Updates for one connection that fall due together
+are sent as a single batch frame.
+
+Updates travel through a broker (see realtime.pubsub): for each cell only
+the worker holding the producer lease builds and publishes the update, and
+every worker delivers what is published to its own subscribers.
+"""
+
+import asyncio
+import math
+import os
+import time
+
+from fastapi import WebSocket
+
+from realtime.connection import ClientConnection, QUEUE_SIZE
+from realtime.protocol import DeltaStream, FrameCodec, LEGACY_CODEC
+from realtime.pubsub import Broker, MemoryBroker, create_broker
+from realtime.updates import build_realtime_update, build_error_message
+from services.spatial import quantizer
+
+UPDATE_INTERVAL = float(os.getenv("REALTIME_UPDATE_INTERVAL", "15"))  # seconds between updates
+ERROR_RETRY_INTERVAL = float(os.getenv("REALTIME_ERROR_RETRY", "10"))
+# Bounds for per-subscription intervals requested by clients
+MIN_INTERVAL = float(os.getenv("REALTIME_MIN_INTERVAL", "5"))
+MAX_INTERVAL = float(os.getenv("REALTIME_MAX_INTERVAL", "3600"))
+# Due times are aligned to ticks so updates falling due together share a frame
+TICK = float(os.getenv("REALTIME_TICK", "1"))
+MAX_SUBSCRIPTIONS = int(os.getenv("REALTIME_MAX_SUBSCRIPTIONS", "20"))
+# Published updates arriving within this window are delivered together
+BATCH_WINDOW = 0.05
+
+# Subscription created from the endpoint's latitude/longitude query parameters
+DEFAULT_SUBSCRIPTION = "default"
+# Queue key of update frames; a newer one supersedes an unsent one
+UPDATES_KEY = "updates"
+
+
+class Subscription:
+    __slots__ = ("id", "cell", "latitude", "longitude", "interval", "next_due")
+
+    def __init__(self, sub_id: str, cell: str, latitude: float, longitude: float,
+                 interval: float, next_due: float):
+        self.id = sub_id
+        self.cell = cell
+        self.latitude = latitude
+        self.longitude = longitude
+        self.interval = interval
+        self.next_due = next_due
+
+
+class CellState:
+    __slots__ = ("latitude", "longitude", "stream", "next_due")
+
+    def __init__(self, latitude: float, longitude: float, next_due: float):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.stream = DeltaStream()
+        self.next_due = next_due
+
+
+class ConnectionManager:
+    """Tracks open WebSockets and the location cells their subscriptions point to"""
+
+    def __init__(self):
+        self.cells: dict[str, set[WebSocket]] = {}
+        self.connections: dict[WebSocket, ClientConnection] = {}
+        # Called with the websocket when a slow consumer is evicted
+        self.on_evict = None
+        self.evictions = 0
+        # Counters of connections that already went away
+        self._closed_totals = {"sent": 0, "bytes_sent": 0, "dropped": 0, "coalesced": 0, "send_timeouts": 0}
+
+    @property
+    def active_connections(self) -> list[WebSocket]:
+        return list(self.connections)
+
+    async def connect(self, websocket: WebSocket, codec: FrameCodec = LEGACY_CODEC, subprotocol: str = None):
+        await websocket.accept(subprotocol=subprotocol)
+        self.connections[websocket] = ClientConnection(websocket, on_evict=self._evicted, codec=codec)
+
+    def _evicted(self, websocket: WebSocket):
+        self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict(websocket)
+        else:
+            self.disconnect(websocket)
+
+    def subscribe(self, websocket: WebSocket, subscription: Subscription) -> bool:
+        """Register a subscription; returns True if it is the first one for its cell"""
+        self.connections[websocket].subscriptions[subscription.id] = subscription
+        subscribers = self.cells.setdefault(subscription.cell, set())
+        first = not subscribers
+        subscribers.add(websocket)
+        return first
+
+    def unsubscribe(self, websocket: WebSocket, sub_id: str):
+        """Remove a subscription; returns its cell if the cell has no subscribers left"""
+        connection = self.connections.get(websocket)
+        subscription = connection.subscriptions.pop(sub_id, None) if connection is not None else None
+        if subscription is None:
+            return None
+        connection.seqs.pop(sub_id, None)
+        connection.lost.discard(sub_id)
+
+        cell = subscription.cell
+        if any(other.cell == cell for other in connection.subscriptions.values()):
+            return None
+        subscribers = self.cells.get(cell)
+        if subscribers is not None:
+            subscribers.discard(websocket)
+            if not subscribers:
+                del self.cells[cell]
+                return cell
+        return None
+
+    def disconnect(self, websocket: WebSocket) -> list[str]:
+        """Forget a websocket; returns the cells left without subscribers"""
+        connection = self.connections.get(websocket)
+        if connection is None:
+            return []
+        emptied = [
+            cell for cell in (self.unsubscribe(websocket, sub_id) for sub_id in list(connection.subscriptions))
+            if cell is not None
+        ]
+        del self.connections[websocket]
+        connection.close()
+        for name in self._closed_totals:
+            self._closed_totals[name] += getattr(connection, name)
+        return emptied
+
+    def subscriptions_in(self, cell: str):
+        """(connection, subscription) pairs for every subscription of a cell"""
+        for websocket in self.cells.get(cell, ()):
+            connection = self.connections.get(websocket)
+            if connection is None:
+                continue
+            for subscription in connection.subscriptions.values():
+                if subscription.cell == cell:
+                    yield connection, subscription
+
+    def send(self, websocket: WebSocket, message: dict, key: str = None):
+        """Encode a message in the websocket's wire format and queue it"""
+        connection = self.connections.get(websocket)
+        if connection is not None:
+            connection.enqueue(connection.codec.encode(message), key)
+
+    def broadcast(self, message: dict):
+        for websocket in list(self.connections):
+            self.send(websocket, message)
+
+    def stats(self) -> dict:
+        connections = list(self.connections.values())
+        depths = [c.queue_depth for c in connections]
+        protocols = {}
+        for connection in connections:
+            protocols[connection.codec.name] = protocols.get(connection.codec.name, 0) + 1
+        totals = {
+            name: total + sum(getattr(c, name) for c in connections)
+            for name, total in self._closed_totals.items()
+        }
+        return {
+            "connections": len(connections),
+            "subscriptions": sum(len(c.subscriptions) for c in connections),
+            "cells": len(self.cells),
+            "max_subscribers_per_cell": max((len(s) for s in self.cells.values()), default=0),
+            "queued_messages": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "protocols": protocols,
+            "bytes_sent": totals["bytes_sent"],
+            "queue_size": QUEUE_SIZE,
+            "messages_sent": totals["sent"],
+            "messages_dropped": totals["dropped"],
+            "messages_coalesced": totals["coalesced"],
+            "send_timeouts": totals["send_timeouts"],
+            "slow_consumers_evicted": self.evictions,
+        }
+
+
+class RealtimeHub:
+    """Schedules per-cell updates and fans them out to subscriptions"""
+
+    def __init__(self, manager: ConnectionManager, interval: float = UPDATE_INTERVAL, tick: float = TICK,
+                 broker: Broker = None):
+        self.manager = manager
+        self.broker = broker if broker is not None else MemoryBroker()
+        self._broker_started = False
+        # Latest published payload per cell, waiting to be delivered
+        self._inbox: dict[str, dict] = {}
+        self._flush_handle = None
+        self.interval = interval
+        # A tick longer than the interval would round due times back to now
+        self.tick = min(tick, interval)
+        self._cells: dict[str, CellState] = {}
+        self._scheduler = None
+        self._wakeup = asyncio.Event()
+        # In-flight update builds per cell
+        self._builds: dict[str, asyncio.Task] = {}
+        # Frame counters of streams whose cell has gone away
+        self._retired_frames = {"snapshots_encoded": 0, "deltas_encoded": 0}
+        self.updates_built = 0
+        self.ticks = 0
+        self.batch_frames = 0
+        self.broker_errors = 0
+        manager.on_evict = self.leave
+
+    def _align(self, t: float) -> float:
+        return round(t / self.tick) * self.tick
+
+    def _clamp_interval(self, interval) -> float:
+        if interval is None:
+            return self.interval
+        interval = float(interval)
+        if not math.isfinite(interval):
+            raise ValueError(f"Invalid interval: {interval}")
+        return min(max(interval, MIN_INTERVAL), MAX_INTERVAL)
+
+    @staticmethod
+    def _check_location(latitude: float, longitude: float):
+        if not (math.isfinite(latitude) and math.isfinite(longitude)):
+            raise ValueError(f"Invalid location: {latitude}, {longitude}")
+
+    def subscribe(self, websocket: WebSocket, latitude: float, longitude: float,
+                  sub_id: str = DEFAULT_SUBSCRIPTION, interval: float = None) -> Subscription:
+        """Subscribe a connection to a location; re-using an id moves that subscription"""
+        connection = self.manager.connections[websocket]
+        if sub_id not in connection.subscriptions and len(connection.subscriptions) >= MAX_SUBSCRIPTIONS:
+            raise ValueError(f"At most {MAX_SUBSCRIPTIONS} subscriptions per connection")
+        # Validate everything before touching the subscription being replaced
+        interval = self._clamp_interval(interval)
+        self._check_location(latitude, longitude)
+        cell, _, _ = quantizer.quantize(latitude, longitude)
+        self.unsubscribe(websocket, sub_id)
+
+        now = time.monotonic()
+        subscription = Subscription(sub_id, cell, latitude, longitude, interval, self._align(now + interval))
+        self.manager.subscribe(websocket, subscription)
+
+        state = self._cells.get(cell)
+        if state is None:
+            # The first subscriber's coordinates stand for the whole cell
+            self._cells[cell] = CellState(latitude, longitude, next_due=now)
+            self.broker.subscribe(cell)
+            subscription.next_due = now
+            self._start_scheduler()
+            self._wakeup.set()
+        elif state.stream.packet is None:
+            # The cell's first update is still on its way
+            subscription.next_due = state.next_due
+        else:
+            # Newcomers get the cell's latest update immediately
+            self._send_updates(connection, [subscription])
+            state.next_due = min(state.next_due, subscription.next_due)
+        return subscription
+
+    def unsubscribe(self, websocket: WebSocket, sub_id: str) -> bool:
+        connection = self.manager.connections.get(websocket)
+        if connection is None or sub_id not in connection.subscriptions:
+            return False
+        empty_cell = self.manager.unsubscribe(websocket, sub_id)
+        if empty_cell is not None:
+            self._drop_cell(empty_cell)
+        return True
+
+    def set_interval(self, websocket: WebSocket, sub_id: str, interval: float) -> Subscription:
+        subscription = self.manager.connections[websocket].subscriptions.get(sub_id)
+        if subscription is None:
+            raise ValueError(f"Unknown subscription '{sub_id}'")
+        interval = self._clamp_interval(interval)
+        subscription.interval = interval
+        subscription.next_due = min(subscription.next_due, self._align(time.monotonic() + subscription.interval))
+        state = self._cells[subscription.cell]
+        state.next_due = min(state.next_due, subscription.next_due)
+        self._wakeup.set()
+        return subscription
+
+    def handle_control(self, websocket: WebSocket, data) -> dict:
+        """
+        Apply a control message from the client and return the reply:
+            {"type": "subscribe", "id": "home", "latitude": 12.97, "longitude": 77.59, "interval": 30}
+            {"type": "unsubscribe", "id": "home"}
+            {"type": "set_interval", "id": "home", "interval": 60}
+        """
+        connection = self.manager.connections.get(websocket)
+        if connection is None:
+            return None
+        sub_id = DEFAULT_SUBSCRIPTION
+        try:
+            message = connection.codec.decode(data)
+            sub_id = str(message.get("id", DEFAULT_SUBSCRIPTION))
+            action = message.get("type")
+            if action == "subscribe":
+                subscription = self.subscribe(
+                    websocket, float(message["latitude"]), float(message["longitude"]),
+                    sub_id, message.get("interval")
+                )
+                return {"type": "subscribed", "id": sub_id, "cell": subscription.cell,
+                        "interval": subscription.interval}
+            if action == "unsubscribe":
+                if not self.unsubscribe(websocket, sub_id):
+                    raise ValueError(f"Unknown subscription '{sub_id}'")
+                return {"type": "unsubscribed", "id": sub_id}
+            if action == "set_interval":
+                subscription = self.set_interval(websocket, sub_id, message["interval"])
+                return {"type": "interval_set", "id": sub_id, "interval": subscription.interval}
+            raise ValueError(f"Unknown control message type '{action}'")
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            return {"type": "error", "id": sub_id, "message": f"Invalid control message: {e}"}
+
+    def leave(self, websocket: WebSocket):
+        for cell in self.manager.disconnect(websocket):
+            self._drop_cell(cell)
+
+    def _drop_cell(self, cell: str):
+        state = self._cells.pop(cell, None)
+        if state is not None:
+            for name in self._retired_frames:
+                self._retired_frames[name] += getattr(state.stream, name)
+        self._inbox.pop(cell, None)
+        self.broker.unsubscribe(cell)
+        if cell in self.broker.leases:
+            asyncio.ensure_future(self._release(cell))
+
+    async def _release(self, cell: str):
+        try:
+            await self.broker.release(cell)
+        except Exception:
+            # The lease expires on its own
+            self.broker_errors += 1
+
+    def _start_scheduler(self):
+        if self._scheduler is None or self._scheduler.done():
+            self._scheduler = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._scheduler is not None:
+            self._scheduler.cancel()
+            self._scheduler = None
+        for task in list(self._builds.values()):
+            task.cancel()
+        if self._broker_started:
+            await self.broker.close()
+            self._broker_started = False
+
+    async def _start_broker(self):
+        try:
+            await self.broker.start(self._on_message)
+        except Exception as e:
+            print(f"Realtime broker '{self.broker.backend}' unavailable, producing every cell locally: {e}")
+            cells = self.broker.cells
+            self.broker = MemoryBroker()
+            for cell in cells:
+                self.broker.subscribe(cell)
+            await self.broker.start(self._on_message)
+        self._broker_started = True
+
+    async def _run(self):
+        if not self._broker_started:
+            await self._start_broker()
+        while True:
+            now = time.monotonic()
+            next_due = min((state.next_due for state in self._cells.values()), default=None)
+            if next_due is None or next_due > now:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), None if next_due is None else next_due - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            horizon = now + self.tick / 2
+            due = [cell for cell, state in self._cells.items() if state.next_due <= horizon]
+            try:
+                await self._tick(due, now)
+            except Exception as e:
+                # One failed tick must not end the scheduler; retry its cells later
+                print(f"Realtime tick failed: {e}")
+                retry = time.monotonic() + ERROR_RETRY_INTERVAL
+                for cell in due:
+                    state = self._cells.get(cell)
+                    if state is not None and state.next_due <= horizon:
+                        state.next_due = retry
+
+    async def _tick(self, cells: list[str], started: float):
+        self.ticks += 1
+        claims = await asyncio.gather(*(self._claim(cell) for cell in cells))
+
+        for cell, owned in zip(cells, claims):
+            state = self._cells.get(cell)
+            if state is None:
+                continue
+            # Producers are rescheduled when their update comes back; the others
+            # wait for the producer and check the lease again after an interval
+            state.next_due = started + self.interval
+            if cell in self._builds:
+                continue
+            if owned:
+                self._start_build(cell, state, True)
+            elif state.stream.packet is None:
+                # Serve this process's first subscribers without waiting for the producer
+                self._start_build(cell, state, False)
+
+    def _start_build(self, cell: str, state: CellState, publish: bool):
+        """Build a cell's update in its own task so a slow cell does not hold up the others"""
+        task = asyncio.create_task(self._build(cell, state.latitude, state.longitude, publish))
+        self._builds[cell] = task
+        task.add_done_callback(lambda _: self._builds.pop(cell, None))
+
+    async def _build(self, cell: str, latitude: float, longitude: float, publish: bool):
+        try:
+            payload = {"packet": await build_realtime_update(latitude, longitude)}
+            self.updates_built += 1
+        except Exception as e:
+            state = self._cells.get(cell)
+            if state is not None:
+                state.next_due = time.monotonic() + ERROR_RETRY_INTERVAL
+            payload = {"error": build_error_message(e)}
+        # Delivered through the inbox, batched with whatever else finishes in BATCH_WINDOW
+        if publish:
+            await self._publish(cell, payload)
+        else:
+            self._on_message(cell, payload)
+
+    async def _claim(self, cell: str) -> bool:
+        try:
+            return await self.broker.acquire(cell)
+        except Exception:
+            # Without the broker, produce locally rather than leave subscribers without updates
+            self.broker_errors += 1
+            return True
+
+    async def _publish(self, cell: str, payload: dict):
+        try:
+            await self.broker.publish(cell, payload)
+        except Exception:
+            self.broker_errors += 1
+            self._on_message(cell, payload)
+
+    def _on_message(self, cell: str, payload: dict):
+        """Broker callback: collect published payloads and deliver them shortly in one batch"""
+        if cell not in self._cells:
+            return
+        self._inbox[cell] = payload
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(BATCH_WINDOW, self._flush)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        inbox, self._inbox = self._inbox, {}
+
+        updated = []
+        for cell, payload in inbox.items():
+            state = self._cells.get(cell)
+            if state is None:
+                continue
+            if "error" in payload:
+                self._send_error(cell, payload["error"])
+                continue
+            state.stream.update(payload["packet"])
+            updated.append(cell)
+        self._deliver(updated, time.monotonic())
+        # Delivery may have moved due times earlier than the scheduler is waiting for
+        self._wakeup.set()
+
+    def _deliver(self, cells: list[str], started: float):
+        horizon = started + self.tick / 2
+        due: dict[ClientConnection, list[Subscription]] = {}
+        for cell in cells:
+            next_due = math.inf
+            for connection, subscription in self.manager.subscriptions_in(cell):
+                if subscription.next_due <= horizon:
+                    due.setdefault(connection, []).append(subscription)
+                    subscription.next_due = self._align(started + subscription.interval)
+                next_due = min(next_due, subscription.next_due)
+            if self.broker.shared:
+                # Subscribers in other processes may expect the default cadence
+                next_due = min(next_due, self._align(started + self.interval))
+            self._cells[cell].next_due = next_due if next_due != math.inf else started + self.interval
+
+        for connection, subscriptions in due.items():
+            self._send_updates(connection, subscriptions)
+
+    def _send_updates(self, connection: ClientConnection, subscriptions: list[Subscription]):
+        """Queue one frame with the latest update of each subscription"""
+        # An unsent update frame is superseded; its subscriptions ride along in the new one
+        carried = connection.take_pending(UPDATES_KEY)
+        if carried:
+            ids = {s.id for s in subscriptions}
+            subscriptions = subscriptions + [
+                connection.subscriptions[sub_id] for sub_id in carried
+                if sub_id not in ids and sub_id in connection.subscriptions
+            ]
+
+        codec = connection.codec
+        items = []
+        for subscription in subscriptions:
+            stream = self._cells[subscription.cell].stream
+            body = stream.body_for(codec, connection.seqs.get(subscription.id), subscription.id in connection.lost)
+            connection.seqs[subscription.id] = stream.seq
+            connection.lost.discard(subscription.id)
+            items.append((subscription.id, body))
+
+        if len(items) == 1 and items[0][0] == DEFAULT_SUBSCRIPTION:
+            # Single-location clients keep receiving plain update frames
+            body = items[0][1]
+        else:
+            body = codec.batch(items)
+            self.batch_frames += 1
+        connection.enqueue(codec.finish(body), key=UPDATES_KEY, subscriptions=[s.id for s in subscriptions])
+
+    def _send_error(self, cell: str, message: dict):
+        for connection, subscription in list(self.manager.subscriptions_in(cell)):
+            connection.enqueue(
+                connection.codec.encode({**message, "id": subscription.id}),
+                key=f"error:{subscription.id}"
+            )
+
+    def _frame_count(self, name: str) -> int:
+        return self._retired_frames[name] + sum(getattr(s.stream, name) for s in self._cells.values())
+
+    def stats(self) -> dict:
+        return {
+            **self.manager.stats(),
+            "scheduled_cells": len(self._cells),
+            "ticks": self.ticks,
+            "updates_built": self.updates_built,
+            "builds_in_flight": len(self._builds),
+            "batch_frames": self.batch_frames,
+            "broker": self.broker.stats(),
+            "broker_errors": self.broker_errors,
+            "snapshot_frames_encoded": self._frame_count("snapshots_encoded"),
+            "delta_frames_encoded": self._frame_count("deltas_encoded"),
+            "interval_seconds": self.interval,
+            "tick_seconds": self.tick,
+        }
+
+
+manager = ConnectionManager()
+hub = RealtimeHub(manager, broker=create_broker())
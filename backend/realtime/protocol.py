@@ -0,0 +1,263 @@
+"""
+Realtime wire protocols
+Protocol 1 (default) sends every realtime_update as a full JSON text frame.
+Protocol 2 is opt-in: the first frame for a location is a snapshot, later
+frames only carry the fields that changed. Frames are encoded with
+MessagePack (in requirements.txt) or CBOR (optional cbor2 package) and can
+be deflated. An explicitly requested encoding that is not installed is
+rejected rather than silently replaced.
+
+Protocol 2 frames:
+    {"t": "snapshot", "seq": n, "ts": <epoch seconds>, "data": {...packet}}
+    {"t": "delta", "seq": n, "base": m, "ts": <epoch seconds>, "set": {"aqi.value": 57, ...}, "unset": [...]}
+Delta keys are dotted paths into the packet; lists (alerts) are replaced
+whole. A delta applies to the frame with seq == base; whenever a client
+could have missed a frame it gets a snapshot instead.
+
+Updates for several subscriptions of one connection that fall due in the
+same tick are sent as one frame, in either protocol:
+    {"type" (v1) / "t" (v2): "batch", "updates": [{"id": <subscription id>, "data": <update>}, ...]}
+
+With deflate, every binary frame starts with one flag byte:
+0 = payload follows as is, 1 = payload is zlib-compressed.
+"""
+
+import json
+import os
+import time
+import zlib
+from collections import OrderedDict
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+SUBPROTOCOL_PREFIX = "greenguard.v2"
+# Frames smaller than this are not worth compressing
+DEFLATE_MIN_BYTES = int(os.getenv("REALTIME_DEFLATE_MIN_BYTES", "256"))
+DEFLATE_LEVEL = 6
+# Past updates per location a delta can be computed against
+DELTA_HISTORY = int(os.getenv("REALTIME_DELTA_HISTORY", "8"))
+
+
+def _json_dumps(message) -> str:
+    return json.dumps(message, separators=(",", ":"))
+
+
+class FrameCodec:
+    """
+    Encodes protocol messages into WebSocket frames (str = text, bytes = binary).
+    A body is a serialized message; a frame is a body after optional deflate.
+    """
+
+    def __init__(self, protocol: int, encoding: str, deflate: bool = False):
+        self.protocol = protocol
+        self.encoding = encoding
+        self.deflate = deflate
+        # Bodies do not depend on deflate and can be shared between both variants
+        self.body_format = f"v{protocol}.{encoding}"
+        self.name = f"{self.body_format}{'+deflate' if deflate else ''}"
+
+    def encode_body(self, message):
+        if self.encoding == "msgpack":
+            return msgpack.packb(message, use_bin_type=True)
+        if self.encoding == "cbor":
+            return cbor2.dumps(message)
+        if self.protocol == 1:
+            # Keep the original formatting for existing clients
+            return json.dumps(message)
+        return _json_dumps(message)
+
+    def finish(self, body):
+        if not self.deflate:
+            return body
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        if len(body) < DEFLATE_MIN_BYTES:
+            return b"\x00" + body
+        return b"\x01" + zlib.compress(body, DEFLATE_LEVEL)
+
+    def encode(self, message):
+        return self.finish(self.encode_body(message))
+
+    def batch(self, items: list) -> str | bytes:
+        """
+        Body of {"type"/"t": "batch", "updates": [{"id": ..., "data": ...}]}
+        assembled from (subscription id, encoded body) pairs without
+        re-serializing the bodies
+        """
+        type_key = "type" if self.protocol == 1 else "t"
+        if self.encoding == "json":
+            updates = ",".join(f'{{"id":{json.dumps(sub_id)},"data":{body}}}' for sub_id, body in items)
+            return f'{{"{type_key}":"batch","updates":[{updates}]}}'
+
+        pack = self.encode_body
+        entry_prefix = self._header("map", 2) + pack("id")
+        data_key = pack("data")
+        return (
+            self._header("map", 2) + pack(type_key) + pack("batch") + pack("updates")
+            + self._header("array", len(items))
+            + b"".join(entry_prefix + pack(sub_id) + data_key + body for sub_id, body in items)
+        )
+
+    def _header(self, kind: str, size: int) -> bytes:
+        """MessagePack / CBOR header of a map or array with size elements"""
+        if self.encoding == "msgpack":
+            if size < 16:
+                return bytes([(0x80 if kind == "map" else 0x90) | size])
+            return (b"\xde" if kind == "map" else b"\xdc") + size.to_bytes(2, "big")
+        major = 0xa0 if kind == "map" else 0x80
+        if size < 24:
+            return bytes([major | size])
+        if size < 256:
+            return bytes([major | 24, size])
+        return bytes([major | 25]) + size.to_bytes(2, "big")
+
+    def decode(self, data):
+        """Decode a control message from the client: JSON text, or a binary frame in this encoding"""
+        if isinstance(data, str) or self.encoding == "json":
+            return json.loads(data)
+        if self.encoding == "msgpack":
+            return msgpack.unpackb(data, raw=False)
+        return cbor2.loads(data)
+
+
+LEGACY_CODEC = FrameCodec(1, "json")
+_codecs: dict[str, FrameCodec] = {}
+
+
+def available_encodings() -> list[str]:
+    encodings = []
+    if msgpack is not None:
+        encodings.append("msgpack")
+    if cbor2 is not None:
+        encodings.append("cbor")
+    encodings.append("json")
+    return encodings
+
+
+def _check_encoding(encoding: str):
+    if encoding is not None and encoding not in available_encodings():
+        raise ValueError(f"Unsupported encoding: {encoding} (available: {', '.join(available_encodings())})")
+
+
+def get_codec(encoding: str = None, deflate: bool = False) -> FrameCodec:
+    """
+    Protocol 2 codec; None picks the best available encoding. Raises
+    ValueError for an encoding that is unknown or not installed
+    """
+    _check_encoding(encoding)
+    if encoding is None:
+        encoding = available_encodings()[0]
+    codec = FrameCodec(2, encoding, deflate)
+    return _codecs.setdefault(codec.name, codec)
+
+
+def negotiate(protocol: int = 1, encoding: str = None, compress: bool = False,
+              subprotocols: list[str] = ()):
+    """
+    Pick the codec for a new connection. Protocol 2 is selected by the
+    protocol=2 query parameter or by offering a subprotocol such as
+    "greenguard.v2", "greenguard.v2.msgpack" or "greenguard.v2.cbor+deflate".
+    Returns (codec, subprotocol to accept or None). Raises ValueError when
+    protocol 2 is requested with an encoding query parameter that is not
+    available; offered subprotocols with such an encoding are just skipped.
+    """
+    wants_v2 = protocol == 2 or any(offered.startswith(SUBPROTOCOL_PREFIX) for offered in subprotocols)
+    if wants_v2:
+        _check_encoding(encoding)
+
+    for offered in subprotocols:
+        if not offered.startswith(SUBPROTOCOL_PREFIX):
+            continue
+        name, _, option = offered.partition("+")
+        offered_encoding = name[len(SUBPROTOCOL_PREFIX) + 1:] or None
+        if offered_encoding is not None and offered_encoding not in available_encodings():
+            continue
+        return get_codec(offered_encoding or encoding, option == "deflate" or compress), offered
+
+    if protocol == 2:
+        return get_codec(encoding, compress), None
+    return LEGACY_CODEC, None
+
+
+def flatten(packet: dict, prefix: str = "") -> dict:
+    """Flatten nested dicts into dotted paths; everything else is a leaf value"""
+    flat = {}
+    for key, value in packet.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict) and value:
+            flat.update(flatten(value, path + "."))
+        else:
+            flat[path] = value
+    return flat
+
+
+class DeltaStream:
+    """
+    Sequence of packets for one location. The flattened form of the last
+    DELTA_HISTORY packets is kept so clients that skipped some updates (for
+    example with a longer update interval) still get a delta. Encoded bodies
+    are cached per format and base, so the cost does not grow with the
+    number of subscribers.
+    """
+
+    def __init__(self):
+        self.seq = 0
+        self.packet = None
+        self._history: OrderedDict[int, dict] = OrderedDict()
+        self._ts = 0.0
+        self._bodies = {}
+        self.snapshots_encoded = 0
+        self.deltas_encoded = 0
+
+    def update(self, packet: dict):
+        self.seq += 1
+        self._history[self.seq] = flatten({k: v for k, v in packet.items() if k not in ("type", "timestamp")})
+        if len(self._history) > DELTA_HISTORY:
+            self._history.popitem(last=False)
+        self.packet = packet
+        self._ts = round(time.time(), 3)
+        self._bodies.clear()
+
+    def _message(self, kind: str, base: int = None) -> dict:
+        if kind == "legacy":
+            return self.packet
+        if kind == "snapshot":
+            self.snapshots_encoded += 1
+            return {
+                "t": "snapshot", "seq": self.seq, "ts": self._ts,
+                "data": {k: v for k, v in self.packet.items() if k not in ("type", "timestamp")}
+            }
+
+        self.deltas_encoded += 1
+        current, previous = self._history[self.seq], self._history[base]
+        message = {
+            "t": "delta", "seq": self.seq, "base": base, "ts": self._ts,
+            "set": {path: value for path, value in current.items() if previous.get(path, ...) != value}
+        }
+        removed = [path for path in previous if path not in current]
+        if removed:
+            message["unset"] = removed
+        return message
+
+    def body_for(self, codec: FrameCodec, base: int = None, full: bool = False):
+        """Encoded body for a client whose last received seq is base; a snapshot unless a delta is safe"""
+        if codec.protocol == 1:
+            kind = "legacy"
+        elif full or base is None or base >= self.seq or base not in self._history:
+            kind, base = "snapshot", None
+        else:
+            kind = "delta"
+
+        cache_key = (codec.body_format, kind, base)
+        body = self._bodies.get(cache_key)
+        if body is None:
+            body = self._bodies[cache_key] = codec.encode_body(self._message(kind, base))
+        return body
@@ -0,0 +1,526 @@
+"""
+Pub/sub backbone for realtime updates across worker processes
+For every location cell one worker holds a producer lease: it polls the
+upstreams and publishes the update, and every worker (the producer
+included) forwards published updates to its local subscribers. Upstream
+polling therefore grows with the number of distinct cells rather than the
+number of workers.
+
+Brokers (REALTIME_BROKER):
+    memory  single process (default)
+    unix    workers on one host; whichever worker takes the lock file serves
+            a small broker on a Unix socket and the others connect to it
+    redis   multi-host, requires the 'redis' package
+    nats    multi-host, requires the 'nats-py' package and JetStream (for leases)
+"""
+
+import asyncio
+import itertools
+import json
+import os
+import tempfile
+import uuid
+
+BROKER_BACKEND = os.getenv("REALTIME_BROKER", "memory").lower()
+BROKER_PATH = os.getenv("REALTIME_BROKER_PATH", os.path.join(tempfile.gettempdir(), "greenguard_realtime.sock"))
+BROKER_URL = os.getenv("REALTIME_BROKER_URL", "")
+# A producer that stops renewing its lease is replaced after this long
+LEASE_SECONDS = float(os.getenv("REALTIME_LEASE_SECONDS", "45"))
+# Bytes the unix broker may queue for one subscriber before dropping it as too slow
+SUBSCRIBER_BUFFER_LIMIT = int(os.getenv("REALTIME_BROKER_BUFFER", str(1 << 20)))
+REQUEST_TIMEOUT = 2.0
+RECONNECT_DELAY = 0.5
+
+
+def _dumps(message) -> str:
+    return json.dumps(message, separators=(",", ":"))
+
+
+class Broker:
+    """
+    Delivers payloads published for a cell to on_message(cell, payload) in
+    every process subscribed to that cell. subscribe/unsubscribe never
+    block; publish, acquire and release may raise when the broker is down.
+    """
+
+    backend = "base"
+    # Whether other processes see what is published here
+    shared = True
+
+    def __init__(self):
+        self.on_message = None
+        self.cells: set[str] = set()
+        self.leases: set[str] = set()
+        self.published = 0
+        self.received = 0
+        # Published messages that could not be decoded and were skipped
+        self.decode_errors = 0
+
+    async def start(self, on_message):
+        self.on_message = on_message
+
+    async def close(self):
+        pass
+
+    def subscribe(self, cell: str):
+        self.cells.add(cell)
+
+    def unsubscribe(self, cell: str):
+        self.cells.discard(cell)
+
+    async def publish(self, cell: str, payload: dict):
+        raise NotImplementedError
+
+    async def acquire(self, cell: str, ttl: float = LEASE_SECONDS) -> bool:
+        """Take or renew the producer lease for a cell; True if this process holds it"""
+        raise NotImplementedError
+
+    async def release(self, cell: str):
+        self.leases.discard(cell)
+
+    def _deliver(self, cell: str, payload: dict):
+        if cell in self.cells and self.on_message is not None:
+            self.received += 1
+            self.on_message(cell, payload)
+
+    def _lease_result(self, cell: str, owned: bool) -> bool:
+        if owned:
+            self.leases.add(cell)
+        else:
+            self.leases.discard(cell)
+        return owned
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.backend,
+            "subscribed_cells": len(self.cells),
+            "leases_held": len(self.leases),
+            "published": self.published,
+            "received": self.received,
+            "decode_errors": self.decode_errors,
+        }
+
+
+class MemoryBroker(Broker):
+    """In-process broker: this process produces every cell itself"""
+
+    backend = "memory"
+    shared = False
+
+    async def publish(self, cell: str, payload: dict):
+        self.published += 1
+        self._deliver(cell, payload)
+
+    async def acquire(self, cell: str, ttl: float = LEASE_SECONDS) -> bool:
+        return self._lease_result(cell, True)
+
+
+class UnixSocketBroker(Broker):
+    """
+    Host-local broker over a Unix socket. Every worker is a client; the one
+    holding an exclusive lock on "<path>.lock" also runs the server. Leases
+    belong to a client connection, so a crashed worker's cells are taken
+    over on the next attempt, and when the serving worker dies another one
+    takes the lock and the rest reconnect.
+    Wire format: one JSON object per line. A subscriber that lets more than
+    SUBSCRIBER_BUFFER_LIMIT bytes pile up is disconnected; it reconnects and
+    resubscribes, missing only the updates published in between.
+    """
+
+    backend = "unix"
+    _PUB_PREFIX = b'{"op":"pub"'
+    _MSG_PREFIX = b'{"op":"msg"'
+
+    def __init__(self, path: str = BROKER_PATH):
+        super().__init__()
+        self.path = path
+        self._lock_file = None
+        self._server = None
+        self._client_task = None
+        self._writer = None
+        self._connected = asyncio.Event()
+        self._closing = False
+        self._requests: dict[int, asyncio.Future] = {}
+        self._request_ids = itertools.count()
+        # Server side: cell -> subscribed client writers, cell -> (holder writer, expiry)
+        self._subscribers: dict[str, set] = {}
+        self._holders: dict[str, tuple] = {}
+        self.slow_subscribers_dropped = 0
+
+    async def start(self, on_message):
+        await super().start(on_message)
+        self._client_task = asyncio.create_task(self._run_client())
+        try:
+            await asyncio.wait_for(self._connected.wait(), REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"Realtime broker at {self.path} not reachable yet; retrying in the background")
+
+    async def close(self):
+        self._closing = True
+        if self._client_task is not None:
+            self._client_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+        if self._server is not None:
+            self._server.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self._server = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    # Client side
+
+    async def _run_client(self):
+        """Connect to the host's broker, serving it ourselves if nobody does, and reconnect on failure"""
+        while not self._closing:
+            try:
+                if self._server is None:
+                    await self._try_serve()
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except OSError:
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+
+            self._writer = writer
+            for cell in self.cells:
+                self._send({"op": "sub", "cell": cell})
+            self._connected.set()
+            try:
+                while line := await reader.readline():
+                    self._handle(json.loads(line))
+            except (OSError, ValueError):
+                pass
+            finally:
+                self._connected.clear()
+                self._writer = None
+                self.leases.clear()
+                for future in self._requests.values():
+                    if not future.done():
+                        future.set_exception(ConnectionError("Realtime broker connection lost"))
+                self._requests.clear()
+                writer.close()
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    def _handle(self, message: dict):
+        if message["op"] == "msg":
+            self._deliver(message["cell"], message["payload"])
+        elif message["op"] == "ack":
+            future = self._requests.pop(message["req"], None)
+            if future is not None and not future.done():
+                future.set_result(message["ok"])
+
+    def _send(self, message: dict):
+        if self._writer is None:
+            raise ConnectionError(f"Realtime broker at {self.path} is not connected")
+        self._writer.write((_dumps(message) + "\n").encode("utf-8"))
+
+    async def _request(self, message: dict) -> bool:
+        request_id = next(self._request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._requests[request_id] = future
+        try:
+            self._send({**message, "req": request_id})
+            return await asyncio.wait_for(future, REQUEST_TIMEOUT)
+        finally:
+            self._requests.pop(request_id, None)
+
+    def subscribe(self, cell: str):
+        super().subscribe(cell)
+        if self._writer is not None:
+            self._send({"op": "sub", "cell": cell})
+
+    def unsubscribe(self, cell: str):
+        super().unsubscribe(cell)
+        if self._writer is not None:
+            self._send({"op": "unsub", "cell": cell})
+
+    async def publish(self, cell: str, payload: dict):
+        # "op" must stay the first key: the server rewrites the prefix instead of re-encoding
+        self._send({"op": "pub", "cell": cell, "payload": payload})
+        self.published += 1
+
+    async def acquire(self, cell: str, ttl: float = LEASE_SECONDS) -> bool:
+        return self._lease_result(cell, await self._request({"op": "acquire", "cell": cell, "ttl": ttl}))
+
+    async def release(self, cell: str):
+        await super().release(cell)
+        if self._writer is not None:
+            self._send({"op": "release", "cell": cell})
+
+    # Server side
+
+    async def _try_serve(self):
+        import fcntl
+
+        if self._lock_file is None:
+            lock_file = open(self.path + ".lock", "a+")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return
+            self._lock_file = lock_file
+        # Holding the lock means any socket file left behind belongs to a dead server
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._serve, self.path)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        try:
+            while line := await reader.readline():
+                if line.startswith(self._PUB_PREFIX):
+                    cell = json.loads(line)["cell"]
+                    data = self._MSG_PREFIX + line[len(self._PUB_PREFIX):]
+                    for subscriber in list(self._subscribers.get(cell, ())):
+                        if subscriber.transport.get_write_buffer_size() > SUBSCRIBER_BUFFER_LIMIT:
+                            self._drop_subscriber(subscriber)
+                        else:
+                            subscriber.write(data)
+                    continue
+
+                message = json.loads(line)
+                op, cell = message["op"], message["cell"]
+                if op == "sub":
+                    self._subscribers.setdefault(cell, set()).add(writer)
+                elif op == "unsub":
+                    self._remove_subscriber(cell, writer)
+                elif op == "acquire":
+                    holder = self._holders.get(cell)
+                    owned = holder is None or holder[0] is writer or holder[1] <= loop.time()
+                    if owned:
+                        self._holders[cell] = (writer, loop.time() + message["ttl"])
+                    writer.write((_dumps({"op": "ack", "req": message["req"], "ok": owned}) + "\n").encode("utf-8"))
+                elif op == "release":
+                    if self._holders.get(cell, (None,))[0] is writer:
+                        del self._holders[cell]
+        except (OSError, ValueError, KeyError):
+            pass
+        except asyncio.CancelledError:
+            # Server shutting down; the client reconnects elsewhere
+            pass
+        finally:
+            for cell in list(self._subscribers):
+                self._remove_subscriber(cell, writer)
+            for cell, (holder, _) in list(self._holders.items()):
+                if holder is writer:
+                    del self._holders[cell]
+            writer.close()
+
+    def _drop_subscriber(self, writer):
+        """Disconnect a subscriber that does not keep up; its connection handler cleans up the rest"""
+        self.slow_subscribers_dropped += 1
+        for cell in list(self._subscribers):
+            self._remove_subscriber(cell, writer)
+        writer.close()
+
+    def _remove_subscriber(self, cell: str, writer):
+        subscribers = self._subscribers.get(cell)
+        if subscribers is not None:
+            subscribers.discard(writer)
+            if not subscribers:
+                del self._subscribers[cell]
+
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            "path": self.path,
+            "connected": self._connected.is_set(),
+            "serving": self._server is not None,
+            "slow_subscribers_dropped": self.slow_subscribers_dropped,
+        }
+
+
+class RedisBroker(Broker):
+    """Redis pub/sub with leases stored as SET NX PX keys"""
+
+    backend = "redis"
+    _RENEW = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) else return 0 end"
+    _RELEASE = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+
+    def __init__(self, url: str, prefix: str = "greenguard:realtime:"):
+        super().__init__()
+        try:
+            import redis.asyncio as aioredis
+        except ImportError as e:
+            raise ImportError("REALTIME_BROKER=redis requires the 'redis' package (pip install redis)") from e
+        self.url = url
+        self.prefix = prefix
+        self.owner = uuid.uuid4().hex
+        self._redis = aioredis.Redis.from_url(url)
+        self._pubsub = self._redis.pubsub()
+        self._listener = None
+
+    def _channel(self, cell: str) -> str:
+        return f"{self.prefix}cell:{cell}"
+
+    async def start(self, on_message):
+        await super().start(on_message)
+        await self._redis.ping()
+        if self.cells:
+            await self._pubsub.subscribe(*(self._channel(cell) for cell in self.cells))
+        self._listener = asyncio.create_task(self._listen())
+
+    async def _listen(self):
+        channel_prefix = len(self._channel(""))
+        while True:
+            if not self._pubsub.subscribed:
+                await asyncio.sleep(0.1)
+                continue
+            try:
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except (OSError, ConnectionError) as e:
+                print(f"Realtime broker connection error: {e}")
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+            if message is None or message["type"] != "message":
+                continue
+            try:
+                cell = message["channel"].decode()[channel_prefix:]
+                payload = json.loads(message["data"])
+            except ValueError:
+                # Skip a malformed message rather than lose the listener
+                self.decode_errors += 1
+                continue
+            self._deliver(cell, payload)
+
+    def subscribe(self, cell: str):
+        super().subscribe(cell)
+        if self.on_message is not None:
+            asyncio.ensure_future(self._pubsub.subscribe(self._channel(cell)))
+
+    def unsubscribe(self, cell: str):
+        super().unsubscribe(cell)
+        if self.on_message is not None:
+            asyncio.ensure_future(self._pubsub.unsubscribe(self._channel(cell)))
+
+    async def publish(self, cell: str, payload: dict):
+        await self._redis.publish(self._channel(cell), _dumps(payload))
+        self.published += 1
+
+    async def acquire(self, cell: str, ttl: float = LEASE_SECONDS) -> bool:
+        key, ttl_ms = f"{self.prefix}lease:{cell}", int(ttl * 1000)
+        owned = await self._redis.set(key, self.owner, nx=True, px=ttl_ms)
+        if not owned:
+            owned = await self._redis.eval(self._RENEW, 1, key, self.owner, ttl_ms)
+        return self._lease_result(cell, bool(owned))
+
+    async def release(self, cell: str):
+        await super().release(cell)
+        await self._redis.eval(self._RELEASE, 1, f"{self.prefix}lease:{cell}", self.owner)
+
+    async def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+        await self._pubsub.close()
+        await self._redis.close()
+
+    def stats(self) -> dict:
+        return {**super().stats(), "url": self.url}
+
+
+class NatsBroker(Broker):
+    """NATS subjects per cell with leases in a JetStream key-value bucket whose TTL is the lease length"""
+
+    backend = "nats"
+
+    def __init__(self, url: str, subject: str = "greenguard.realtime", bucket: str = "greenguard_realtime_leases"):
+        super().__init__()
+        try:
+            import nats
+        except ImportError as e:
+            raise ImportError("REALTIME_BROKER=nats requires the 'nats-py' package (pip install nats-py)") from e
+        self._nats = nats
+        self.url = url
+        self.subject = subject
+        self.bucket = bucket
+        self.owner = uuid.uuid4().hex.encode()
+        self._nc = None
+        self._kv = None
+        self._subscriptions = {}
+        self._revisions: dict[str, int] = {}
+
+    @staticmethod
+    def _token(cell: str) -> str:
+        # Subject tokens cannot contain dots or wildcards; grid and raw keys may
+        return cell.encode("utf-8").hex()
+
+    async def start(self, on_message):
+        await super().start(on_message)
+        self._nc = await self._nats.connect(self.url)
+        self._kv = await self._nc.jetstream().create_key_value(bucket=self.bucket, ttl=LEASE_SECONDS)
+        for cell in list(self.cells):
+            await self._subscribe(cell)
+
+    async def _subscribe(self, cell: str):
+        if cell in self._subscriptions or cell not in self.cells:
+            return
+        self._subscriptions[cell] = None
+
+        async def handler(msg):
+            try:
+                payload = json.loads(msg.data)
+            except ValueError:
+                self.decode_errors += 1
+                return
+            self._deliver(cell, payload)
+
+        self._subscriptions[cell] = await self._nc.subscribe(f"{self.subject}.{self._token(cell)}", cb=handler)
+
+    def subscribe(self, cell: str):
+        super().subscribe(cell)
+        if self._nc is not None:
+            asyncio.ensure_future(self._subscribe(cell))
+
+    def unsubscribe(self, cell: str):
+        super().unsubscribe(cell)
+        subscription = self._subscriptions.pop(cell, None)
+        if subscription is not None:
+            asyncio.ensure_future(subscription.unsubscribe())
+
+    async def publish(self, cell: str, payload: dict):
+        await self._nc.publish(f"{self.subject}.{self._token(cell)}", _dumps(payload).encode("utf-8"))
+        self.published += 1
+
+    async def acquire(self, cell: str, ttl: float = LEASE_SECONDS) -> bool:
+        # The lease length is the bucket TTL; ttl is fixed when the bucket is created
+        from nats.js.errors import KeyWrongLastSequenceError
+
+        key, revision = self._token(cell), self._revisions.get(cell)
+        try:
+            if revision is None:
+                self._revisions[cell] = await self._kv.create(key, self.owner)
+            else:
+                self._revisions[cell] = await self._kv.update(key, self.owner, last=revision)
+        except KeyWrongLastSequenceError:
+            self._revisions.pop(cell, None)
+            return self._lease_result(cell, False)
+        return self._lease_result(cell, True)
+
+    async def release(self, cell: str):
+        await super().release(cell)
+        revision = self._revisions.pop(cell, None)
+        if revision is not None:
+            await self._kv.delete(self._token(cell), last=revision)
+
+    async def close(self):
+        if self._nc is not None:
+            await self._nc.drain()
+            self._nc = None
+
+    def stats(self) -> dict:
+        return {**super().stats(), "url": self.url}
+
+
+def create_broker(backend: str = BROKER_BACKEND) -> Broker:
+    if backend == "unix":
+        return UnixSocketBroker(BROKER_PATH)
+    if backend == "redis":
+        return RedisBroker(BROKER_URL or "redis://localhost:6379/0")
+    if backend == "nats":
+        return NatsBroker(BROKER_URL or "nats://localhost:4222")
+    if backend != "memory":
+        raise ValueError(f"Unknown REALTIME_BROKER '{backend}'")
+    return MemoryBroker()
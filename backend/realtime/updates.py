@@ -0,0 +1,71 @@
+"""
+Realtime monitoring payloads
+Builds the realtime_update packet streamed over /ws/realtime-monitoring
+"""
+
+import asyncio
+from datetime import datetime
+
+from services.weather_service import get_weather_data_async as get_weather_data
+from services.air_quality_service import get_current_aqi_async as get_aqi_data
+
+
+async def build_realtime_update(latitude: float, longitude: float) -> dict:
+    """Fetch current weather and AQI and assemble a realtime_update packet"""
+    # Fetch current weather and AQI data concurrently
+    weather_data, aqi_data = await asyncio.gather(
+        get_weather_data(latitude, longitude),
+        get_aqi_data(latitude, longitude)
+    )
+
+    aqi_value = aqi_data.get("aqi", 50) if "error" not in aqi_data else 50
+
+    # Create real-time data packet
+    realtime_data = {
+        "type": "realtime_update",
+        "timestamp": datetime.now().isoformat(),
+        "location": {
+            "latitude": latitude,
+            "longitude": longitude
+        },
+        "aqi": {
+            "value": aqi_value,
+            "status": "Good" if aqi_value <= 50 else
+                    "Moderate" if aqi_value <= 100 else "Unhealthy",
+            "pm25": aqi_data.get("pm25", 0),
+            "pm10": aqi_data.get("pm10", 0),
+            "co": aqi_data.get("co", 0),
+            "no2": aqi_data.get("no2", 0),
+            "o3": aqi_data.get("o3", 0),
+            "so2": aqi_data.get("so2", 0)
+        },
+        "weather": {
+            "temperature": weather_data.get("temperature", 22),
+            "humidity": weather_data.get("humidity", 60),
+            "wind_speed": weather_data.get("wind_speed", 5),
+            "description": weather_data.get("description", "Clear sky")
+        },
+        "alerts": []
+    }
+
+    # Add alerts based on conditions
+    if aqi_value > 150:
+        realtime_data["alerts"].append({
+            "level": "danger",
+            "message": "Very unhealthy air quality - avoid outdoor activities"
+        })
+    elif aqi_value > 100:
+        realtime_data["alerts"].append({
+            "level": "warning",
+            "message": "Unhealthy air quality for sensitive groups"
+        })
+
+    return realtime_data
+
+
+def build_error_message(error: Exception) -> dict:
+    return {
+        "type": "error",
+        "message": f"Data fetch error: {str(error)}",
+        "timestamp": datetime.now().isoformat()
+    }
@@ -4,32 +4,33 @@ Handles all air quality related endpoints
 """
 
 from fastapi import APIRouter, HTTPException, Query
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
 from typing import Optional, List
 import pandas as pd
+import numpy as np
 import os
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import sys
 import random
 import math
+import asyncio
 
 # Add parent directory to path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from ml.predict import AQIPredictor
-from services.weather_service import get_weather_data
-from services.air_quality_service import get_current_aqi as get_aqi_data
+from ml.predict import LAG_DAYS
+from ml.registry import model_registry
+from services.weather_service import get_weather_data_async as get_weather_data, get_weather_data_batch
+from services.air_quality_service import get_current_aqi_async as get_aqi_data, get_current_aqi_batch
+from services.historical_store import historical_store
+from services.historical_export import MEDIA_TYPES, check_format, stream_rows
+from services.rollups import rollups
 
 router = APIRouter(prefix="/api", tags=["AQI"])
 
-# Initialize predictor (lazy loading)
-predictor = None
-
-def get_predictor():
-    """Lazy load predictor"""
-    global predictor
-    if predictor is None:
-        predictor = AQIPredictor()
-    return predictor
+# Page sizes for /historical JSON responses with a date range
+HISTORICAL_PAGE_SIZE = int(os.getenv("HISTORICAL_PAGE_SIZE", "1000"))
+HISTORICAL_MAX_PAGE = int(os.getenv("HISTORICAL_MAX_PAGE", "10000"))
 
 def calculate_weather_adjusted_aqi(base_aqi: float, weather_data: dict) -> dict:
     """
@@ -91,6 +92,45 @@ def calculate_weather_adjusted_aqi(base_aqi: float, weather_data: dict) -> dict:
         'wind_speed': wind_speed
     }
 
+AQI_STATUS_THRESHOLDS = [50, 100, 150, 200, 300]
+AQI_STATUS_LABELS = np.array([
+    "Good", "Moderate", "Unhealthy for Sensitive Groups",
+    "Unhealthy", "Very Unhealthy", "Hazardous"
+])
+
+def calculate_weather_adjusted_aqi_batch(base_aqi: list, weather_data: list) -> dict:
+    """
+    Vectorized calculate_weather_adjusted_aqi over a whole batch
+    Returns a dict of NumPy arrays with the same keys as the scalar version
+    """
+    adjusted_aqi = np.asarray(base_aqi, dtype=float)
+    n = len(adjusted_aqi)
+    temperature = np.array([w.get('temperature', 20) for w in weather_data], dtype=float)
+    humidity = np.array([w.get('humidity', 50) for w in weather_data], dtype=float)
+    wind_speed = np.array([w.get('wind_speed', 5) for w in weather_data], dtype=float)
+
+    # Temperature, humidity and wind effects (see calculate_weather_adjusted_aqi)
+    adjusted_aqi = adjusted_aqi * np.where(temperature > 25, 1 + (temperature - 25) * 0.02, 1.0)
+    adjusted_aqi *= np.where(humidity > 70, 0.9, np.where(humidity < 30, 1.1, 1.0))
+    adjusted_aqi *= np.where(wind_speed > 10, 0.8, np.where(wind_speed < 2, 1.2, 1.0))
+
+    # Real-time variation (±10%) and bounds
+    adjusted_aqi *= np.random.uniform(0.9, 1.1, n)
+    adjusted_aqi = np.clip(adjusted_aqi, 10, 500)
+
+    pm25 = adjusted_aqi / 5 * np.random.uniform(0.8, 1.2, n)
+    pm10 = adjusted_aqi / 5 * 1.5 * np.random.uniform(0.8, 1.2, n)
+
+    return {
+        'aqi': np.round(adjusted_aqi, 1),
+        'pm25': np.round(pm25, 1),
+        'pm10': np.round(pm10, 1),
+        'co2': np.round(np.random.uniform(350, 450, n), 1),
+        'temperature': temperature,
+        'humidity': humidity,
+        'wind_speed': wind_speed
+    }
+
 class AQIResponse(BaseModel):
     aqi: float
     pm25: float
@@ -102,6 +142,21 @@ class AQIResponse(BaseModel):
     status: str
     timestamp: str
 
+class Coordinate(BaseModel):
+    latitude: float
+    longitude: float
+
+class BatchAQIRequest(BaseModel):
+    coordinates: List[Coordinate] = Field(..., min_length=1, max_length=1000)
+
+class BatchAQIItem(AQIResponse):
+    latitude: float
+    longitude: float
+
+class BatchForecastRequest(BaseModel):
+    coordinates: List[Coordinate] = Field(..., min_length=1, max_length=1000)
+    days: int = Field(7, ge=1, le=7)
+
 class ForecastResponse(BaseModel):
     date: str
     aqi: float
@@ -118,11 +173,11 @@ async def get_current_aqi(
     AQI values dynamically adjust based on temperature, humidity, and wind speed
     """
     try:
-        # Get real weather data
-        weather_data = get_weather_data(latitude, longitude)
-
-        # Get real air quality data
-        aqi_data = get_aqi_data(latitude, longitude)
+        # Get real weather and air quality data concurrently
+        weather_data, aqi_data = await asyncio.gather(
+            get_weather_data(latitude, longitude),
+            get_aqi_data(latitude, longitude)
+        )
 
         base_aqi = aqi_data.get("aqi", 50)
 
@@ -160,6 +215,53 @@ async def get_current_aqi(
         raise HTTPException(status_code=500, detail=f"Failed to fetch AQI data: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error fetching AQI: {str(e)}")
 
+@router.post("/current-aqi/batch")
+async def get_current_aqi_batch_route(request: BatchAQIRequest):
+    """
+    Get current AQI for many locations in one request
+
+    Cache lookups are grouped by location bucket, missing AQI values are
+    fetched with multi-coordinate upstream calls and the weather adjustment
+    runs over the whole batch at once
+    """
+    try:
+        coordinates = [(c.latitude, c.longitude) for c in request.coordinates]
+
+        weather_batch, aqi_batch = await asyncio.gather(
+            get_weather_data_batch(coordinates),
+            get_current_aqi_batch(coordinates)
+        )
+
+        base_aqi = [aqi_data.get("aqi", 50) for aqi_data in aqi_batch]
+        adjusted = calculate_weather_adjusted_aqi_batch(base_aqi, weather_batch)
+        statuses = AQI_STATUS_LABELS[np.searchsorted(AQI_STATUS_THRESHOLDS, adjusted['aqi'], side='left')]
+        temperature = np.round(adjusted['temperature'], 1)
+        humidity = np.round(adjusted['humidity'], 1)
+        wind_speed = np.round(adjusted['wind_speed'], 1)
+        timestamp = datetime.now().isoformat()
+
+        results = [
+            BatchAQIItem(
+                latitude=lat,
+                longitude=lon,
+                aqi=adjusted['aqi'][i],
+                pm25=adjusted['pm25'][i],
+                pm10=adjusted['pm10'][i],
+                co2=adjusted['co2'][i],
+                temperature=temperature[i],
+                humidity=humidity[i],
+                wind_speed=wind_speed[i],
+                status=statuses[i],
+                timestamp=timestamp
+            )
+            for i, (lat, lon) in enumerate(coordinates)
+        ]
+
+        return {"results": results, "count": len(results)}
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to fetch batch AQI data: {str(e)}")
+
 @router.get("/forecast")
 async def get_forecast(
     latitude: float = Query(..., description="Latitude"),
@@ -173,7 +275,7 @@ async def get_forecast(
         forecast_data = []
 
         # Get current weather as baseline
-        current_weather = get_weather_data(latitude, longitude)
+        current_weather = await get_weather_data(latitude, longitude)
         if "error" in current_weather:
             current_weather = {
                 "temperature": 22,
@@ -182,7 +284,7 @@ async def get_forecast(
             }
 
         # Get current AQI as baseline
-        current_aqi_data = get_aqi_data(latitude, longitude)
+        current_aqi_data = await get_aqi_data(latitude, longitude)
         base_aqi = current_aqi_data.get("aqi", 50) if "error" not in current_aqi_data else 50
 
         for day in range(days):
@@ -222,46 +324,148 @@ async def get_forecast(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating forecast: {str(e)}")
 
+@router.post("/forecast/batch")
+async def get_forecast_batch(request: BatchForecastRequest):
+    """
+    ML forecast for many locations in one request
+
+    Each coordinate is forecast from the history of its nearest station;
+    all stations are advanced together, one model call per forecast day
+    """
+    try:
+        try:
+            # Loaded and warmed at startup; only loads here if that has not finished
+            loaded = await asyncio.to_thread(model_registry.get)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Model not found. Please train the model first.")
+        try:
+            data = await asyncio.to_thread(historical_store.get)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Data file not found")
+
+        nearest = [data.index.nearest(c.latitude, c.longitude) for c in request.coordinates]
+        stations = list(dict.fromkeys(int(found[0][0]) for found in nearest))
+
+        # The last LAG_DAYS rows hold everything the model reads from a history
+        rows = [data.station_rows(station, limit=LAG_DAYS) for station in stations]
+        selected = np.concatenate(rows)
+        tails = pd.DataFrame({
+            name: np.asarray(data.columns[name][selected])
+            for name in data.names if name not in data.categories
+        })
+        bounds = np.cumsum([0] + [len(r) for r in rows])
+        histories = [tails.iloc[bounds[i]:bounds[i + 1]] for i in range(len(stations))]
+        forecasts = await asyncio.to_thread(loaded.predictor.predict_many, histories, request.days)
+        by_station = dict(zip(stations, forecasts))
+
+        results = [
+            {
+                "latitude": c.latitude,
+                "longitude": c.longitude,
+                "station": {**data.station_info(int(found[0][0])), "distance_km": round(float(found[1][0]), 1)},
+                "forecast": by_station[int(found[0][0])]
+            }
+            for c, found in zip(request.coordinates, nearest)
+        ]
+        return {"results": results, "count": len(results), "model_version": loaded.version}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to generate batch forecast: {str(e)}")
+
 @router.get("/historical")
 async def get_historical(
     latitude: float = Query(..., description="Latitude"),
-    longitude: float = Query(..., description="Longitude")
+    longitude: float = Query(..., description="Longitude"),
+    start: Optional[date] = Query(None, description="First day (YYYY-MM-DD)"),
+    end: Optional[date] = Query(None, description="Last day (YYYY-MM-DD)"),
+    limit: Optional[int] = Query(None, ge=1, description="Maximum rows to return"),
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page"),
+    format: str = Query("json", pattern="^(json|ndjson|csv|arrow)$", description="json, ndjson, csv or arrow")
 ):
     """
-    Get historical AQI data for last 6 months
+    Get historical AQI data. Without start, end or cursor this is the last
+    180 rows (6 months) near the location. With them, rows from start to end
+    in date order, paged with limit and cursor. ndjson, csv and arrow are
+    streamed; the next page cursor is then in the X-Next-Cursor header.
     """
     try:
-        # Load historical data
-        data_path = os.path.join(os.path.dirname(__file__), '..', 'data', 'air_quality_data.csv')
-        
-        if not os.path.exists(data_path):
+        if format != "json":
+            check_format(format)
+        try:
+            data = await asyncio.to_thread(historical_store.get)
+        except FileNotFoundError:
             raise HTTPException(status_code=404, detail="Data file not found")
-        
-        df = pd.read_csv(data_path)
-        df['date'] = pd.to_datetime(df['date'])
-        
-        # Filter by location
-        location_df = df[
-            (df['lat'].between(latitude - 0.1, latitude + 0.1)) &
-            (df['lon'].between(longitude - 0.1, longitude + 0.1))
-        ]
-        
-        if len(location_df) == 0:
-            location_df = df
-        
-        # Get last 6 months (180 days) of data
-        location_df = location_df.sort_values('date').tail(180)
-        
-        # Convert to list of dictionaries
-        historical = location_df.to_dict('records')
-        
-        # Format dates
-        for record in historical:
-            if isinstance(record.get('date'), pd.Timestamp):
-                record['date'] = record['date'].strftime('%Y-%m-%d')
-        
-        return {"data": historical}
-    
+
+        if start is None and end is None and cursor is None:
+            # Last 6 months (180 days) of data near the location, or of all stations if none is close
+            rows = data.rows_near(latitude, longitude, radius=0.1, limit=limit or 180)
+            if rows is None:
+                rows = data.rows_all(limit=limit or 180)
+            next_cursor = None
+        else:
+            if limit is None and format == "json":
+                limit = HISTORICAL_PAGE_SIZE
+            rows = data.rows_between(latitude, longitude, radius=0.1, start=start, end=end)
+            rows, next_cursor = data.page(rows, cursor=cursor, limit=min(limit, HISTORICAL_MAX_PAGE) if format == "json" else limit)
+
+        if format != "json":
+            headers = {"X-Next-Cursor": next_cursor} if next_cursor else {}
+            return StreamingResponse(stream_rows(data, rows, format), media_type=MEDIA_TYPES[format], headers=headers)
+
+        response = {"data": data.records(rows)}
+        if next_cursor:
+            response["next_cursor"] = next_cursor
+        return response
+
+    except HTTPException:
+        raise
+    except (ImportError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching historical data: {str(e)}")
 
+@router.get("/aggregates")
+async def get_aggregates(
+    latitude: float = Query(..., description="Latitude"),
+    longitude: float = Query(..., description="Longitude"),
+    period: str = Query("week", pattern="^(day|week|month)$", description="day, week or month"),
+    metrics: Optional[str] = Query(None, description="Comma-separated columns, e.g. aqi,pm25 (default: all)"),
+    start: Optional[date] = Query(None, description="First period start (YYYY-MM-DD)"),
+    end: Optional[date] = Query(None, description="Last period start (YYYY-MM-DD)")
+):
+    """
+    Per-station mean / min / max / percentiles per day, week or month from
+    precomputed rollups, for stations near the location (all stations if
+    none is close)
+    """
+    try:
+        try:
+            data, table = await asyncio.to_thread(rollups.get, period)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Data file not found")
+
+        available = rollups.metrics(data)
+        selected = available if metrics is None else [m.strip() for m in metrics.split(",") if m.strip()]
+        unknown = [m for m in selected if m not in available]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown metrics {unknown}; available: {available}")
+
+        stations = data.stations_in_box(latitude, longitude, 0.1)
+        if len(stations) == 0:
+            stations = range(data.stations)
+
+        return {
+            "period": period,
+            "metrics": selected,
+            "stations": [
+                {**data.station_info(station), "data": table.records(table.rows(station, start, end), selected)}
+                for station in stations
+            ]
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching aggregates: {str(e)}")
@@ -5,11 +5,12 @@ Calculates pollution exposure for travel routes
 
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
-import pandas as pd
 import os
-import math
+import numpy as np
 import requests
 from typing import List, Dict
+from services import geodesy
+from services.historical_store import historical_store
 
 router = APIRouter(prefix="/api", tags=["Travel"])
 
@@ -37,56 +38,70 @@ class TravelResponse(BaseModel):
     state_breakdown: List[StateAnalysis]
     travel_mode: str
 
+# Distance between route samples used for the state breakdown
+ROUTE_SAMPLE_KM = float(os.getenv("ROUTE_SAMPLE_KM", "0.5"))
+
 def haversine_distance(lat1, lon1, lat2, lon2):
     """Calculate distance between two points using Haversine formula"""
-    R = 6371  # Earth radius in km
-    
-    dlat = math.radians(lat2 - lat1)
-    dlon = math.radians(lon2 - lon1)
-    
-    a = math.sin(dlat/2)**2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon/2)**2
-    c = 2 * math.asin(math.sqrt(a))
-    
-    return R * c
+    return float(geodesy.haversine_km(lat1, lon1, lat2, lon2))
+
+# (state, lat_min, lat_max, lon_min, lon_max), first match wins
+STATE_BOXES = [
+    ("California", 32.5, 42.0, -124.7, -114.1),
+    ("New York", 40.5, 45.0, -79.8, -71.8),
+    ("Florida", 25.0, 31.0, -87.6, -80.0),
+    ("Colorado", 36.0, 42.0, -109.0, -102.0),
+    ("Michigan", 41.0, 43.5, -87.9, -84.7),
+    ("Georgia", 33.0, 37.0, -84.0, -75.0),
+    ("Tennessee", 35.0, 40.0, -90.0, -80.0),
+    ("Ohio", 38.0, 42.0, -85.0, -80.0),
+    ("Illinois", 39.0, 43.0, -95.0, -89.0),
+]
+STATE_NAMES = np.array([box[0] for box in STATE_BOXES] + ["Unknown"])
+_STATE_BOUNDS = np.array([box[1:] for box in STATE_BOXES])
 
 def get_state_from_coords(lat: float, lon: float) -> str:
     """Simple state determination based on coordinates (US only)"""
     # This is a simplified version - in production, use a proper geolocation service
-    if 32.5 <= lat <= 42.0 and -124.7 <= lon <= -114.1:
-        return "California"
-    elif 40.5 <= lat <= 45.0 and -79.8 <= lon <= -71.8:
-        return "New York"
-    elif 25.0 <= lat <= 31.0 and -87.6 <= lon <= -80.0:
-        return "Florida"
-    elif 36.0 <= lat <= 42.0 and -109.0 <= lon <= -102.0:
-        return "Colorado"
-    elif 41.0 <= lat <= 43.5 and -87.9 <= lon <= -84.7:
-        return "Michigan"
-    elif 33.0 <= lat <= 37.0 and -84.0 <= lon <= -75.0:
-        return "Georgia"
-    elif 35.0 <= lat <= 40.0 and -90.0 <= lon <= -80.0:
-        return "Tennessee"
-    elif 38.0 <= lat <= 42.0 and -85.0 <= lon <= -80.0:
-        return "Ohio"
-    elif 39.0 <= lat <= 43.0 and -95.0 <= lon <= -89.0:
-        return "Illinois"
-    else:
-        return "Unknown"
+    return str(get_states_for_points(np.array([lat]), np.array([lon]))[0])
+
+def get_states_for_points(lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """State name for every point of an array"""
+    lat_min, lat_max, lon_min, lon_max = (_STATE_BOUNDS[:, i, None] for i in range(4))
+    inside = (lat_min <= lats) & (lats <= lat_max) & (lon_min <= lons) & (lons <= lon_max)
+    first = np.where(inside.any(axis=0), inside.argmax(axis=0), len(STATE_BOXES))
+    return STATE_NAMES[first]
 
 def get_states_along_route(source_lat: float, source_lon: float, dest_lat: float, dest_lon: float, num_points: int = 10) -> List[str]:
-    """Get list of states along the route by sampling points"""
-    states = []
-    
-    # Sample points along the route
-    for i in range(num_points + 1):
-        t = i / num_points
-        lat = source_lat + t * (dest_lat - source_lat)
-        lon = source_lon + t * (dest_lon - source_lon)
-        state = get_state_from_coords(lat, lon)
-        if state not in states:
-            states.append(state)
-    
-    return states
+    """Get list of states along the route by sampling points on the great circle"""
+    lats, lons = geodesy.great_circle_points(source_lat, source_lon, dest_lat, dest_lon, num_points + 1)
+    states = get_states_for_points(lats, lons)
+    _, first_seen = np.unique(states, return_index=True)
+    return states[np.sort(first_seen)].tolist()
+
+def get_route_state_segments(source_lat: float, source_lon: float, dest_lat: float, dest_lon: float,
+                             spacing_km: float = ROUTE_SAMPLE_KM) -> List[Dict]:
+    """
+    Distance travelled in each state along the route, in route order, with
+    the middle point of each state's stretch
+    """
+    lats, lons, distances = geodesy.sample_route([source_lat, dest_lat], [source_lon, dest_lon], spacing_km)
+    states = get_states_for_points(lats, lons)
+    # Each sample stands for the stretch up to the next one
+    stretch = np.diff(distances, append=distances[-1])
+
+    segments = []
+    names, first_seen = np.unique(states, return_index=True)
+    for index in np.argsort(first_seen):
+        mask = states == names[index]
+        middle = np.flatnonzero(mask)[mask.sum() // 2]
+        segments.append({
+            "state": str(names[index]),
+            "distance_km": float(stretch[mask].sum()),
+            "lat": float(lats[middle]),
+            "lon": float(lons[middle]),
+        })
+    return segments
 
 def get_real_time_aqi(lat: float, lon: float) -> float:
     """Get real-time AQI from external API"""
@@ -134,26 +149,12 @@ def get_real_time_aqi(lat: float, lon: float) -> float:
 def get_aqi_from_local_data(lat: float, lon: float) -> float:
     """Fallback to local CSV data"""
     try:
-        data_path = os.path.join(os.path.dirname(__file__), '..', 'data', 'air_quality_data.csv')
-        df = pd.read_csv(data_path)
+        data = historical_store.get()
         
-        # Find closest data point
-        df['distance'] = df.apply(lambda row: haversine_distance(lat, lon, row['lat'], row['lon']), axis=1)
-        closest = df.loc[df['distance'].idxmin()]
-        return float(closest['aqi'])
+        # Latest reading of the closest station
+        return float(data.latest(data.nearest_station(lat, lon), 'aqi'))
     except:
         return 50.0  # Default moderate AQI
-    """Get AQI for a location from dataset"""
-    location_df = df[
-        (df['lat'].between(lat - radius, lat + radius)) &
-        (df['lon'].between(lon - radius, lon + radius))
-    ]
-    
-    if len(location_df) == 0:
-        # Use overall average if no match
-        return float(df['aqi'].mean())
-    
-    return float(location_df['aqi'].mean())
 
 @router.post("/travel-exposure")
 async def calculate_travel_exposure(request: TravelRequest):
@@ -171,23 +172,19 @@ async def calculate_travel_exposure(request: TravelRequest):
             request.dest_lat, request.dest_lon
         )
         
-        # Get states along the route
-        states = get_states_along_route(
+        # Distance through each state along the route
+        segments = get_route_state_segments(
             request.source_lat, request.source_lon,
             request.dest_lat, request.dest_lon
         )
         
         # Calculate state-by-state breakdown
         state_breakdown = []
-        for state in states:
-            if state != "Unknown":
-                # Sample multiple points within the state for average AQI
-                state_lat = (request.source_lat + request.dest_lat) / 2  # Simplified
-                state_lon = (request.source_lon + request.dest_lon) / 2
-                state_aqi = get_real_time_aqi(state_lat, state_lon)
-                
-                # Estimate distance through this state (simplified)
-                state_distance = total_distance / len(states)
+        for segment in segments:
+            if segment["state"] != "Unknown":
+                # AQI in the middle of the state's stretch of the route
+                state_aqi = get_real_time_aqi(segment["lat"], segment["lon"])
+                state_distance = segment["distance_km"]
                 
                 # Determine risk level for this state
                 if state_aqi <= 50:
@@ -200,7 +197,7 @@ async def calculate_travel_exposure(request: TravelRequest):
                     risk_level = "Very High"
                 
                 state_breakdown.append(StateAnalysis(
-                    state=state,
+                    state=segment["state"],
                     distance_km=round(state_distance, 1),
                     average_aqi=round(state_aqi, 1),
                     risk_level=risk_level
@@ -252,7 +249,7 @@ async def calculate_travel_exposure(request: TravelRequest):
         elif dest_aqi > source_aqi:
             recommendations.append(f"Source has better air quality ({source_aqi:.1f} vs {dest_aqi:.1f})")
         
-        recommendations.append(f"Travel distance: {distance:.1f} km")
+        recommendations.append(f"Travel distance: {total_distance:.1f} km")
         
         return TravelResponse(
             source_aqi=round(source_aqi, 1),
@@ -260,7 +257,10 @@ async def calculate_travel_exposure(request: TravelRequest):
             route_average_aqi=round(route_average_aqi, 1),
             exposure_level=exposure_level,
             risk_assessment=risk_assessment,
-            recommendations=recommendations
+            recommendations=recommendations,
+            total_distance_km=round(total_distance, 1),
+            state_breakdown=state_breakdown,
+            travel_mode=request.travel_mode
         )
     
     except Exception as e:
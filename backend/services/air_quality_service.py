@@ -1,67 +1,216 @@
-import requests
-import time
+import asyncio
+import os
 import random
 
-# Simple in-memory cache
-_cache = {}
+from services.cache import cache
+from services.http_client import client, get_json_blocking
+from services.revalidate import revalidator
+from services.spatial import quantizer
+
+AQI_URL = "https://air-quality-api.open-meteo.com/v1/air-quality"
+AQI_CACHE_SECONDS = int(os.getenv("CACHE_TTL_AQI", "900"))  # 15 minutes
+AQI_STALE_SECONDS = int(os.getenv("CACHE_STALE_AQI", "1800"))  # serve-stale window after expiry
+AQI_BATCH_CHUNK = int(os.getenv("AQI_BATCH_CHUNK", "100"))  # coordinates per Open-Meteo call
+AQI_BATCH_CONCURRENCY = int(os.getenv("AQI_BATCH_CONCURRENCY", "4"))  # concurrent bulk calls per batch
+
+cache.set_ttl("aqi", AQI_CACHE_SECONDS)
+
+
+def _aqi_params(lat: float, lon: float) -> dict:
+    return {
+        "latitude": lat,
+        "longitude": lon,
+        "current": "pm10,pm2_5,carbon_monoxide,nitrogen_dioxide,sulphur_dioxide,ozone,european_aqi"
+    }
+
+
+def _parse_aqi(data: dict) -> dict:
+    if 'current' not in data:
+        raise ValueError("Invalid response format")
+
+    current = data['current']
+    return {
+        "aqi": current.get('european_aqi', 0),
+        "pm25": current.get('pm2_5', 0),
+        "pm10": current.get('pm10', 0),
+        "co": current.get('carbon_monoxide', 0),
+        "no2": current.get('nitrogen_dioxide', 0),
+        "o3": current.get('ozone', 0),
+        "so2": current.get('sulphur_dioxide', 0)
+    }
+
+
+def _fallback_aqi(entry, lat: float, lon: float) -> dict:
+    # Return the bucket's cached data (entry) if available, even if expired
+    if entry is not None:
+        return entry.value
+
+    # Generate realistic mock data based on location as fallback
+    base_aqi = 30 + random.uniform(-10, 20)
+
+    # Add location-based variation
+    if abs(lat - 40.7128) < 1 and abs(lon - (-74.0060)) < 1:  # NYC area
+        base_aqi += 15
+
+    return {
+        "aqi": round(base_aqi, 2),
+        "pm25": round(base_aqi / 5, 2),
+        "pm10": round(base_aqi / 4, 2),
+        "co": round(base_aqi * 2, 2),
+        "no2": round(base_aqi / 3, 2),
+        "o3": round(base_aqi / 2, 2),
+        "so2": round(base_aqi / 10, 2)
+    }
+
 
 def get_current_aqi(lat: float, lon: float):
-    # Create cache key
-    cache_key = f"aqi_{lat}_{lon}"
-    current_time = time.time()
+    """Blocking variant, kept for scripts; request handlers use get_current_aqi_async"""
+    # Nearby coordinates share a cache bucket
+    cache_key, upstream_lat, upstream_lon = quantizer.quantize(lat, lon)
 
     # Check cache (15 minute cache for AQI data)
-    if cache_key in _cache:
-        cached_data, timestamp = _cache[cache_key]
-        if current_time - timestamp < 900:  # 15 minutes
-            return cached_data
+    cached_data = cache.get("aqi", cache_key)
+    quantizer.record_lookup("aqi", cache_key, lat, lon, hit=cached_data is not None)
+    if cached_data is not None:
+        return cached_data
 
     try:
         # Open-Meteo Air Quality API
-        url = f"https://air-quality-api.open-meteo.com/v1/air-quality?latitude={lat}&longitude={lon}&current=pm10,pm2_5,carbon_monoxide,nitrogen_dioxide,sulphur_dioxide,ozone,european_aqi"
-        
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-
-        if 'current' in data:
-            current = data['current']
-            
-            result_data = {
-                "aqi": current.get('european_aqi', 0),
-                "pm25": current.get('pm2_5', 0),
-                "pm10": current.get('pm10', 0),
-                "co": current.get('carbon_monoxide', 0),
-                "no2": current.get('nitrogen_dioxide', 0),
-                "o3": current.get('ozone', 0),
-                "so2": current.get('sulphur_dioxide', 0)
-            }
-
-            # Cache the result
-            _cache[cache_key] = (result_data, current_time)
-            return result_data
-        else:
-            raise ValueError("Invalid response format")
+        data = get_json_blocking(AQI_URL, params=_aqi_params(upstream_lat, upstream_lon), timeout=10)
+        result_data = _parse_aqi(data)
+
+        # Cache the result
+        cache.set("aqi", cache_key, result_data)
+        quantizer.record_fetch("aqi", cache_key, lat, lon)
+        return result_data
+
+    except Exception as e:
+        print(f"Error fetching air quality data: {e}")
+        return _fallback_aqi(cache.get_entry("aqi", cache_key), lat, lon)
+
+
+async def _fetch_aqi_async(cache_key: str, upstream_lat: float, upstream_lon: float, lat: float, lon: float):
+    data = await client.get_json(AQI_URL, params=_aqi_params(upstream_lat, upstream_lon), timeout=10)
+    result_data = _parse_aqi(data)
+
+    await cache.aset("aqi", cache_key, result_data)
+    quantizer.record_fetch("aqi", cache_key, lat, lon)
+    return result_data
+
+
+async def get_current_aqi_async(lat: float, lon: float):
+    """Awaitable get_current_aqi using the pooled async upstream client"""
+    # Nearby coordinates share a cache bucket
+    cache_key, upstream_lat, upstream_lon = quantizer.quantize(lat, lon)
+
+    async def fetch():
+        return await _fetch_aqi_async(cache_key, upstream_lat, upstream_lon, lat, lon)
+
+    try:
+        # Serve fresh or recently expired data at once, refreshing in the background
+        result_data, hit = await revalidator.get("aqi", cache_key, fetch, stale_for=AQI_STALE_SECONDS)
+        quantizer.record_lookup("aqi", cache_key, lat, lon, hit=hit)
+        return result_data
 
     except Exception as e:
+        quantizer.record_lookup("aqi", cache_key, lat, lon, hit=False)
         print(f"Error fetching air quality data: {e}")
-        # Return cached data if available
-        if cache_key in _cache:
-            return _cache[cache_key][0]
-
-        # Generate realistic mock data based on location as fallback
-        base_aqi = 30 + random.uniform(-10, 20)
-        
-        # Add location-based variation
-        if abs(lat - 40.7128) < 1 and abs(lon - (-74.0060)) < 1:  # NYC area
-            base_aqi += 15
-
-        return {
-            "aqi": round(base_aqi, 2),
-            "pm25": round(base_aqi / 5, 2),
-            "pm10": round(base_aqi / 4, 2),
-            "co": round(base_aqi * 2, 2),
-            "no2": round(base_aqi / 3, 2),
-            "o3": round(base_aqi / 2, 2),
-            "so2": round(base_aqi / 10, 2)
-        }
\ No newline at end of file
+        return _fallback_aqi(await cache.aget_entry("aqi", cache_key), lat, lon)
+
+
+async def _fetch_aqi_bulk(buckets: dict) -> dict:
+    """
+    Fetch many cache buckets with multi-coordinate Open-Meteo calls.
+    buckets maps cache_key -> (upstream_lat, upstream_lon, lat, lon);
+    returns cache_key -> result for the buckets that were fetched. Buckets
+    of a failed chunk are missing from the result, so callers can mark them failed.
+    """
+    keys = list(buckets)
+    results = {}
+    semaphore = asyncio.Semaphore(AQI_BATCH_CONCURRENCY)
+
+    async def fetch_chunk(chunk):
+        params = _aqi_params(
+            ",".join(str(buckets[key][0]) for key in chunk),
+            ",".join(str(buckets[key][1]) for key in chunk)
+        )
+        async with semaphore:
+            data = await client.get_json(AQI_URL, params=params, timeout=10)
+
+        # Open-Meteo returns a list for several locations, a single object for one
+        items = data if isinstance(data, list) else [data]
+        fetched = {}
+        for key, item in zip(chunk, items):
+            try:
+                fetched[key] = _parse_aqi(item)
+            except ValueError:
+                continue
+        await cache.aset_many("aqi", fetched)
+        for key in fetched:
+            quantizer.record_fetch("aqi", key, buckets[key][2], buckets[key][3])
+        results.update(fetched)
+
+    chunks = [keys[i:i + AQI_BATCH_CHUNK] for i in range(0, len(keys), AQI_BATCH_CHUNK)]
+    outcomes = await asyncio.gather(*(fetch_chunk(chunk) for chunk in chunks), return_exceptions=True)
+    for chunk, outcome in zip(chunks, outcomes):
+        if isinstance(outcome, Exception):
+            print(f"Error fetching air quality batch of {len(chunk)} buckets: {outcome}")
+
+    return results
+
+
+async def get_current_aqi_batch(coordinates: list) -> list:
+    """
+    Current AQI for many (lat, lon) pairs, in input order.
+    Cache lookups are grouped by bucket, misses are fetched in bulk and
+    stale buckets are refreshed together in the background.
+    """
+    bucket_keys = []
+    buckets = {}
+    results = {}
+    misses = {}
+    stale = {}
+
+    for lat, lon in coordinates:
+        cache_key, upstream_lat, upstream_lon = quantizer.quantize(lat, lon)
+        bucket_keys.append(cache_key)
+        buckets.setdefault(cache_key, (upstream_lat, upstream_lon, lat, lon))
+
+    lookups = await cache.alookup_many("aqi", buckets, stale_for=AQI_STALE_SECONDS)
+    for cache_key, (entry, state) in lookups.items():
+        if entry is None:
+            misses[cache_key] = buckets[cache_key]
+        else:
+            results[cache_key] = entry.value
+            if state == "stale":
+                stale[cache_key] = buckets[cache_key]
+
+    recorded = set()
+    for cache_key, (lat, lon) in zip(bucket_keys, coordinates):
+        # Later coordinates in a bucket are covered by the first one's lookup
+        quantizer.record_lookup("aqi", cache_key, lat, lon, hit=cache_key in recorded or cache_key in results)
+        recorded.add(cache_key)
+
+    # Buckets whose last fetch failed go straight to fallback data
+    for cache_key in [key for key in misses if await revalidator.recently_failed("aqi", key)]:
+        del misses[cache_key]
+
+    if misses:
+        results.update(await _fetch_aqi_bulk(misses))
+        for cache_key in misses:
+            if cache_key not in results:
+                await revalidator.mark_failed("aqi", cache_key)
+
+    if stale:
+        await revalidator.refresh_many(
+            "aqi", list(stale), lambda keys: _fetch_aqi_bulk({key: stale[key] for key in keys})
+        )
+
+    fallbacks = {
+        cache_key: await cache.aget_entry("aqi", cache_key)
+        for cache_key in buckets if cache_key not in results
+    }
+    return [
+        results[cache_key] if cache_key in results else _fallback_aqi(fallbacks[cache_key], lat, lon)
+        for cache_key, (lat, lon) in zip(bucket_keys, coordinates)
+    ]
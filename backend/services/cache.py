@@ -0,0 +1,255 @@
+"""
+Bounded LRU + TTL cache shared by the upstream services
+Entries are grouped by namespace ("aqi", "weather", ...), each with its own TTL.
+The default backend is in-process; CACHE_BACKEND selects a store shared
+by all worker processes (see services/shared_cache.py).
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+DEFAULT_TTL = 300
+
+# memory (per process) | sqlite (shared file, WAL) | redis
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_SQLITE_PATH = os.getenv("CACHE_SQLITE_PATH", os.path.join(tempfile.gettempdir(), "greenguard_cache.db"))
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+
+def estimate_size(value) -> int:
+    """Rough in-memory size of a cached value (dicts/lists of scalars)"""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(sys.getsizeof(k) + estimate_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(estimate_size(v) for v in value)
+    return size
+
+
+class CacheEntry:
+    __slots__ = ("value", "stored_at", "expires_at", "size", "hits")
+
+    def __init__(self, value, stored_at: float, expires_at: float, size: int):
+        self.value = value
+        self.stored_at = stored_at
+        self.expires_at = expires_at
+        self.size = size
+        self.hits = 0
+
+    def is_fresh(self, now: float) -> bool:
+        return now < self.expires_at
+
+
+class BaseCache:
+    """
+    Interface shared by the cache backends: per-namespace TTLs, counters,
+    lookup()/get()/get_entry()/set()/delete()/clear()/stats(), and awaitable
+    alookup()/alookup_many()/aget_entry()/aset()/aset_many()/astats() for the
+    event loop. The in-process cache answers those directly; shared backends
+    override them so the loop never waits on disk or network I/O.
+    """
+
+    backend = "base"
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, max_bytes: int = CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._ttls: dict[str, float] = {}
+        self._stats: dict[str, dict[str, int]] = {}
+
+    def set_ttl(self, namespace: str, seconds: float):
+        self._ttls[namespace] = seconds
+
+    def ttl(self, namespace: str) -> float:
+        return self._ttls.get(namespace, DEFAULT_TTL)
+
+    def _counters(self, namespace: str) -> dict:
+        return self._stats.setdefault(
+            namespace, {"hits": 0, "stale_hits": 0, "misses": 0, "expired": 0, "evictions": 0}
+        )
+
+    def _count(self, namespace: str, counter: str):
+        self._counters(namespace)[counter] += 1
+
+    def _classify(self, namespace: str, entry, stale_for: float, now: float):
+        """Counts the lookup and returns its state for an entry (or None)"""
+        if entry is None:
+            self._count(namespace, "misses")
+            return "miss"
+        if entry.is_fresh(now):
+            self._count(namespace, "hits")
+            return "fresh"
+        if now - entry.expires_at < stale_for:
+            self._count(namespace, "stale_hits")
+            return "stale"
+        self._count(namespace, "expired")
+        return "miss"
+
+    def _namespace_stats(self) -> dict:
+        return {
+            namespace: {**self._counters(namespace), "ttl": self.ttl(namespace)}
+            for namespace in sorted(set(self._ttls) | set(self._stats))
+        }
+
+    def get(self, namespace: str, key: str, now: float = None):
+        """Return the cached value if present and fresh, otherwise None"""
+        entry, _ = self.lookup(namespace, key, now=now)
+        return entry.value if entry is not None else None
+
+    def lookup(self, namespace: str, key: str, stale_for: float = 0, now: float = None):
+        raise NotImplementedError
+
+    def get_entry(self, namespace: str, key: str):
+        raise NotImplementedError
+
+    def set(self, namespace: str, key: str, value, ttl: float = None, now: float = None):
+        raise NotImplementedError
+
+    def delete(self, namespace: str, key: str):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def items(self) -> list:
+        """All entries as (namespace, key, CacheEntry), least recently used first"""
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        raise NotImplementedError
+
+    def lookup_many(self, namespace: str, keys, stale_for: float = 0, now: float = None) -> dict:
+        """lookup() for several keys; returns key -> (entry, state)"""
+        return {key: self.lookup(namespace, key, stale_for, now) for key in keys}
+
+    def set_many(self, namespace: str, values: dict, ttl: float = None, now: float = None):
+        for key, value in values.items():
+            self.set(namespace, key, value, ttl, now)
+
+    async def alookup(self, namespace: str, key: str, stale_for: float = 0, now: float = None):
+        return self.lookup(namespace, key, stale_for, now)
+
+    async def alookup_many(self, namespace: str, keys, stale_for: float = 0, now: float = None) -> dict:
+        return self.lookup_many(namespace, keys, stale_for, now)
+
+    async def aget_entry(self, namespace: str, key: str):
+        return self.get_entry(namespace, key)
+
+    async def aset(self, namespace: str, key: str, value, ttl: float = None, now: float = None):
+        self.set(namespace, key, value, ttl, now)
+
+    async def aset_many(self, namespace: str, values: dict, ttl: float = None, now: float = None):
+        self.set_many(namespace, values, ttl, now)
+
+    async def astats(self) -> dict:
+        return self.stats()
+
+    async def aclose(self):
+        pass
+
+
+class TTLCache(BaseCache):
+    """
+    In-process cache bounded by entry count and approximate bytes.
+    Least recently used entries are evicted first; expired entries stay
+    readable through get_entry() until evicted so callers can fall back
+    to stale data when an upstream fails.
+    """
+
+    backend = "memory"
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, max_bytes: int = CACHE_MAX_BYTES):
+        super().__init__(max_entries, max_bytes)
+        self._entries: OrderedDict = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, namespace: str, key: str, stale_for: float = 0, now: float = None):
+        """
+        Return (entry, state) where state is "fresh", "stale" (expired less
+        than stale_for seconds ago) or "miss" (entry is None).
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            state = self._classify(namespace, entry, stale_for, now)
+            if state == "miss":
+                return None, "miss"
+            entry.hits += 1
+            self._entries.move_to_end((namespace, key))
+            return entry, state
+
+    def get_entry(self, namespace: str, key: str):
+        """Return the raw CacheEntry (fresh or expired) without touching counters"""
+        with self._lock:
+            return self._entries.get((namespace, key))
+
+    def set(self, namespace: str, key: str, value, ttl: float = None, now: float = None):
+        now = time.time() if now is None else now
+        ttl = self.ttl(namespace) if ttl is None else ttl
+        entry = CacheEntry(value, now, now + ttl, estimate_size(value))
+        with self._lock:
+            old = self._entries.pop((namespace, key), None)
+            if old is not None:
+                self._bytes -= old.size
+            self._entries[(namespace, key)] = entry
+            self._bytes += entry.size
+            self._evict()
+
+    def delete(self, namespace: str, key: str):
+        with self._lock:
+            old = self._entries.pop((namespace, key), None)
+            if old is not None:
+                self._bytes -= old.size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def items(self) -> list:
+        with self._lock:
+            return [(namespace, key, entry) for (namespace, key), entry in self._entries.items()]
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            (namespace, _), entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size
+            self._count(namespace, "evictions")
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "backend": self.backend,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "namespaces": self._namespace_stats(),
+            }
+
+
+def create_cache(backend: str = CACHE_BACKEND) -> BaseCache:
+    """Build the configured cache backend (memory, sqlite or redis)"""
+    if backend == "memory":
+        return TTLCache()
+
+    from services.shared_cache import SQLiteCache, RedisCache
+
+    if backend == "sqlite":
+        return SQLiteCache(CACHE_SQLITE_PATH)
+    if backend == "redis":
+        return RedisCache(CACHE_REDIS_URL)
+    raise ValueError(f"Unknown cache backend: {backend}")
+
+
+cache = create_cache()
@@ -0,0 +1,98 @@
+"""
+Persistent cache snapshots for warm restarts
+The cache is written to disk periodically and on shutdown, then loaded at
+startup so the first requests after a deploy do not all go upstream.
+
+File layout (little endian):
+    magic  b"GGCS"
+    u8     format version
+    f64    snapshot wall-clock time
+    u32    entry count
+    ...    zlib-compressed JSON array of [namespace, key, stored_at, expires_at, value]
+"""
+
+import asyncio
+import json
+import os
+import struct
+import tempfile
+import time
+import zlib
+
+SNAPSHOT_ENABLED = os.getenv("CACHE_SNAPSHOT_ENABLED", "true").lower() in ("1", "true", "yes")
+SNAPSHOT_PATH = os.getenv("CACHE_SNAPSHOT_PATH", os.path.join(tempfile.gettempdir(), "greenguard_cache.snapshot"))
+SNAPSHOT_INTERVAL = float(os.getenv("CACHE_SNAPSHOT_INTERVAL", "300"))  # seconds, 0 disables periodic saves
+# Expired entries are still restored within this window so stale-while-revalidate can serve them
+SNAPSHOT_MAX_STALE = float(os.getenv("CACHE_SNAPSHOT_MAX_STALE", "1800"))
+
+MAGIC = b"GGCS"
+VERSION = 1
+HEADER = struct.Struct("<4sBdI")
+
+
+def _snapshot_namespace(namespace: str) -> bool:
+    # Negative entries describe a past outage and should not survive a restart
+    return not namespace.endswith("_failed")
+
+
+def save_snapshot(cache, path: str = SNAPSHOT_PATH) -> int:
+    """Write all cache entries to path atomically; returns the entry count"""
+    rows = [
+        [namespace, key, entry.stored_at, entry.expires_at, entry.value]
+        for namespace, key, entry in cache.items()
+        if _snapshot_namespace(namespace)
+    ]
+    payload = zlib.compress(json.dumps(rows, separators=(",", ":")).encode("utf-8"), 6)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".snapshot-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, time.time(), len(rows)))
+            f.write(payload)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return len(rows)
+
+
+def load_snapshot(cache, path: str = SNAPSHOT_PATH, now: float = None) -> dict:
+    """
+    Restore entries from a snapshot. Entries keep their absolute expiry, so
+    their remaining TTL shrinks by the time since the snapshot was taken;
+    entries expired longer than SNAPSHOT_MAX_STALE are dropped.
+    """
+    now = time.time() if now is None else now
+    if not os.path.exists(path):
+        return {"restored": 0, "dropped": 0, "age_seconds": None}
+
+    with open(path, "rb") as f:
+        header = f.read(HEADER.size)
+        payload = f.read()
+
+    magic, version, taken_at, count = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Unsupported cache snapshot format in {path}")
+
+    rows = json.loads(zlib.decompress(payload))
+    restored = 0
+    # Rows are least recently used first, so re-inserting keeps the LRU order
+    for namespace, key, stored_at, expires_at, value in rows:
+        if now - expires_at >= SNAPSHOT_MAX_STALE:
+            continue
+        cache.set(namespace, key, value, ttl=expires_at - stored_at, now=stored_at)
+        restored += 1
+
+    return {"restored": restored, "dropped": count - restored, "age_seconds": round(now - taken_at, 1)}
+
+
+async def run_periodic_snapshots(cache, interval: float = SNAPSHOT_INTERVAL, path: str = SNAPSHOT_PATH):
+    """Background task saving a snapshot every interval seconds"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(save_snapshot, cache, path)
+        except Exception as e:
+            print(f"Cache snapshot failed: {e}")
@@ -0,0 +1,153 @@
+"""
+Per-upstream circuit breakers with latency-adaptive timeouts
+When a host keeps failing, calls are rejected immediately instead of each
+one waiting out the full timeout; after a cool-down a single probe is let
+through to decide whether to close the circuit again.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+import numpy as np
+
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "20"))  # recent calls considered
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "5"))
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+UPSTREAM_MIN_TIMEOUT = float(os.getenv("UPSTREAM_MIN_TIMEOUT", "1.0"))
+UPSTREAM_TIMEOUT_MULTIPLIER = float(os.getenv("UPSTREAM_TIMEOUT_MULTIPLIER", "3.0"))
+LATENCY_SAMPLES = 200
+MIN_LATENCY_SAMPLES = 20
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class UpstreamUnavailable(Exception):
+    """Upstream is known to be failing; callers should use fallback data"""
+
+
+class CircuitOpenError(UpstreamUnavailable):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, host: str):
+        self.host = host
+        self.state = CLOSED
+        self._outcomes = deque(maxlen=BREAKER_WINDOW)  # True = failure
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._probe_started = 0.0
+        self._rejected = 0
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Whether a call may go upstream now"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self._opened_at >= BREAKER_OPEN_SECONDS:
+                self.state = HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == HALF_OPEN:
+                # One probe at a time; a probe that never reported back is replaced
+                now = time.monotonic()
+                if not self._probe_in_flight or now - self._probe_started >= BREAKER_OPEN_SECONDS:
+                    self._probe_in_flight = True
+                    self._probe_started = now
+                    return True
+            self._rejected += 1
+            return False
+
+    def check(self):
+        if not self.allow():
+            raise CircuitOpenError(f"Circuit open for {self.host}")
+
+    def record_success(self, latency: float):
+        with self._lock:
+            self._latencies.append(latency)
+            if self.state == HALF_OPEN:
+                self.state = CLOSED
+                self._outcomes.clear()
+            self._outcomes.append(False)
+
+    def record_failure(self, timed_out: bool = False):
+        with self._lock:
+            if timed_out:
+                # The adaptive timeout was too short for the upstream's current latency:
+                # forget it so calls get the full timeout until new samples accumulate
+                self._latencies.clear()
+            if self.state == HALF_OPEN:
+                self._open()
+                return
+            self._outcomes.append(True)
+            if len(self._outcomes) >= BREAKER_MIN_CALLS and self._failure_rate() >= BREAKER_FAILURE_RATE:
+                self._open()
+
+    def _open(self):
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+        self._probe_in_flight = False
+        self._opened += 1
+
+    def _failure_rate(self) -> float:
+        return sum(self._outcomes) / len(self._outcomes) if self._outcomes else 0.0
+
+    def _percentile(self, q: float):
+        if not self._latencies:
+            return None
+        return float(np.percentile(self._latencies, q))
+
+    def timeout(self, default: float) -> float:
+        """
+        Timeout adapted to observed p99 latency, never above the configured
+        default. Half-open probes always get the default so a slow but
+        recovering upstream can close the circuit
+        """
+        with self._lock:
+            if self.state != CLOSED or len(self._latencies) < MIN_LATENCY_SAMPLES:
+                return default
+            adaptive = self._percentile(99) * UPSTREAM_TIMEOUT_MULTIPLIER
+        return min(default, max(UPSTREAM_MIN_TIMEOUT, adaptive))
+
+    def stats(self) -> dict:
+        with self._lock:
+            p50 = self._percentile(50)
+            p99 = self._percentile(99)
+            return {
+                "state": self.state,
+                "failure_rate": round(self._failure_rate(), 3),
+                "calls_in_window": len(self._outcomes),
+                "times_opened": self._opened,
+                "rejected": self._rejected,
+                "latency_p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+                "latency_p99_ms": round(p99 * 1000, 1) if p99 is not None else None,
+            }
+
+
+class BreakerRegistry:
+    def __init__(self):
+        self._breakers: dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def get(self, host: str) -> CircuitBreaker:
+        with self._lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(host)
+            return self._breakers[host]
+
+    def for_url(self, url: str) -> CircuitBreaker:
+        return self.get(urlsplit(url).netloc)
+
+    def stats(self) -> dict:
+        return {host: breaker.stats() for host, breaker in self._breakers.items()}
+
+
+breakers = BreakerRegistry()
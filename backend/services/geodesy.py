@@ -0,0 +1,107 @@
+"""
+Vectorized geodesy on a spherical Earth
+All functions take degrees and accept scalars or NumPy arrays (broadcast
+against each other), so distances, interpolation and route sampling for
+thousands of points are single array expressions instead of Python loops.
+"""
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def to_vectors(lat, lon) -> np.ndarray:
+    """Unit vectors (..., 3) for coordinates in degrees"""
+    lat, lon = np.radians(lat), np.radians(lon)
+    cos_lat = np.cos(lat)
+    return np.stack(np.broadcast_arrays(cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)), axis=-1)
+
+
+def from_vectors(vectors: np.ndarray):
+    """(lat, lon) in degrees for (..., 3) vectors, which need not be normalized"""
+    x, y, z = vectors[..., 0], vectors[..., 1], vectors[..., 2]
+    return np.degrees(np.arctan2(z, np.hypot(x, y))), np.degrees(np.arctan2(y, x))
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in km"""
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def bearing(lat1, lon1, lat2, lon2):
+    """Initial bearing from point 1 to point 2 in degrees clockwise from north, 0 - 360"""
+    lat1, lat2 = np.radians(lat1), np.radians(lat2)
+    dlon = np.radians(lon2) - np.radians(lon1)
+    x = np.sin(dlon) * np.cos(lat2)
+    y = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dlon)
+    return np.degrees(np.arctan2(x, y)) % 360
+
+
+def interpolate(lat1, lon1, lat2, lon2, fractions):
+    """Points at the given fractions (0 = start, 1 = end) of the great circle between two points"""
+    a, b = to_vectors(lat1, lon1), to_vectors(lat2, lon2)
+    angle = np.arccos(np.clip(np.dot(a, b), -1.0, 1.0))
+    t = np.asarray(fractions, dtype=np.float64)[..., None]
+    if angle < 1e-12:
+        vectors = a + t * (b - a)
+    else:
+        vectors = (np.sin((1 - t) * angle) * a + np.sin(t * angle) * b) / np.sin(angle)
+    return from_vectors(vectors)
+
+
+def great_circle_points(lat1, lon1, lat2, lon2, n: int):
+    """n evenly spaced points from start to end inclusive along the great circle"""
+    return interpolate(lat1, lon1, lat2, lon2, np.linspace(0.0, 1.0, n))
+
+
+def sample_route(lats, lons, spacing_km: float):
+    """
+    Points every spacing_km along a route given by its vertices, following
+    the great circle on each leg. Returns (lat, lon, distance from the start
+    in km) arrays; the first and last vertex are always included.
+    """
+    lats, lons = np.atleast_1d(np.asarray(lats, dtype=np.float64)), np.atleast_1d(np.asarray(lons, dtype=np.float64))
+    legs = haversine_km(lats[:-1], lons[:-1], lats[1:], lons[1:])
+    leg_start = np.concatenate([[0.0], np.cumsum(legs)])
+    total = leg_start[-1]
+
+    distances = np.arange(0.0, total, spacing_km) if spacing_km > 0 and total > 0 else np.zeros(1)
+    distances = np.append(distances, total) if total > 0 else distances
+    leg = np.clip(np.searchsorted(leg_start, distances, side="right") - 1, 0, max(len(legs) - 1, 0))
+    if len(legs) == 0:
+        return np.repeat(lats[:1], len(distances)), np.repeat(lons[:1], len(distances)), distances
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = np.where(legs[leg] > 0, (distances - leg_start[leg]) / legs[leg], 0.0)
+    a, b = to_vectors(lats[leg], lons[leg]), to_vectors(lats[leg + 1], lons[leg + 1])
+    angle = np.arccos(np.clip(np.einsum("ij,ij->i", a, b), -1.0, 1.0))[:, None]
+    t = t[:, None]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        slerp = (np.sin((1 - t) * angle) * a + np.sin(t * angle) * b) / np.sin(angle)
+    vectors = np.where(angle > 1e-12, slerp, a + t * (b - a))
+    lat, lon = from_vectors(vectors)
+    return lat, lon, distances
+
+
+def point_segment_distance_km(lat, lon, lat1, lon1, lat2, lon2):
+    """
+    Distance in km from points to the great-circle segment between
+    (lat1, lon1) and (lat2, lon2): the cross-track distance where the
+    closest point of the circle lies on the segment, else the distance to
+    the nearer end
+    """
+    p = to_vectors(lat, lon)
+    a, b = to_vectors(lat1, lon1), to_vectors(lat2, lon2)
+    normal = np.cross(a, b)
+    norm = np.linalg.norm(normal, axis=-1, keepdims=True)
+    to_ends = np.minimum(haversine_km(lat, lon, lat1, lon1), haversine_km(lat, lon, lat2, lon2))
+    if np.all(norm < 1e-12):
+        return to_ends
+    normal = normal / np.where(norm < 1e-12, 1.0, norm)
+
+    cross_track = np.abs(np.arcsin(np.clip(np.sum(p * normal, axis=-1), -1.0, 1.0))) * EARTH_RADIUS_KM
+    # The closest point lies between a and b when it is on the inner side of both ends
+    on_segment = (np.sum(np.cross(a, p) * normal, axis=-1) >= 0) & (np.sum(np.cross(p, b) * normal, axis=-1) >= 0)
+    return np.where(on_segment & (norm[..., 0] >= 1e-12), cross_track, to_ends)
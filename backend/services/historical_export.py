@@ -0,0 +1,92 @@
+"""
+Streaming encoders for historical rows
+Rows are written chunk by chunk straight from the NumPy columns, so a large
+date range is never held as one list of Python dicts.
+
+    ndjson  one JSON object per line
+    csv     header line, then one line per row (same columns as the source CSV)
+    arrow   Arrow IPC stream, one record batch per chunk (requires pyarrow)
+"""
+
+import csv
+import io
+import json
+import os
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+EXPORT_CHUNK_ROWS = int(os.getenv("HISTORICAL_EXPORT_CHUNK_ROWS", "5000"))
+
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+
+def check_format(fmt: str):
+    """Raise ImportError if the optional package a format needs is missing"""
+    if fmt == "arrow" and pa is None:
+        raise ImportError("format=arrow requires the 'pyarrow' package (pip install pyarrow)")
+
+
+def _chunks(rows: np.ndarray, chunk_rows: int):
+    for start in range(0, len(rows), chunk_rows):
+        yield np.asarray(rows[start:start + chunk_rows])
+
+
+def iter_ndjson(data, rows: np.ndarray, chunk_rows: int = EXPORT_CHUNK_ROWS):
+    for chunk in _chunks(rows, chunk_rows):
+        lines = [json.dumps(dict(zip(data.names, row))) for row in zip(*data.column_values(chunk))]
+        yield "\n".join(lines) + "\n"
+
+
+def iter_csv(data, rows: np.ndarray, chunk_rows: int = EXPORT_CHUNK_ROWS):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(data.names)
+    for chunk in _chunks(rows, chunk_rows):
+        writer.writerows(zip(*data.column_values(chunk)))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _arrow_batch(data, rows: np.ndarray):
+    arrays = []
+    for name in data.names:
+        column = np.asarray(data.columns[name][rows])
+        if name in data.categories:
+            arrays.append(pa.DictionaryArray.from_arrays(column, pa.array(data.categories[name], pa.string())))
+        else:
+            arrays.append(pa.array(column))
+    return pa.RecordBatch.from_arrays(arrays, names=data.names)
+
+
+def iter_arrow(data, rows: np.ndarray, chunk_rows: int = EXPORT_CHUNK_ROWS):
+    sink = io.BytesIO()
+    schema = _arrow_batch(data, np.asarray(rows[:0])).schema
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for chunk in _chunks(rows, chunk_rows):
+            writer.write_batch(_arrow_batch(data, chunk))
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+    # End-of-stream marker written on close
+    yield sink.getvalue()
+
+
+ENCODERS = {"ndjson": iter_ndjson, "csv": iter_csv, "arrow": iter_arrow}
+
+
+def stream_rows(data, rows: np.ndarray, fmt: str, chunk_rows: int = EXPORT_CHUNK_ROWS):
+    """Iterator of str / bytes chunks encoding rows of a HistoricalColumns snapshot"""
+    check_format(fmt)
+    return ENCODERS[fmt](data, rows, chunk_rows)
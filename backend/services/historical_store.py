@@ -0,0 +1,364 @@
+"""
+In-memory historical air quality store
+data/air_quality_data.csv is parsed once into typed NumPy columns sorted by
+station and date. A station is a run of rows with the same city and
+coordinates, so "last N days near (lat, lon)" is a station index lookup
+(services/station_index.py) plus one slice per station instead of a CSV parse
+per request.
+
+The parsed columns are saved as .npy files and memory-mapped on later
+starts (and by other workers), so large datasets are not parsed again
+until the CSV changes. The CSV is checked for changes at most every
+HISTORICAL_RELOAD_CHECK seconds and reloaded when its mtime or size differ.
+"""
+
+import base64
+import bisect
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from services.station_index import StationIndex
+
+HISTORICAL_DATA_PATH = os.getenv(
+    "HISTORICAL_DATA_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "air_quality_data.csv")
+)
+# Directory for the memory-mapped column files, empty to keep everything in memory
+HISTORICAL_COLUMN_CACHE = os.getenv("HISTORICAL_COLUMN_CACHE", os.path.join(tempfile.gettempdir(), "greenguard_historical"))
+HISTORICAL_RELOAD_CHECK = float(os.getenv("HISTORICAL_RELOAD_CHECK", "5"))  # seconds between file change checks
+
+COLUMN_CACHE_VERSION = 1
+
+
+class HistoricalColumns:
+    """
+    Immutable snapshot of the dataset. Rows are sorted by (station, date);
+    station i owns rows station_start[i]:station_start[i + 1].
+    """
+
+    def __init__(self, columns: dict, names: list, categories: dict, source: tuple):
+        self.columns = columns
+        self.names = names  # column order of the CSV
+        self.categories = categories  # column -> labels for dictionary-encoded text columns
+        self.source = source  # (mtime_ns, size) of the CSV these columns came from
+        self.rows = len(columns["date"])
+        self.dates = columns["date"]
+        self.station_start = columns["_station_start"]
+        self.station_lat = columns["_station_lat"]
+        self.station_lon = columns["_station_lon"]
+        # Row numbers in date order, for queries across all stations
+        self.by_date = columns["_by_date"]
+        self.dates_sorted = columns["_dates_sorted"]
+        self.index = StationIndex(self.station_lat, self.station_lon)
+
+    @property
+    def stations(self) -> int:
+        return len(self.station_lat)
+
+    def stations_in_box(self, lat: float, lon: float, radius: float) -> np.ndarray:
+        return self.index.in_box(lat, lon, radius)
+
+    def station_rows(self, station: int, days: int = None, limit: int = None) -> np.ndarray:
+        """Row numbers of one station in date order, optionally only its last days / last limit rows"""
+        start, end = int(self.station_start[station]), int(self.station_start[station + 1])
+        if days is not None:
+            cutoff = self.dates[end - 1] - np.timedelta64(days - 1, "D")
+            start += int(np.searchsorted(self.dates[start:end], cutoff, side="left"))
+        if limit is not None:
+            start = max(start, end - limit)
+        return np.arange(start, end)
+
+    def rows_near(self, lat: float, lon: float, radius: float, days: int = None, limit: int = None):
+        """
+        Row numbers in date order for stations within radius degrees of
+        (lat, lon); None when no station is that close
+        """
+        stations = self.stations_in_box(lat, lon, radius)
+        if len(stations) == 0:
+            return None
+        if days is not None:
+            # Last N days of the newest data among these stations
+            latest = max(self.dates[int(self.station_start[s + 1]) - 1] for s in stations)
+            cutoff = latest - np.timedelta64(days - 1, "D")
+        parts = []
+        for station in stations:
+            rows = self.station_rows(station, limit=limit)
+            if days is not None:
+                rows = rows[self.dates[rows] >= cutoff]
+            parts.append(rows)
+        rows = np.concatenate(parts)
+        if len(parts) > 1:
+            rows = rows[np.argsort(self.dates[rows], kind="stable")]
+        return rows if limit is None else rows[-limit:]
+
+    def rows_all(self, days: int = None, limit: int = None) -> np.ndarray:
+        """Row numbers in date order across all stations"""
+        start = 0
+        if days is not None and self.rows:
+            cutoff = self.dates_sorted[-1] - np.timedelta64(days - 1, "D")
+            start = int(np.searchsorted(self.dates_sorted, cutoff, side="left"))
+        if limit is not None:
+            start = max(start, self.rows - limit)
+        return np.asarray(self.by_date[start:])
+
+    def nearest_station(self, lat: float, lon: float) -> int:
+        """Closest station by great-circle distance"""
+        return int(self.index.nearest(lat, lon)[0][0])
+
+    def station_info(self, station: int) -> dict:
+        """City (if the data has one) and coordinates of a station"""
+        info = {}
+        if "city" in self.categories:
+            info["city"] = self.categories["city"][int(self.columns["city"][int(self.station_start[station])])]
+        info["lat"] = float(self.station_lat[station])
+        info["lon"] = float(self.station_lon[station])
+        return info
+
+    def latest(self, station: int, column: str):
+        """Most recent value of column for a station"""
+        return self.columns[column][int(self.station_start[station + 1]) - 1].item()
+
+    def rows_between(self, lat: float, lon: float, radius: float, start=None, end=None) -> np.ndarray:
+        """
+        Row numbers in date order with start <= date <= end (datetime64[D] or
+        None for open ends) for stations near (lat, lon), or for all stations
+        if none is that close. Rows of the same day are ordered by station.
+        """
+        start = np.datetime64(start, "D") if start is not None else None
+        end = np.datetime64(end, "D") if end is not None else None
+        stations = self.stations_in_box(lat, lon, radius)
+        if len(stations) == 0:
+            low = int(np.searchsorted(self.dates_sorted, start, side="left")) if start is not None else 0
+            high = int(np.searchsorted(self.dates_sorted, end, side="right")) if end is not None else self.rows
+            return self.by_date[low:high]
+
+        parts = []
+        for station in stations:
+            first, last = int(self.station_start[station]), int(self.station_start[station + 1])
+            dates = self.dates[first:last]
+            low = first + int(np.searchsorted(dates, start, side="left")) if start is not None else first
+            high = first + int(np.searchsorted(dates, end, side="right")) if end is not None else last
+            parts.append(np.arange(low, high))
+        rows = np.concatenate(parts)
+        if len(parts) > 1:
+            rows = rows[np.argsort(self.dates[rows], kind="stable")]
+        return rows
+
+    def page(self, rows: np.ndarray, cursor: str = None, limit: int = None):
+        """
+        Slice of date-ordered rows after cursor, at most limit long.
+        Returns (rows, next cursor or None). A cursor is the last date
+        returned plus the number of rows of that date already returned, so
+        it stays valid when data for other days is added.
+        """
+        offset = 0
+        if cursor:
+            day, seen = decode_cursor(cursor)
+            offset = min(self._first_of_day(rows, day) + seen, len(rows))
+        end = len(rows) if limit is None else min(len(rows), offset + limit)
+        selected = rows[offset:end]
+        if end >= len(rows) or len(selected) == 0:
+            return selected, None
+
+        last_day = self.dates[rows[end - 1]]
+        return selected, encode_cursor(last_day, end - self._first_of_day(rows, last_day))
+
+    def _first_of_day(self, rows: np.ndarray, day: np.datetime64) -> int:
+        """Position of the first row dated day or later in date-ordered rows, without gathering all dates"""
+        return bisect.bisect_left(range(len(rows)), day, key=lambda i: self.dates[rows[i]])
+
+    def column_values(self, rows: np.ndarray) -> list:
+        """One Python list per column (CSV order) for rows, dates as YYYY-MM-DD strings"""
+        values = []
+        for name in self.names:
+            column = self.columns[name][rows]
+            if name == "date":
+                values.append(np.datetime_as_string(column, unit="D").tolist())
+            elif name in self.categories:
+                labels = self.categories[name]
+                values.append([labels[code] for code in column.tolist()])
+            else:
+                values.append(column.tolist())
+        return values
+
+    def records(self, rows: np.ndarray) -> list:
+        """Rows as dicts in CSV column order, dates as YYYY-MM-DD strings"""
+        return [dict(zip(self.names, row)) for row in zip(*self.column_values(rows))]
+
+
+def encode_cursor(day: np.datetime64, seen: int) -> str:
+    return base64.urlsafe_b64encode(f"{day}|{seen}".encode("ascii")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    """(datetime64[D], rows of that day already returned); ValueError if malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("ascii")
+        day, seen = raw.split("|")
+        return np.datetime64(day, "D"), int(seen)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def _parse_csv(path: str, source: tuple) -> HistoricalColumns:
+    df = pd.read_csv(path)
+    names = list(df.columns)
+    dates = pd.to_datetime(df["date"]).to_numpy().astype("datetime64[D]")
+
+    columns, categories = {"date": dates}, {}
+    for name in names:
+        if name == "date":
+            continue
+        series = df[name]
+        if pd.api.types.is_numeric_dtype(series):
+            columns[name] = series.to_numpy()
+        else:
+            codes, labels = pd.factorize(series.astype(str), sort=True)
+            columns[name] = codes.astype(np.int32)
+            categories[name] = labels.tolist()
+
+    station_keys = [columns[name] for name in ("city", "lat", "lon") if name in columns]
+    order = np.lexsort([dates] + station_keys[::-1])
+    columns = {name: column[order] for name, column in columns.items()}
+
+    boundary = np.zeros(len(order), dtype=bool)
+    if len(order):
+        boundary[0] = True
+        for name in ("city", "lat", "lon"):
+            if name in columns:
+                boundary[1:] |= columns[name][1:] != columns[name][:-1]
+    starts = np.flatnonzero(boundary)
+    columns["_station_start"] = np.append(starts, len(order)).astype(np.int64)
+    columns["_station_lat"] = columns["lat"][starts].astype(np.float64)
+    columns["_station_lon"] = columns["lon"][starts].astype(np.float64)
+    # Same-day rows keep their order in the file
+    columns["_by_date"] = np.lexsort((order, columns["date"])).astype(np.int64)
+    columns["_dates_sorted"] = columns["date"][columns["_by_date"]]
+    return HistoricalColumns(columns, names, categories, source)
+
+
+def _cache_dir(path: str) -> str:
+    key = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(HISTORICAL_COLUMN_CACHE, key)
+
+
+def _load_column_cache(path: str, source: tuple):
+    directory = _cache_dir(path)
+    try:
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get("version") != COLUMN_CACHE_VERSION or tuple(meta.get("source", ())) != source:
+        return None
+    try:
+        columns = {
+            name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+            for name in meta["columns"]
+        }
+    except (OSError, ValueError):
+        return None
+    return HistoricalColumns(columns, meta["names"], meta["categories"], source)
+
+
+def _save_column_cache(path: str, data: HistoricalColumns):
+    """Write one .npy per column, then meta.json, which marks the set as complete"""
+    directory = _cache_dir(path)
+    os.makedirs(directory, exist_ok=True)
+    for name, column in data.columns.items():
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{name}-", suffix=".npy")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, column)
+            os.replace(tmp_path, os.path.join(directory, f"{name}.npy"))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    meta = {
+        "version": COLUMN_CACHE_VERSION,
+        "source": list(data.source),
+        "names": data.names,
+        "categories": data.categories,
+        "columns": list(data.columns),
+    }
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".meta-")
+    with os.fdopen(fd, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(directory, "meta.json"))
+
+
+class HistoricalStore:
+    """
+    Current HistoricalColumns for a CSV file, reloaded when the file changes.
+    Queries work on the snapshot returned by get(), so a reload never
+    changes the data under a running query.
+    """
+
+    def __init__(self, path: str = HISTORICAL_DATA_PATH, reload_check: float = HISTORICAL_RELOAD_CHECK,
+                 column_cache: bool = bool(HISTORICAL_COLUMN_CACHE)):
+        self.path = path
+        self.reload_check = reload_check
+        self.column_cache = column_cache
+        self._data = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.cache_loads = 0
+        self.last_load_seconds = None
+
+    def _source(self) -> tuple:
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def get(self) -> HistoricalColumns:
+        """Current snapshot; raises FileNotFoundError if the data file is missing"""
+        data = self._data
+        now = time.monotonic()
+        if data is not None and now - self._checked_at < self.reload_check:
+            return data
+
+        with self._lock:
+            if self._data is not None and now - self._checked_at < self.reload_check:
+                return self._data
+            source = self._source()
+            if self._data is None or self._data.source != source:
+                self._data = self._load(source)
+            self._checked_at = time.monotonic()
+            return self._data
+
+    def _load(self, source: tuple) -> HistoricalColumns:
+        started = time.perf_counter()
+        data = _load_column_cache(self.path, source) if self.column_cache else None
+        if data is not None:
+            self.cache_loads += 1
+        else:
+            data = _parse_csv(self.path, source)
+            if self.column_cache:
+                try:
+                    _save_column_cache(self.path, data)
+                except OSError as e:
+                    print(f"Could not write historical column cache: {e}")
+        self.loads += 1
+        self.last_load_seconds = round(time.perf_counter() - started, 4)
+        return data
+
+    def stats(self) -> dict:
+        data = self._data
+        return {
+            "path": self.path,
+            "rows": data.rows if data is not None else 0,
+            "stations": data.stations if data is not None else 0,
+            "loads": self.loads,
+            "column_cache_loads": self.cache_loads,
+            "last_load_seconds": self.last_load_seconds,
+        }
+
+
+historical_store = HistoricalStore()
@@ -0,0 +1,115 @@
+"""
+Async HTTP client for upstream APIs (Open-Meteo, OpenWeather)
+Keeps a pooled keep-alive client and limits concurrent requests per host
+"""
+
+import asyncio
+import os
+import time
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+
+from services.circuit_breaker import breakers
+
+# Pool sizing (overridable through the environment)
+MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "20"))
+KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+PER_HOST_CONCURRENCY = int(os.getenv("UPSTREAM_PER_HOST_CONCURRENCY", "10"))
+
+
+def is_upstream_failure(status_code: int) -> bool:
+    """Server errors and rate limiting count against the breaker; other 4xx do not"""
+    return status_code >= 500 or status_code == 429
+
+
+def _decode_json(response, breaker, start: float):
+    """
+    Record the outcome on the breaker, raise on HTTP errors and return the
+    JSON body; a success response whose body does not decode is a failure
+    """
+    if is_upstream_failure(response.status_code):
+        breaker.record_failure()
+        response.raise_for_status()
+    if not 200 <= response.status_code < 300:
+        breaker.record_success(time.monotonic() - start)
+        response.raise_for_status()
+        return response.json()
+    try:
+        data = response.json()
+    except ValueError:
+        breaker.record_failure()
+        raise
+    breaker.record_success(time.monotonic() - start)
+    return data
+
+
+class AsyncHTTPClient:
+    """Shared httpx.AsyncClient with a semaphore per upstream host"""
+
+    def __init__(self, per_host_limit: int = PER_HOST_CONCURRENCY):
+        self.per_host_limit = per_host_limit
+        self._client = None
+        self._semaphores: dict[str, asyncio.Semaphore] = {}
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=MAX_CONNECTIONS,
+                    max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=KEEPALIVE_EXPIRY,
+                ),
+            )
+        return self._client
+
+    def _get_semaphore(self, host: str) -> asyncio.Semaphore:
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.per_host_limit)
+        return self._semaphores[host]
+
+    async def get_json(self, url: str, params: dict = None, timeout: float = 10):
+        """
+        GET a URL and return the decoded JSON body, raising on HTTP errors
+        and ValueError on a body that is not JSON (counted as a failure).
+        Raises CircuitOpenError without a network call while the host's
+        breaker is open; the timeout shrinks to the host's observed latency.
+        """
+        host = urlsplit(url).netloc
+        breaker = breakers.get(host)
+        breaker.check()
+
+        async with self._get_semaphore(host):
+            start = time.monotonic()
+            try:
+                response = await self._get_client().get(url, params=params, timeout=breaker.timeout(timeout))
+            except httpx.TransportError as e:
+                breaker.record_failure(timed_out=isinstance(e, httpx.TimeoutException))
+                raise
+
+            return _decode_json(response, breaker, start)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+def get_json_blocking(url: str, params: dict = None, timeout: float = 10):
+    """Blocking counterpart of AsyncHTTPClient.get_json sharing the same breakers"""
+    breaker = breakers.for_url(url)
+    breaker.check()
+
+    start = time.monotonic()
+    try:
+        response = requests.get(url, params=params, timeout=breaker.timeout(timeout))
+    except (requests.ConnectionError, requests.Timeout) as e:
+        breaker.record_failure(timed_out=isinstance(e, requests.Timeout))
+        raise
+
+    return _decode_json(response, breaker, start)
+
+
+client = AsyncHTTPClient()
@@ -0,0 +1,149 @@
+"""
+Stale-while-revalidate for the upstream services
+Expired entries inside the staleness window are served immediately while a
+background task refreshes them; hot entries are refreshed shortly before
+they expire so requests for them never wait on the upstream.
+"""
+
+import asyncio
+import os
+import time
+
+from services.cache import cache
+from services.circuit_breaker import UpstreamUnavailable
+from services.singleflight import inflight
+
+# Fraction of the TTL before expiry at which hot entries are refreshed
+CACHE_REFRESH_AHEAD = float(os.getenv("CACHE_REFRESH_AHEAD", "0.1"))
+# Hits an entry needs before it counts as hot
+CACHE_HOT_HITS = int(os.getenv("CACHE_HOT_HITS", "3"))
+# How long a failed fetch short-circuits further upstream calls for that key
+CACHE_NEGATIVE_TTL = float(os.getenv("CACHE_NEGATIVE_TTL", "30"))
+
+
+class Revalidator:
+    def __init__(self, refresh_ahead: float = CACHE_REFRESH_AHEAD, hot_hits: int = CACHE_HOT_HITS):
+        self.refresh_ahead = refresh_ahead
+        self.hot_hits = hot_hits
+        self._tasks: dict[tuple, asyncio.Task] = {}
+        self._stats: dict[str, dict[str, int]] = {}
+
+    def _counters(self, namespace: str) -> dict:
+        return self._stats.setdefault(
+            namespace, {"stale_served": 0, "refresh_ahead": 0, "background_refreshes": 0,
+                        "refresh_failures": 0, "negative_hits": 0}
+        )
+
+    async def get(self, namespace: str, key: str, fetch, stale_for: float = 0):
+        """
+        Return (value, hit). Misses await fetch() through single-flight;
+        stale hits return at once and schedule a background refresh.
+        """
+        entry, state = await cache.alookup(namespace, key, stale_for=stale_for)
+
+        if state == "miss":
+            if await self.recently_failed(namespace, key):
+                self._counters(namespace)["negative_hits"] += 1
+                raise UpstreamUnavailable(f"Upstream fetch for {namespace}/{key} failed recently")
+            try:
+                return await inflight.do(namespace, key, fetch), False
+            except Exception:
+                await self.mark_failed(namespace, key)
+                raise
+
+        if state == "stale":
+            self._counters(namespace)["stale_served"] += 1
+            await self._refresh(namespace, key, fetch)
+        elif entry.hits >= self.hot_hits:
+            ttl = entry.expires_at - entry.stored_at
+            if entry.expires_at - time.time() < ttl * self.refresh_ahead:
+                if await self._refresh(namespace, key, fetch):
+                    self._counters(namespace)["refresh_ahead"] += 1
+
+        return entry.value, True
+
+    async def mark_failed(self, namespace: str, key: str):
+        """Remember a failed fetch so the key is not retried upstream for a while"""
+        await cache.aset(f"{namespace}_failed", key, True, ttl=CACHE_NEGATIVE_TTL)
+
+    async def recently_failed(self, namespace: str, key: str) -> bool:
+        # get_entry does not count towards the *_failed namespace's hit/miss counters
+        entry = await cache.aget_entry(f"{namespace}_failed", key)
+        return entry is not None and entry.is_fresh(time.time())
+
+    def _busy(self, namespace: str, key: str) -> bool:
+        return (namespace, key) in self._tasks or inflight.is_in_flight(namespace, key)
+
+    async def _can_refresh(self, namespace: str, key: str) -> bool:
+        if self._busy(namespace, key) or await self.recently_failed(namespace, key):
+            return False
+        # Another refresh may have started while the negative entry was read
+        return not self._busy(namespace, key)
+
+    async def _refresh(self, namespace: str, key: str, fetch) -> bool:
+        """Schedule a background refresh unless one is running or the key just failed"""
+        if not await self._can_refresh(namespace, key):
+            return False
+        task = asyncio.ensure_future(self._run_refresh(namespace, key, fetch))
+        self._tasks[(namespace, key)] = task
+        task.add_done_callback(lambda _: self._tasks.pop((namespace, key), None))
+        return True
+
+    async def refresh_many(self, namespace: str, keys: list, fetch_many) -> bool:
+        """
+        Schedule one background refresh covering several stale keys.
+        fetch_many(keys) returns a mapping of the keys it fetched; keys
+        missing from it (e.g. a failed chunk of a bulk call) are marked failed
+        """
+        self._counters(namespace)["stale_served"] += len(keys)
+        keys = [key for key in keys if await self._can_refresh(namespace, key)]
+        # Refreshes may have started for earlier keys while later ones were checked
+        keys = [key for key in keys if not self._busy(namespace, key)]
+        if not keys:
+            return False
+
+        async def run():
+            counters = self._counters(namespace)
+            counters["background_refreshes"] += 1
+            try:
+                fetched = await fetch_many(keys)
+            except Exception as e:
+                fetched = {}
+                print(f"Background batch refresh failed for {namespace}: {e}")
+            failed = [key for key in keys if key not in fetched]
+            if failed:
+                counters["refresh_failures"] += 1
+                for key in failed:
+                    await self.mark_failed(namespace, key)
+
+        task = asyncio.ensure_future(run())
+        for key in keys:
+            self._tasks[(namespace, key)] = task
+
+        def done(_):
+            for key in keys:
+                self._tasks.pop((namespace, key), None)
+
+        task.add_done_callback(done)
+        return True
+
+    async def _run_refresh(self, namespace: str, key: str, fetch):
+        counters = self._counters(namespace)
+        counters["background_refreshes"] += 1
+        try:
+            await inflight.do(namespace, key, fetch)
+        except Exception as e:
+            counters["refresh_failures"] += 1
+            await self.mark_failed(namespace, key)
+            print(f"Background refresh failed for {namespace}/{key}: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(set(self._tasks.values())),
+            "refresh_ahead_fraction": self.refresh_ahead,
+            "hot_hits": self.hot_hits,
+            "namespaces": {namespace: dict(counters) for namespace, counters in self._stats.items()},
+        }
+
+
+revalidator = Revalidator()
@@ -0,0 +1,242 @@
+"""
+Precomputed rollups of the historical data
+Per station and day / week (starting Monday) / month: count, mean, min,
+max and percentiles of AQI and every pollutant / weather column. Rows in
+the historical store are sorted by station and date, so each (station,
+period) group is a contiguous run and is reduced with reduceat.
+
+When the CSV is reloaded and only new rows were appended, only the
+periods that received rows are recomputed; any other change rebuilds the
+tables.
+"""
+
+import threading
+import time
+
+import numpy as np
+
+from services.historical_store import historical_store
+
+PERIODS = ("day", "week", "month")
+PERCENTILES = (50, 90, 95)
+# Source columns that describe the station rather than a measurement
+NON_METRIC_COLUMNS = {"date", "city", "lat", "lon"}
+
+
+def period_starts(dates: np.ndarray, period: str) -> np.ndarray:
+    """First day of the period each date falls in"""
+    dates = np.asarray(dates, dtype="datetime64[D]")
+    if period == "day":
+        return dates
+    if period == "week":
+        days = dates.astype(np.int64)
+        # 1970-01-01 was a Thursday
+        return (days - (days + 3) % 7).astype("datetime64[D]")
+    if period == "month":
+        return dates.astype("datetime64[M]").astype("datetime64[D]")
+    raise ValueError(f"Unknown period: {period}")
+
+
+class RollupTable:
+    """
+    Rollup rows sorted by (station, period start); station i owns rows
+    station_start[i]:station_start[i + 1]. stats[metric][name] are arrays
+    aligned with the rows.
+    """
+
+    def __init__(self, period: str, station: np.ndarray, start: np.ndarray, count: np.ndarray,
+                 stats: dict, stations: int):
+        self.period = period
+        self.station = station
+        self.start = start
+        self.count = count
+        self.stats = stats
+        self.station_start = np.searchsorted(station, np.arange(stations + 1), side="left")
+
+    def __len__(self):
+        return len(self.station)
+
+    def rows(self, station: int, start=None, end=None) -> np.ndarray:
+        """Rows of one station whose period starts within [start, end]"""
+        first, last = int(self.station_start[station]), int(self.station_start[station + 1])
+        starts = self.start[first:last]
+        low = first + int(np.searchsorted(starts, np.datetime64(start, "D"), side="left")) if start is not None else first
+        high = first + int(np.searchsorted(starts, np.datetime64(end, "D"), side="right")) if end is not None else last
+        return np.arange(low, high)
+
+    def records(self, rows: np.ndarray, metrics: list) -> list:
+        """Rows as {"period_start", "count", <metric>: {"mean", "min", ...}}, NaN as None"""
+        columns = {
+            metric: {name: np.round(values[rows], 2).tolist() for name, values in self.stats[metric].items()}
+            for metric in metrics
+        }
+        starts = np.datetime_as_string(self.start[rows], unit="D").tolist()
+        counts = self.count[rows].tolist()
+        records = []
+        for i, period_start in enumerate(starts):
+            record = {"period_start": period_start, "count": counts[i]}
+            for metric, stats in columns.items():
+                record[metric] = {name: (None if values[i] != values[i] else values[i]) for name, values in stats.items()}
+            records.append(record)
+        return records
+
+
+def _empty(period: str, metrics: list, stations: int) -> RollupTable:
+    names = ["mean", "min", "max"] + [f"p{q}" for q in PERCENTILES]
+    stats = {metric: {name: np.zeros(0) for name in names} for metric in metrics}
+    return RollupTable(period, np.zeros(0, dtype=np.int64), np.zeros(0, dtype="datetime64[D]"),
+                       np.zeros(0, dtype=np.int64), stats, stations)
+
+
+def _reduce(data, rows: np.ndarray, period: str, metrics: list) -> RollupTable:
+    """Rollups of date-ordered per-station runs of rows (every station's rows contiguous)"""
+    if len(rows) == 0:
+        return _empty(period, metrics, data.stations)
+    station = np.searchsorted(data.station_start, rows, side="right") - 1
+    starts = period_starts(data.dates[rows], period)
+    boundary = np.ones(len(rows), dtype=bool)
+    boundary[1:] = (station[1:] != station[:-1]) | (starts[1:] != starts[:-1])
+    group_start = np.flatnonzero(boundary)
+    group_size = np.diff(np.append(group_start, len(rows)))
+    group_id = np.repeat(np.arange(len(group_start)), group_size)
+
+    stats = {}
+    for metric in metrics:
+        values = np.asarray(data.columns[metric][rows], dtype=np.float64)
+        valid = ~np.isnan(values)
+        count = np.add.reduceat(valid.astype(np.int64), group_start)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            metric_stats = {
+                "mean": np.add.reduceat(np.where(valid, values, 0.0), group_start) / count,
+                "min": np.minimum.reduceat(np.where(valid, values, np.inf), group_start),
+                "max": np.maximum.reduceat(np.where(valid, values, -np.inf), group_start),
+            }
+        # Sorted within groups (NaN last), then linear interpolation between ranks like np.percentile
+        ordered = values[np.lexsort((values, group_id))]
+        last = (count - 1).clip(min=0)
+        for q in PERCENTILES:
+            rank = last * (q / 100)
+            low = np.floor(rank).astype(np.int64)
+            lower, upper = ordered[group_start + low], ordered[group_start + np.minimum(low + 1, last)]
+            metric_stats[f"p{q}"] = lower + (upper - lower) * (rank - low)
+        for values in metric_stats.values():
+            values[count == 0] = np.nan
+        stats[metric] = metric_stats
+
+    return RollupTable(period, station[group_start], starts[group_start], group_size, stats, data.stations)
+
+
+def _concat(tables: list, period: str, stations: int) -> RollupTable:
+    station = np.concatenate([t.station for t in tables])
+    start = np.concatenate([t.start for t in tables])
+    order = np.lexsort((start, station))
+    metrics = tables[0].stats
+    stats = {
+        metric: {name: np.concatenate([t.stats[metric][name] for t in tables])[order] for name in metrics[metric]}
+        for metric in metrics
+    }
+    count = np.concatenate([t.count for t in tables])[order]
+    return RollupTable(period, station[order], start[order], count, stats, stations)
+
+
+def _take(table: RollupTable, keep: np.ndarray, stations: int) -> RollupTable:
+    stats = {metric: {name: values[keep] for name, values in table.stats[metric].items()} for metric in table.stats}
+    return RollupTable(table.period, table.station[keep], table.start[keep], table.count[keep], stats, stations)
+
+
+class RollupStore:
+    """Rollup tables for the current historical snapshot, updated when it changes"""
+
+    def __init__(self, store=historical_store):
+        self.store = store
+        # (historical snapshot, {period: RollupTable}) swapped as one value
+        self._current = (None, {})
+        self._lock = threading.Lock()
+        self.full_builds = 0
+        self.incremental_updates = 0
+        self.rows_reduced = 0
+        self.last_update_seconds = None
+
+    def get(self, period: str):
+        """(historical snapshot, rollup table) for a period"""
+        if period not in PERIODS:
+            raise ValueError(f"Unknown period: {period}")
+        data = self.store.get()
+        if data is not self._current[0]:
+            with self._lock:
+                if data is not self._current[0]:
+                    self._update(data)
+        current, tables = self._current
+        return current, tables[period]
+
+    @staticmethod
+    def metrics(data) -> list:
+        return [name for name in data.names if name not in NON_METRIC_COLUMNS and name not in data.categories]
+
+    def _update(self, data):
+        started = time.perf_counter()
+        previous, tables = self._current
+        appended = self._appended_rows(previous, data) if previous is not None else None
+        metrics = self.metrics(data)
+        if appended is None:
+            rows = np.arange(data.rows)
+            tables = {period: _reduce(data, rows, period, metrics) for period in PERIODS}
+            self.full_builds += 1
+            self.rows_reduced += data.rows
+        else:
+            tables = {period: self._extend(tables[period], data, appended, metrics) for period in PERIODS}
+            self.incremental_updates += 1
+        self._current = (data, tables)
+        self.last_update_seconds = round(time.perf_counter() - started, 4)
+
+    def _extend(self, table: RollupTable, data, appended: np.ndarray, metrics: list) -> RollupTable:
+        """Recompute the periods from each station's first appended row on, keep the others"""
+        has_new = appended < data.station_start[1:]
+        # First affected period of each station (stations without new rows keep everything)
+        first_period = np.full(data.stations, np.datetime64("9999-12-31"), dtype="datetime64[D]")
+        stations = np.flatnonzero(has_new)
+        first_period[stations] = period_starts(data.dates[appended[stations]], table.period)
+
+        keep = table.start < first_period[table.station]
+        parts = []
+        for station in stations:
+            first, last = int(data.station_start[station]), int(data.station_start[station + 1])
+            offset = int(np.searchsorted(data.dates[first:last], first_period[station], side="left"))
+            parts.append(np.arange(first + offset, last))
+        rows = np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+        self.rows_reduced += len(rows)
+        return _concat([_take(table, keep, data.stations), _reduce(data, rows, table.period, metrics)],
+                       table.period, data.stations)
+
+    @staticmethod
+    def _appended_rows(old, new):
+        """
+        Per station, the row (in new) of its first appended row if new only
+        appends rows to the stations of old; None if anything else changed
+        """
+        if old.names != new.names or old.categories != new.categories or old.stations != new.stations:
+            return None
+        if not (np.array_equal(old.station_lat, new.station_lat) and np.array_equal(old.station_lon, new.station_lon)):
+            return None
+        old_sizes = np.diff(old.station_start)
+        if np.any(np.diff(new.station_start) < old_sizes):
+            return None
+        # Rows of old in new: the first old_sizes rows of every station
+        kept = np.repeat(new.station_start[:-1] - old.station_start[:-1], old_sizes) + np.arange(old.rows)
+        for name in old.names:
+            old_values, new_values = np.asarray(old.columns[name]), np.asarray(new.columns[name][kept])
+            if not np.array_equal(old_values, new_values, equal_nan=np.issubdtype(old_values.dtype, np.floating)):
+                return None
+        return new.station_start[:-1] + old_sizes
+
+    def stats(self) -> dict:
+        return {
+            "periods": {period: len(table) for period, table in self._current[1].items()},
+            "full_builds": self.full_builds,
+            "incremental_updates": self.incremental_updates,
+            "rows_reduced": self.rows_reduced,
+            "last_update_seconds": self.last_update_seconds,
+        }
+
+
+rollups = RollupStore()
@@ -0,0 +1,392 @@
+"""
+Cache backends shared across uvicorn worker processes
+SQLiteCache keeps entries in a local WAL-mode database file that every
+worker on the host opens; RedisCache keeps them in Redis for multi-host
+deployments. Both implement the same interface as the in-process TTLCache.
+Values must be JSON-serializable.
+
+The awaitable methods used by request handlers never block the event loop:
+SQLite calls run on a small dedicated thread pool, Redis calls go through
+the redis.asyncio client.
+"""
+
+import asyncio
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from services.cache import BaseCache, CacheEntry, CACHE_MAX_ENTRIES, CACHE_MAX_BYTES
+
+# Evict at most every N writes; an eviction pass is a small indexed query
+EVICT_EVERY = int(os.getenv("CACHE_SHARED_EVICT_EVERY", "100"))
+# Threads running SQLite calls for the event loop; each keeps its own connection
+SQLITE_THREADS = int(os.getenv("CACHE_SQLITE_THREADS", "4"))
+# Hit counts and access times are written in one batch at most this often (seconds)
+TOUCH_INTERVAL = float(os.getenv("CACHE_SHARED_TOUCH_SECONDS", "1"))
+# Redis keys outlive their TTL by this much so stale fallbacks keep working
+REDIS_RETAIN_SECONDS = int(os.getenv("CACHE_REDIS_RETAIN", "3600"))
+
+
+class SQLiteCache(BaseCache):
+    backend = "sqlite"
+
+    def __init__(self, path: str, max_entries: int = CACHE_MAX_ENTRIES, max_bytes: int = CACHE_MAX_BYTES):
+        super().__init__(max_entries, max_bytes)
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        self._executor = ThreadPoolExecutor(max_workers=SQLITE_THREADS, thread_name_prefix="cache-sqlite")
+        # (namespace, key) -> [last access, hits] not yet written; a hit must not
+        # take the WAL writer lock, so these are flushed together
+        self._touches: dict[tuple, list] = {}
+        self._touch_lock = threading.Lock()
+        self._touched_at = time.monotonic()
+
+        conn = self._conn()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                stored_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                size INTEGER NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            ) WITHOUT ROWID
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_accessed ON cache_entries (accessed_at)")
+
+    def _conn(self) -> sqlite3.Connection:
+        # One connection per thread; the blocking service variants may run in a threadpool
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _row_entry(self, row) -> CacheEntry:
+        value, stored_at, expires_at, size, hits = row
+        entry = CacheEntry(json.loads(value), stored_at, expires_at, size)
+        entry.hits = hits
+        return entry
+
+    def lookup(self, namespace: str, key: str, stale_for: float = 0, now: float = None):
+        now = time.time() if now is None else now
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT value, stored_at, expires_at, size, hits FROM cache_entries WHERE namespace = ? AND key = ?",
+            (namespace, key)
+        ).fetchone()
+        entry = self._row_entry(row) if row is not None else None
+
+        state = self._classify(namespace, entry, stale_for, now)
+        if state == "miss":
+            return None, "miss"
+
+        with self._touch_lock:
+            touch = self._touches.setdefault((namespace, key), [now, 0])
+            touch[0] = max(touch[0], now)
+            touch[1] += 1
+            entry.hits += touch[1]
+            flush = time.monotonic() - self._touched_at >= TOUCH_INTERVAL
+        if flush:
+            self._flush_touches()
+        return entry, state
+
+    def _flush_touches(self):
+        """Write the batched hit counts and access times in one transaction"""
+        with self._touch_lock:
+            touches, self._touches = self._touches, {}
+            self._touched_at = time.monotonic()
+        if not touches:
+            return
+        conn = self._conn()
+        try:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "UPDATE cache_entries SET hits = hits + ?, accessed_at = MAX(accessed_at, ?) "
+                "WHERE namespace = ? AND key = ?",
+                [(hits, accessed_at, namespace, key) for (namespace, key), (accessed_at, hits) in touches.items()]
+            )
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            # Access times only steer eviction; losing one batch is harmless
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            print(f"Could not record cache access times: {e}")
+
+    def get_entry(self, namespace: str, key: str):
+        row = self._conn().execute(
+            "SELECT value, stored_at, expires_at, size, hits FROM cache_entries WHERE namespace = ? AND key = ?",
+            (namespace, key)
+        ).fetchone()
+        return self._row_entry(row) if row is not None else None
+
+    def set(self, namespace: str, key: str, value, ttl: float = None, now: float = None):
+        now = time.time() if now is None else now
+        ttl = self.ttl(namespace) if ttl is None else ttl
+        payload = json.dumps(value, separators=(",", ":"))
+        self._conn().execute(
+            "INSERT OR REPLACE INTO cache_entries "
+            "(namespace, key, value, stored_at, expires_at, size, hits, accessed_at) VALUES (?, ?, ?, ?, ?, ?, 0, ?)",
+            (namespace, key, payload, now, now + ttl, len(payload), now)
+        )
+        self._wrote(1)
+
+    def set_many(self, namespace: str, values: dict, ttl: float = None, now: float = None):
+        """set() for several keys in one transaction"""
+        if not values:
+            return
+        now = time.time() if now is None else now
+        ttl = self.ttl(namespace) if ttl is None else ttl
+        rows = []
+        for key, value in values.items():
+            payload = json.dumps(value, separators=(",", ":"))
+            rows.append((namespace, key, payload, now, now + ttl, len(payload), now))
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO cache_entries "
+                "(namespace, key, value, stored_at, expires_at, size, hits, accessed_at) VALUES (?, ?, ?, ?, ?, ?, 0, ?)",
+                rows
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self._wrote(len(rows))
+
+    def _wrote(self, count: int):
+        before, self._writes = self._writes, self._writes + count
+        if before // EVICT_EVERY != self._writes // EVICT_EVERY:
+            self._evict()
+
+    def _evict(self):
+        # Eviction goes by access time, so pending hits are written first
+        self._flush_touches()
+        conn = self._conn()
+        count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries").fetchone()
+        excess = max(0, count - self.max_entries)
+        if total > self.max_bytes and count:
+            # Drop the least recently used share proportional to the byte overshoot
+            excess = max(excess, int(count * (total - self.max_bytes) / total) + 1)
+        if not excess:
+            return
+
+        victims = conn.execute(
+            "SELECT namespace, key FROM cache_entries ORDER BY accessed_at LIMIT ?", (excess,)
+        ).fetchall()
+        conn.executemany("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", victims)
+        for namespace, _ in victims:
+            self._count(namespace, "evictions")
+
+    def delete(self, namespace: str, key: str):
+        self._conn().execute("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def clear(self):
+        self._conn().execute("DELETE FROM cache_entries")
+
+    def items(self) -> list:
+        self._flush_touches()
+        rows = self._conn().execute(
+            "SELECT namespace, key, value, stored_at, expires_at, size, hits FROM cache_entries ORDER BY accessed_at"
+        ).fetchall()
+        return [(row[0], row[1], self._row_entry(row[2:])) for row in rows]
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0]
+
+    def stats(self) -> dict:
+        count, total = self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries"
+        ).fetchone()
+        return {
+            "backend": self.backend,
+            "path": self.path,
+            "entries": count,
+            "bytes": total,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            # Counters are per worker process; entries and bytes are shared
+            "namespaces": self._namespace_stats(),
+        }
+
+    async def _call(self, method, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(method, *args))
+
+    async def alookup(self, namespace: str, key: str, stale_for: float = 0, now: float = None):
+        return await self._call(self.lookup, namespace, key, stale_for, now)
+
+    async def alookup_many(self, namespace: str, keys, stale_for: float = 0, now: float = None) -> dict:
+        return await self._call(self.lookup_many, namespace, list(keys), stale_for, now)
+
+    async def aget_entry(self, namespace: str, key: str):
+        return await self._call(self.get_entry, namespace, key)
+
+    async def aset(self, namespace: str, key: str, value, ttl: float = None, now: float = None):
+        await self._call(self.set, namespace, key, value, ttl, now)
+
+    async def aset_many(self, namespace: str, values: dict, ttl: float = None, now: float = None):
+        await self._call(self.set_many, namespace, values, ttl, now)
+
+    async def astats(self) -> dict:
+        return await self._call(self.stats)
+
+    async def aclose(self):
+        await self._call(self._flush_touches)
+        self._executor.shutdown(wait=False)
+
+
+class RedisCache(BaseCache):
+    """
+    Redis-backed cache. Size limits and LRU eviction are delegated to the
+    Redis server (maxmemory + allkeys-lru); keys expire REDIS_RETAIN_SECONDS
+    after their TTL so expired data remains available as a fallback.
+    """
+
+    backend = "redis"
+
+    def __init__(self, url: str, prefix: str = "greenguard:cache:"):
+        super().__init__()
+        try:
+            import redis
+            import redis.asyncio as aioredis
+        except ImportError as e:
+            raise ImportError("CACHE_BACKEND=redis requires the 'redis' package (pip install redis)") from e
+        self.url = url
+        self.prefix = prefix
+        # The blocking client serves scripts and threads, the asyncio one the event loop
+        self._redis = redis.Redis.from_url(url)
+        self._aredis = aioredis.Redis.from_url(url)
+
+    def _key(self, namespace: str, key: str) -> str:
+        return f"{self.prefix}{namespace}:{key}"
+
+    def _hash_entry(self, data: dict) -> CacheEntry:
+        entry = CacheEntry(json.loads(data[b"v"]), float(data[b"s"]), float(data[b"e"]), len(data[b"v"]))
+        entry.hits = int(data.get(b"h", 0))
+        return entry
+
+    def lookup(self, namespace: str, key: str, stale_for: float = 0, now: float = None):
+        now = time.time() if now is None else now
+        data = self._redis.hgetall(self._key(namespace, key))
+        entry = self._hash_entry(data) if data else None
+
+        state = self._classify(namespace, entry, stale_for, now)
+        if state == "miss":
+            return None, "miss"
+
+        entry.hits = self._redis.hincrby(self._key(namespace, key), "h", 1)
+        return entry, state
+
+    async def alookup(self, namespace: str, key: str, stale_for: float = 0, now: float = None):
+        now = time.time() if now is None else now
+        data = await self._aredis.hgetall(self._key(namespace, key))
+        entry = self._hash_entry(data) if data else None
+
+        state = self._classify(namespace, entry, stale_for, now)
+        if state == "miss":
+            return None, "miss"
+
+        entry.hits = await self._aredis.hincrby(self._key(namespace, key), "h", 1)
+        return entry, state
+
+    async def alookup_many(self, namespace: str, keys, stale_for: float = 0, now: float = None) -> dict:
+        """alookup() for several keys in two round trips"""
+        now = time.time() if now is None else now
+        keys = list(keys)
+        pipe = self._aredis.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(self._key(namespace, key))
+        results = {}
+        for key, data in zip(keys, await pipe.execute()):
+            entry = self._hash_entry(data) if data else None
+            state = self._classify(namespace, entry, stale_for, now)
+            results[key] = (entry, state) if state != "miss" else (None, "miss")
+
+        hit_keys = [key for key, (entry, _) in results.items() if entry is not None]
+        if hit_keys:
+            pipe = self._aredis.pipeline(transaction=False)
+            for key in hit_keys:
+                pipe.hincrby(self._key(namespace, key), "h", 1)
+            for key, hits in zip(hit_keys, await pipe.execute()):
+                results[key][0].hits = hits
+        return results
+
+    def get_entry(self, namespace: str, key: str):
+        data = self._redis.hgetall(self._key(namespace, key))
+        return self._hash_entry(data) if data else None
+
+    async def aget_entry(self, namespace: str, key: str):
+        data = await self._aredis.hgetall(self._key(namespace, key))
+        return self._hash_entry(data) if data else None
+
+    def _queue_set(self, pipe, namespace: str, values: dict, ttl: float, now: float):
+        ttl = self.ttl(namespace) if ttl is None else ttl
+        for key, value in values.items():
+            redis_key = self._key(namespace, key)
+            pipe.delete(redis_key)
+            pipe.hset(redis_key, mapping={
+                "v": json.dumps(value, separators=(",", ":")),
+                "s": now,
+                "e": now + ttl,
+                "h": 0
+            })
+            pipe.expire(redis_key, int(ttl) + REDIS_RETAIN_SECONDS)
+
+    def set(self, namespace: str, key: str, value, ttl: float = None, now: float = None):
+        self.set_many(namespace, {key: value}, ttl, now)
+
+    def set_many(self, namespace: str, values: dict, ttl: float = None, now: float = None):
+        pipe = self._redis.pipeline()
+        self._queue_set(pipe, namespace, values, ttl, time.time() if now is None else now)
+        pipe.execute()
+
+    async def aset(self, namespace: str, key: str, value, ttl: float = None, now: float = None):
+        await self.aset_many(namespace, {key: value}, ttl, now)
+
+    async def aset_many(self, namespace: str, values: dict, ttl: float = None, now: float = None):
+        pipe = self._aredis.pipeline()
+        self._queue_set(pipe, namespace, values, ttl, time.time() if now is None else now)
+        await pipe.execute()
+
+    def delete(self, namespace: str, key: str):
+        self._redis.delete(self._key(namespace, key))
+
+    def _keys(self):
+        return self._redis.scan_iter(match=f"{self.prefix}*", count=1000)
+
+    def clear(self):
+        for redis_key in self._keys():
+            self._redis.delete(redis_key)
+
+    def items(self) -> list:
+        items = []
+        for redis_key in self._keys():
+            data = self._redis.hgetall(redis_key)
+            if data:
+                namespace, key = redis_key.decode()[len(self.prefix):].split(":", 1)
+                items.append((namespace, key, self._hash_entry(data)))
+        return items
+
+    def __len__(self):
+        return sum(1 for _ in self._keys())
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.backend,
+            "url": self.url,
+            "namespaces": self._namespace_stats(),
+        }
+
+    async def aclose(self):
+        await self._aredis.close()
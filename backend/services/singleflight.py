@@ -0,0 +1,55 @@
+"""
+Single-flight coalescing of concurrent upstream fetches
+The first caller for a key runs the fetch; concurrent callers for the same
+key await that result instead of issuing their own upstream request.
+"""
+
+import asyncio
+
+
+class SingleFlight:
+    def __init__(self):
+        self._inflight: dict[tuple, asyncio.Task] = {}
+        self._stats: dict[str, dict[str, int]] = {}
+
+    def _counters(self, namespace: str) -> dict:
+        return self._stats.setdefault(namespace, {"calls": 0, "executions": 0, "coalesced": 0})
+
+    async def do(self, namespace: str, key: str, fetch):
+        """
+        Run fetch() (a coroutine function) once per (namespace, key) at a time.
+        The shared task is shielded so one caller disconnecting does not
+        cancel the fetch for everyone else waiting on it.
+        """
+        counters = self._counters(namespace)
+        counters["calls"] += 1
+
+        task = self._inflight.get((namespace, key))
+        if task is None:
+            counters["executions"] += 1
+            task = asyncio.ensure_future(fetch())
+            self._inflight[(namespace, key)] = task
+            task.add_done_callback(lambda done: self._finish(namespace, key, done))
+        else:
+            counters["coalesced"] += 1
+
+        return await asyncio.shield(task)
+
+    def _finish(self, namespace: str, key: str, task: asyncio.Task):
+        if self._inflight.get((namespace, key)) is task:
+            del self._inflight[(namespace, key)]
+        # Mark the exception retrieved in case every waiter was cancelled
+        if not task.cancelled():
+            task.exception()
+
+    def is_in_flight(self, namespace: str, key: str) -> bool:
+        return (namespace, key) in self._inflight
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._inflight),
+            "namespaces": {namespace: dict(counters) for namespace, counters in self._stats.items()},
+        }
+
+
+inflight = SingleFlight()
@@ -0,0 +1,165 @@
+"""
+Spatial quantization of cache keys
+Nearby coordinates (slightly different GPS fixes of the same neighbourhood)
+map to the same bucket so they share one upstream result.
+"""
+
+import math
+import os
+import threading
+from collections import OrderedDict
+
+# none | geohash | grid
+CACHE_SPATIAL_MODE = os.getenv("CACHE_SPATIAL_MODE", "geohash")
+CACHE_GEOHASH_PRECISION = int(os.getenv("CACHE_GEOHASH_PRECISION", "6"))  # ~1.2 x 0.6 km cells
+CACHE_GRID_KM = float(os.getenv("CACHE_GRID_KM", "1.0"))
+CACHE_SNAP_UPSTREAM = os.getenv("CACHE_SNAP_UPSTREAM", "false").lower() in ("1", "true", "yes")
+
+KM_PER_DEGREE = 111.32
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def geohash_encode(lat: float, lon: float, precision: int = 6) -> str:
+    """Encode a coordinate as a geohash string"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+
+    while len(chars) < precision:
+        rng, value = (lon_range, lon) if even else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            rng[0] = mid
+        else:
+            bits = bits << 1
+            rng[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_BASE32[bits])
+            bits = 0
+            bit_count = 0
+
+    return "".join(chars)
+
+
+def geohash_bounds(geohash: str):
+    """Return (lat_min, lat_max, lon_min, lon_max) of a geohash cell"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    even = True
+
+    for char in geohash:
+        index = _BASE32.index(char)
+        for shift in range(4, -1, -1):
+            rng = lon_range if even else lat_range
+            mid = (rng[0] + rng[1]) / 2
+            if (index >> shift) & 1:
+                rng[0] = mid
+            else:
+                rng[1] = mid
+            even = not even
+
+    return lat_range[0], lat_range[1], lon_range[0], lon_range[1]
+
+
+def geohash_center(geohash: str):
+    lat_min, lat_max, lon_min, lon_max = geohash_bounds(geohash)
+    return (lat_min + lat_max) / 2, (lon_min + lon_max) / 2
+
+
+class SpatialQuantizer:
+    """
+    Maps coordinates to cache buckets and keeps counters of how many
+    upstream calls bucketing saved (hits for coordinates that differ
+    from the ones the cached result was fetched for).
+    """
+
+    def __init__(self, mode: str = CACHE_SPATIAL_MODE, precision: int = CACHE_GEOHASH_PRECISION,
+                 grid_km: float = CACHE_GRID_KM, snap_upstream: bool = CACHE_SNAP_UPSTREAM,
+                 max_tracked: int = 10000):
+        if mode not in ("none", "geohash", "grid"):
+            raise ValueError(f"Unknown spatial cache mode: {mode}")
+        self.mode = mode
+        self.precision = precision
+        self.grid_km = grid_km
+        self.snap_upstream = snap_upstream
+        self.max_tracked = max_tracked
+        self._origins: OrderedDict = OrderedDict()
+        self._stats: dict[str, dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def _grid_cell(self, lat: float, lon: float):
+        lat_step = self.grid_km / KM_PER_DEGREE
+        row = math.floor(lat / lat_step)
+        center_lat = (row + 0.5) * lat_step
+        lon_step = self.grid_km / (KM_PER_DEGREE * max(math.cos(math.radians(center_lat)), 0.01))
+        col = math.floor(lon / lon_step)
+        center_lon = (col + 0.5) * lon_step
+        return f"g{self.grid_km}:{row}:{col}", center_lat, center_lon
+
+    def quantize(self, lat: float, lon: float):
+        """
+        Returns (cache_key, upstream_lat, upstream_lon). Upstream coordinates
+        are the bucket centre when snapping is enabled, otherwise the input.
+        """
+        if self.mode == "none":
+            return f"{lat}_{lon}", lat, lon
+
+        if self.mode == "geohash":
+            key = geohash_encode(lat, lon, self.precision)
+            center_lat, center_lon = geohash_center(key)
+        else:
+            key, center_lat, center_lon = self._grid_cell(lat, lon)
+
+        if self.snap_upstream:
+            return key, round(center_lat, 5), round(center_lon, 5)
+        return key, lat, lon
+
+    def _counters(self, namespace: str) -> dict:
+        return self._stats.setdefault(
+            namespace, {"lookups": 0, "hits": 0, "shared_hits": 0, "upstream_calls": 0}
+        )
+
+    def record_lookup(self, namespace: str, key: str, lat: float, lon: float, hit: bool):
+        with self._lock:
+            counters = self._counters(namespace)
+            counters["lookups"] += 1
+            if hit:
+                counters["hits"] += 1
+                origin = self._origins.get((namespace, key))
+                if origin is not None and origin != (lat, lon):
+                    counters["shared_hits"] += 1
+
+    def record_fetch(self, namespace: str, key: str, lat: float, lon: float):
+        with self._lock:
+            self._counters(namespace)["upstream_calls"] += 1
+            self._origins[(namespace, key)] = (lat, lon)
+            self._origins.move_to_end((namespace, key))
+            while len(self._origins) > self.max_tracked:
+                self._origins.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            namespaces = {}
+            for namespace, counters in self._stats.items():
+                # Calls that would have gone upstream without bucketing
+                unbucketed = counters["upstream_calls"] + counters["shared_hits"]
+                namespaces[namespace] = {
+                    **counters,
+                    "upstream_saved_pct": round(100 * counters["shared_hits"] / unbucketed, 1) if unbucketed else 0.0,
+                }
+            return {
+                "mode": self.mode,
+                "geohash_precision": self.precision if self.mode == "geohash" else None,
+                "grid_km": self.grid_km if self.mode == "grid" else None,
+                "snap_upstream": self.snap_upstream,
+                "namespaces": namespaces,
+            }
+
+
+quantizer = SpatialQuantizer()
@@ -0,0 +1,56 @@
+"""
+Spatial index over station coordinates
+A BallTree with the haversine metric answers nearest-k, radius and
+bounding-box queries in O(log n) per query instead of a distance
+computation for every row.
+"""
+
+import numpy as np
+from sklearn.neighbors import BallTree
+
+from services.geodesy import EARTH_RADIUS_KM, haversine_km
+
+
+class StationIndex:
+    """Built once per dataset snapshot from station latitudes / longitudes in degrees"""
+
+    def __init__(self, lat: np.ndarray, lon: np.ndarray):
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.size = len(self.lat)
+        self._tree = BallTree(np.radians(np.column_stack([self.lat, self.lon])), metric="haversine") if self.size else None
+
+    @staticmethod
+    def _point(lat: float, lon: float) -> np.ndarray:
+        return np.radians([[lat, lon]])
+
+    def nearest(self, lat: float, lon: float, k: int = 1):
+        """(station indices, distances in km) of the k closest stations, closest first"""
+        k = min(k, self.size)
+        if k == 0:
+            return np.empty(0, dtype=np.intp), np.empty(0)
+        distances, stations = self._tree.query(self._point(lat, lon), k=k)
+        return stations[0], distances[0] * EARTH_RADIUS_KM
+
+    def within(self, lat: float, lon: float, radius_km: float):
+        """(station indices, distances in km) of stations within radius_km, closest first"""
+        if self.size == 0:
+            return np.empty(0, dtype=np.intp), np.empty(0)
+        stations, distances = self._tree.query_radius(
+            self._point(lat, lon), r=radius_km / EARTH_RADIUS_KM, return_distance=True, sort_results=True
+        )
+        return stations[0], distances[0] * EARTH_RADIUS_KM
+
+    def in_box(self, lat: float, lon: float, radius_deg: float) -> np.ndarray:
+        """Station indices (ascending) with latitude and longitude within radius_deg of (lat, lon)"""
+        if self.size == 0:
+            return np.empty(0, dtype=np.intp)
+        # Candidates from the circle through the farthest box corner, then the exact box test
+        far_lat = np.clip([lat - radius_deg, lat + radius_deg], -90, 90)
+        reach = haversine_km(lat, lon, far_lat, lon + radius_deg).max() / EARTH_RADIUS_KM * 1.01
+        candidates = self._tree.query_radius(self._point(lat, lon), r=reach)[0]
+        mask = (
+            (self.lat[candidates] >= lat - radius_deg) & (self.lat[candidates] <= lat + radius_deg)
+            & (self.lon[candidates] >= lon - radius_deg) & (self.lon[candidates] <= lon + radius_deg)
+        )
+        return np.sort(candidates[mask])
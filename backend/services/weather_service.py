@@ -1,57 +1,121 @@
 import requests
+import httpx
+import asyncio
 import os
-import time
 from functools import lru_cache
 
-# Simple in-memory cache
-_cache = {}
+from services.cache import cache
+from services.circuit_breaker import UpstreamUnavailable
+from services.http_client import client, get_json_blocking
+from services.revalidate import revalidator
+from services.spatial import quantizer
+
+WEATHER_URL = "https://api.openweathermap.org/data/2.5/weather"
+WEATHER_CACHE_SECONDS = int(os.getenv("CACHE_TTL_WEATHER", "300"))  # 5 minutes
+WEATHER_STALE_SECONDS = int(os.getenv("CACHE_STALE_WEATHER", "600"))  # serve-stale window after expiry
+WEATHER_BATCH_CONCURRENCY = int(os.getenv("WEATHER_BATCH_CONCURRENCY", "8"))
+
+cache.set_ttl("weather", WEATHER_CACHE_SECONDS)
+
+MOCK_WEATHER = {
+    "wind_speed": 3.5,
+    "temperature": 22,
+    "humidity": 65,
+    "description": "Clear sky"
+}
+
+
+def _weather_params(lat: float, lon: float, api_key: str) -> dict:
+    return {"lat": lat, "lon": lon, "appid": api_key, "units": "metric"}
+
+
+def _parse_weather(data: dict) -> dict:
+    return {
+        "wind_speed": data['wind'].get('speed', 0),
+        "temperature": data['main'].get('temp', 0),
+        "humidity": data['main'].get('humidity', 0),
+        "description": data['weather'][0].get('description', 'Clear sky') if data.get('weather') else 'Clear sky'
+    }
+
+
+def _fallback_weather(entry) -> dict:
+    # Return the bucket's cached data (entry) if available (even if expired), otherwise mock data
+    if entry is not None:
+        return entry.value
+    return dict(MOCK_WEATHER)
+
 
 def get_weather_data(lat: float, lon: float):
-    # Create cache key
-    cache_key = f"weather_{lat}_{lon}"
-    current_time = time.time()
+    """Blocking variant, kept for scripts; request handlers use get_weather_data_async"""
+    # Nearby coordinates share a cache bucket
+    cache_key, upstream_lat, upstream_lon = quantizer.quantize(lat, lon)
 
     # Check cache (5 minute cache)
-    if cache_key in _cache:
-        cached_data, timestamp = _cache[cache_key]
-        if current_time - timestamp < 300:  # 5 minutes
-            return cached_data
+    cached_data = cache.get("weather", cache_key)
+    quantizer.record_lookup("weather", cache_key, lat, lon, hit=cached_data is not None)
+    if cached_data is not None:
+        return cached_data
 
     api_key = os.getenv("OPENWEATHER_API_KEY")
     if not api_key:
         # Return mock data if no API key
-        return {
-            "wind_speed": 3.5,
-            "temperature": 22,
-            "humidity": 65,
-            "description": "Clear sky"
-        }
+        return dict(MOCK_WEATHER)
 
     try:
-        url = f"https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={api_key}&units=metric"
-        response = requests.get(url, timeout=5)  # Reduced timeout
-        response.raise_for_status()
-        data = response.json()
-
-        result = {
-            "wind_speed": data['wind'].get('speed', 0),
-            "temperature": data['main'].get('temp', 0),
-            "humidity": data['main'].get('humidity', 0),
-            "description": data['weather'][0].get('description', 'Clear sky') if data.get('weather') else 'Clear sky'
-        }
+        data = get_json_blocking(WEATHER_URL, params=_weather_params(upstream_lat, upstream_lon, api_key), timeout=5)  # Reduced timeout
+        result = _parse_weather(data)
 
         # Cache the result
-        _cache[cache_key] = (result, current_time)
+        cache.set("weather", cache_key, result)
+        quantizer.record_fetch("weather", cache_key, lat, lon)
+        return result
+
+    except (requests.RequestException, UpstreamUnavailable, ValueError, KeyError, TypeError):
+        # ValueError: body is not JSON; KeyError/TypeError: JSON without the expected fields
+        return _fallback_weather(cache.get_entry("weather", cache_key))
+
+
+async def get_weather_data_async(lat: float, lon: float):
+    """Awaitable get_weather_data using the pooled async upstream client"""
+    api_key = os.getenv("OPENWEATHER_API_KEY")
+    if not api_key:
+        return dict(MOCK_WEATHER)
+
+    # Nearby coordinates share a cache bucket
+    cache_key, upstream_lat, upstream_lon = quantizer.quantize(lat, lon)
+
+    async def fetch():
+        data = await client.get_json(WEATHER_URL, params=_weather_params(upstream_lat, upstream_lon, api_key), timeout=5)
+        result = _parse_weather(data)
+
+        await cache.aset("weather", cache_key, result)
+        quantizer.record_fetch("weather", cache_key, lat, lon)
         return result
 
-    except requests.RequestException:
-        # Return cached data if available, otherwise mock data
-        if cache_key in _cache:
-            return _cache[cache_key][0]
-
-        return {
-            "wind_speed": 3.5,
-            "temperature": 22,
-            "humidity": 65,
-            "description": "Clear sky"
-        }
\ No newline at end of file
+    try:
+        # Serve fresh or recently expired data at once, refreshing in the background
+        result, hit = await revalidator.get("weather", cache_key, fetch, stale_for=WEATHER_STALE_SECONDS)
+        quantizer.record_lookup("weather", cache_key, lat, lon, hit=hit)
+        return result
+
+    except (httpx.HTTPError, UpstreamUnavailable, ValueError, KeyError, TypeError):
+        # ValueError: body is not JSON; KeyError/TypeError: JSON without the expected fields.
+        # A failed fetch is negative-cached by the revalidator, so the key is not retried at once
+        quantizer.record_lookup("weather", cache_key, lat, lon, hit=False)
+        return _fallback_weather(await cache.aget_entry("weather", cache_key))
+
+
+async def get_weather_data_batch(coordinates: list) -> list:
+    """
+    Weather for many (lat, lon) pairs, in input order.
+    OpenWeather has no multi-coordinate endpoint, so buckets are fetched
+    concurrently (bounded); duplicates collapse through the cache and
+    single-flight.
+    """
+    semaphore = asyncio.Semaphore(WEATHER_BATCH_CONCURRENCY)
+
+    async def fetch_one(lat: float, lon: float):
+        async with semaphore:
+            return await get_weather_data_async(lat, lon)
+
+    return await asyncio.gather(*(fetch_one(lat, lon) for lat, lon in coordinates))
@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from services.historical_store import HistoricalStore
+
+STATIONS = [("Hyderabad", 17.385, 78.4867), ("Delhi", 28.6139, 77.209), ("Mumbai", 19.076, 72.8777)]
+
+
+def make_history(start: str, days: int, seed: int = 0) -> pd.DataFrame:
+    """One row per station and day, with a few missing readings"""
+    rng = np.random.default_rng(seed)
+    frames = []
+    for city, lat, lon in STATIONS:
+        dates = pd.date_range(start, periods=days, freq="D")
+        frame = pd.DataFrame({
+            "date": dates.strftime("%Y-%m-%d"),
+            "city": city,
+            "lat": lat,
+            "lon": lon,
+            "aqi": rng.uniform(20, 300, days).round(1),
+            "pm25": rng.uniform(5, 150, days).round(1),
+            "temperature": rng.uniform(10, 40, days).round(1),
+        })
+        frame.loc[rng.random(days) < 0.1, "pm25"] = np.nan
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+
+@pytest.fixture
+def history_csv(tmp_path):
+    path = tmp_path / "air_quality_data.csv"
+    make_history("2025-01-01", 70).to_csv(path, index=False)
+    return path
+
+
+@pytest.fixture
+def store(history_csv):
+    # Every get() checks the file, so rewriting the CSV is picked up at once
+    return HistoricalStore(str(history_csv), reload_check=0, column_cache=False)
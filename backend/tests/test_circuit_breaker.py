@@ -0,0 +1,129 @@
+import pytest
+
+from services import circuit_breaker
+from services.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(circuit_breaker, "time", clock)
+    return clock
+
+
+def open_breaker(breaker: CircuitBreaker):
+    for _ in range(circuit_breaker.BREAKER_WINDOW):
+        breaker.record_failure()
+        if breaker.state == OPEN:
+            return
+    raise AssertionError("breaker did not open")
+
+
+def test_opens_at_failure_rate_after_min_calls(clock):
+    breaker = CircuitBreaker("upstream")
+    for _ in range(circuit_breaker.BREAKER_MIN_CALLS - 1):
+        breaker.record_failure()
+    assert breaker.state == CLOSED
+
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+    assert breaker.stats()["rejected"] == 2
+
+
+def test_successes_keep_failure_rate_below_threshold(clock):
+    breaker = CircuitBreaker("upstream")
+    for _ in range(10):
+        breaker.record_success(0.1)
+        breaker.record_failure()
+        breaker.record_success(0.1)
+    assert breaker.state == CLOSED
+
+
+def test_half_open_lets_one_probe_through(clock):
+    breaker = CircuitBreaker("upstream")
+    open_breaker(breaker)
+
+    clock.now += circuit_breaker.BREAKER_OPEN_SECONDS
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+
+
+def test_successful_probe_closes(clock):
+    breaker = CircuitBreaker("upstream")
+    open_breaker(breaker)
+    clock.now += circuit_breaker.BREAKER_OPEN_SECONDS
+    assert breaker.allow()
+
+    breaker.record_success(0.2)
+    assert breaker.state == CLOSED
+    assert breaker.stats()["calls_in_window"] == 1
+    assert breaker.allow()
+
+
+def test_failed_probe_reopens(clock):
+    breaker = CircuitBreaker("upstream")
+    open_breaker(breaker)
+    clock.now += circuit_breaker.BREAKER_OPEN_SECONDS
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert breaker.stats()["times_opened"] == 2
+    assert not breaker.allow()
+
+
+def test_lost_probe_is_replaced(clock):
+    breaker = CircuitBreaker("upstream")
+    open_breaker(breaker)
+    clock.now += circuit_breaker.BREAKER_OPEN_SECONDS
+    assert breaker.allow()
+
+    # The probe never reported back
+    clock.now += circuit_breaker.BREAKER_OPEN_SECONDS
+    assert breaker.allow()
+
+
+def test_timeout_adapts_to_latency(clock):
+    breaker = CircuitBreaker("upstream")
+    assert breaker.timeout(10) == 10
+    for _ in range(circuit_breaker.MIN_LATENCY_SAMPLES):
+        breaker.record_success(0.5)
+    assert breaker.timeout(10) == pytest.approx(0.5 * circuit_breaker.UPSTREAM_TIMEOUT_MULTIPLIER)
+    # Never above the default, never below the floor
+    assert breaker.timeout(1.2) == 1.2
+    for _ in range(circuit_breaker.LATENCY_SAMPLES):
+        breaker.record_success(0.001)
+    assert breaker.timeout(10) == circuit_breaker.UPSTREAM_MIN_TIMEOUT
+
+
+def test_timed_out_call_restores_default_timeout(clock):
+    breaker = CircuitBreaker("upstream")
+    for _ in range(circuit_breaker.MIN_LATENCY_SAMPLES):
+        breaker.record_success(0.1)
+    assert breaker.timeout(10) < 10
+
+    breaker.record_failure(timed_out=True)
+    assert breaker.timeout(10) == 10
+
+
+def test_half_open_probe_gets_default_timeout(clock):
+    breaker = CircuitBreaker("upstream")
+    for _ in range(circuit_breaker.MIN_LATENCY_SAMPLES):
+        breaker.record_success(0.1)
+    open_breaker(breaker)
+    clock.now += circuit_breaker.BREAKER_OPEN_SECONDS
+    assert breaker.allow()
+
+    assert breaker.timeout(10) == 10
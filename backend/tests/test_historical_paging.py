@@ -0,0 +1,75 @@
+import base64
+import os
+
+import numpy as np
+import pytest
+
+from services.historical_store import decode_cursor, encode_cursor
+from tests.conftest import make_history
+
+
+def all_pages(data, rows, limit, cursor=None):
+    pages = []
+    while True:
+        page, cursor = data.page(rows, cursor, limit)
+        assert len(page) <= limit
+        pages.append(page)
+        if cursor is None:
+            return np.concatenate(pages)
+
+
+def test_cursor_round_trip():
+    day = np.datetime64("2025-03-01", "D")
+    assert decode_cursor(encode_cursor(day, 2)) == (day, 2)
+
+
+@pytest.mark.parametrize("cursor", [
+    "not a cursor",
+    base64.urlsafe_b64encode(b"2025-03-01").decode(),
+    base64.urlsafe_b64encode(b"2025-03-01|x").decode(),
+    base64.urlsafe_b64encode(b"yesterday|1").decode(),
+])
+def test_malformed_cursor(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 4, 7, 100, 1000])
+def test_pages_cover_rows_in_order(store, limit):
+    data = store.get()
+    # Three stations report every day, so small limits split days
+    rows = data.rows_all()
+    np.testing.assert_array_equal(all_pages(data, rows, limit), rows)
+
+
+@pytest.mark.parametrize("limit", [2, 5])
+def test_pages_of_nearby_rows(store, limit):
+    data = store.get()
+    rows = data.rows_between(17.385, 78.4867, 15, start="2025-01-10", end="2025-02-20")
+    assert len(rows) > 0
+    np.testing.assert_array_equal(all_pages(data, rows, limit), rows)
+
+
+def test_no_limit_returns_everything(store):
+    data = store.get()
+    rows = data.rows_all()
+    page, cursor = data.page(rows)
+    assert cursor is None
+    np.testing.assert_array_equal(page, rows)
+
+
+def test_cursor_survives_appended_days(store, history_csv):
+    data = store.get()
+    first, cursor = data.page(data.rows_all(), limit=100)
+
+    make_history("2025-01-01", 80).to_csv(history_csv, index=False)
+    stat = os.stat(history_csv)
+    os.utime(history_csv, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    newer = store.get()
+    assert newer is not data
+
+    rows = newer.rows_all()
+    rest = all_pages(newer, rows, 100, cursor)
+    # Row numbers differ between snapshots; (date, city) identifies a reading
+    seen = [(r["date"], r["city"]) for r in data.records(first) + newer.records(rest)]
+    assert seen == [(r["date"], r["city"]) for r in newer.records(rows)]
@@ -0,0 +1,189 @@
+import asyncio
+import json
+import math
+
+import pytest
+
+from realtime import hub as hub_module
+from realtime.hub import MAX_INTERVAL, MIN_INTERVAL, ConnectionManager, RealtimeHub
+from realtime.pubsub import MemoryBroker
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, message):
+        self.sent.append(json.loads(message))
+
+    async def send_bytes(self, message):
+        self.sent.append(message)
+
+    async def close(self, code=1000, reason=None):
+        pass
+
+
+@pytest.fixture
+def built(monkeypatch):
+    """Locations updates were built for; builds return at once"""
+    locations = []
+
+    async def build_realtime_update(latitude, longitude):
+        locations.append((latitude, longitude))
+        return {"type": "realtime_update", "location": {"latitude": latitude, "longitude": longitude}}
+
+    monkeypatch.setattr(hub_module, "build_realtime_update", build_realtime_update)
+    return locations
+
+
+def run(scenario):
+    """Run scenario(hub, websocket) against a fresh hub with one connected client"""
+    async def main():
+        manager = ConnectionManager()
+        hub = RealtimeHub(manager, broker=MemoryBroker())
+        websocket = FakeWebSocket()
+        await manager.connect(websocket)
+        try:
+            return await scenario(hub, websocket)
+        finally:
+            hub.leave(websocket)
+            await hub.close()
+
+    return asyncio.run(main())
+
+
+def control(hub, websocket, **message):
+    return hub.handle_control(websocket, json.dumps(message))
+
+
+def subscriptions(hub, websocket):
+    return hub.manager.connections[websocket].subscriptions
+
+
+def test_subscribe_and_deliver(built):
+    async def scenario(hub, websocket):
+        reply = control(hub, websocket, type="subscribe", id="home", latitude=12.97, longitude=77.59, interval=30)
+        await asyncio.sleep(0.2)
+        return reply, websocket.sent
+
+    reply, sent = run(scenario)
+    assert reply["type"] == "subscribed"
+    assert reply["interval"] == 30
+    assert built == [(12.97, 77.59)]
+    # Named subscriptions are delivered in batch frames
+    updates = [update for message in sent if message["type"] == "batch" for update in message["updates"]]
+    assert [update["id"] for update in updates] == ["home"]
+    assert updates[0]["data"]["location"] == {"latitude": 12.97, "longitude": 77.59}
+
+
+def test_intervals_are_clamped(built):
+    async def scenario(hub, websocket):
+        low = control(hub, websocket, type="subscribe", id="a", latitude=1, longitude=2, interval=0.001)
+        high = control(hub, websocket, type="set_interval", id="a", interval=10 ** 9)
+        return low, high
+
+    low, high = run(scenario)
+    assert low["interval"] == MIN_INTERVAL
+    assert high["interval"] == MAX_INTERVAL
+
+
+@pytest.mark.parametrize("interval", ["nan", "inf", "-inf"])
+def test_set_interval_rejects_non_finite(built, interval):
+    async def scenario(hub, websocket):
+        control(hub, websocket, type="subscribe", id="a", latitude=1, longitude=2, interval=30)
+        reply = control(hub, websocket, type="set_interval", id="a", interval=interval)
+        subscription = subscriptions(hub, websocket)["a"]
+        # The scheduler keeps running and the subscription keeps its schedule
+        await asyncio.sleep(0.1)
+        return reply, subscription, hub._scheduler.done()
+
+    reply, subscription, stopped = run(scenario)
+    assert reply["type"] == "error"
+    assert subscription.interval == 30
+    assert math.isfinite(subscription.next_due)
+    assert not stopped
+
+
+def test_resubscribe_with_bad_interval_keeps_subscription(built):
+    async def scenario(hub, websocket):
+        control(hub, websocket, type="subscribe", id="a", latitude=1, longitude=2, interval=30)
+        before = subscriptions(hub, websocket)["a"]
+        reply = control(hub, websocket, type="subscribe", id="a", latitude=5, longitude=6, interval="nan")
+        return reply, before, subscriptions(hub, websocket).get("a"), set(hub._cells)
+
+    reply, before, after, cells = run(scenario)
+    assert reply["type"] == "error"
+    assert after is before
+    assert cells == {before.cell}
+
+
+@pytest.mark.parametrize("latitude, longitude", [(1e309, 2), (1, -1e309), (float("nan"), 2)])
+def test_subscribe_rejects_non_finite_location(built, latitude, longitude):
+    async def scenario(hub, websocket):
+        control(hub, websocket, type="subscribe", id="a", latitude=1, longitude=2)
+        before = subscriptions(hub, websocket)["a"]
+        # json.dumps writes Infinity/NaN, which the decoder reads back as floats
+        reply = control(hub, websocket, type="subscribe", id="a", latitude=latitude, longitude=longitude)
+        new = control(hub, websocket, type="subscribe", id="b", latitude=latitude, longitude=longitude)
+        return reply, new, before, dict(subscriptions(hub, websocket))
+
+    reply, new, before, current = run(scenario)
+    assert reply["type"] == "error"
+    assert new["type"] == "error"
+    assert current == {"a": before}
+
+
+def test_unsubscribe(built):
+    async def scenario(hub, websocket):
+        control(hub, websocket, type="subscribe", id="a", latitude=1, longitude=2)
+        first = control(hub, websocket, type="unsubscribe", id="a")
+        second = control(hub, websocket, type="unsubscribe", id="a")
+        return first, second, dict(hub._cells)
+
+    first, second, cells = run(scenario)
+    assert first == {"type": "unsubscribed", "id": "a"}
+    assert second["type"] == "error"
+    assert cells == {}
+
+
+@pytest.mark.parametrize("data", [
+    "not json",
+    json.dumps({"type": "teleport", "id": "a"}),
+    json.dumps({"type": "subscribe", "id": "a", "latitude": 1}),
+    json.dumps({"type": "set_interval", "id": "missing", "interval": 30}),
+    json.dumps(["subscribe"]),
+])
+def test_invalid_messages_get_an_error(built, data):
+    async def scenario(hub, websocket):
+        return hub.handle_control(websocket, data), dict(subscriptions(hub, websocket))
+
+    reply, current = run(scenario)
+    assert reply["type"] == "error"
+    assert current == {}
+
+
+def test_scheduler_survives_failing_tick(built, monkeypatch):
+    monkeypatch.setattr(hub_module, "ERROR_RETRY_INTERVAL", 0.05)
+
+    async def scenario(hub, websocket):
+        tick = hub._tick
+        failures = []
+
+        async def failing_tick(cells, started):
+            if not failures:
+                failures.append(cells)
+                raise RuntimeError("tick failed")
+            await tick(cells, started)
+
+        hub._tick = failing_tick
+        control(hub, websocket, type="subscribe", id="a", latitude=1, longitude=2)
+        await asyncio.sleep(0.3)
+        return failures, hub._scheduler.done()
+
+    failures, stopped = run(scenario)
+    assert len(failures) == 1
+    assert not stopped
+    assert built == [(1.0, 2.0)]
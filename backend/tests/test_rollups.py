@@ -0,0 +1,103 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from services.rollups import PERCENTILES, PERIODS, RollupStore, period_starts
+from tests.conftest import make_history
+
+
+def write_csv(path, frame: pd.DataFrame):
+    frame.to_csv(path, index=False)
+    # Make sure the store sees a change even within the file system's timestamp resolution
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+def assert_tables_equal(actual, expected):
+    np.testing.assert_array_equal(actual.station, expected.station)
+    np.testing.assert_array_equal(actual.start, expected.start)
+    np.testing.assert_array_equal(actual.count, expected.count)
+    assert actual.stats.keys() == expected.stats.keys()
+    for metric, stats in expected.stats.items():
+        for name, values in stats.items():
+            np.testing.assert_array_equal(actual.stats[metric][name], values, err_msg=f"{metric}.{name}")
+
+
+@pytest.mark.parametrize("period", PERIODS)
+def test_full_build_matches_pandas(store, period):
+    data, table = RollupStore(store).get(period)
+    frame = pd.DataFrame(data.records(np.arange(data.rows)))
+    frame["period_start"] = period_starts(pd.to_datetime(frame["date"]).to_numpy(), period)
+    groups = frame.groupby(["city", "period_start"])
+
+    assert len(table) == groups.ngroups
+    for row in range(len(table)):
+        city = data.station_info(int(table.station[row]))["city"]
+        group = groups.get_group((city, table.start[row]))
+        assert table.count[row] == len(group)
+        for metric in ("aqi", "pm25"):
+            values = group[metric].dropna()
+            stats = {name: column[row] for name, column in table.stats[metric].items()}
+            if values.empty:
+                assert all(np.isnan(value) for value in stats.values())
+                continue
+            assert stats["mean"] == pytest.approx(values.mean())
+            assert stats["min"] == values.min()
+            assert stats["max"] == values.max()
+            for q in PERCENTILES:
+                assert stats[f"p{q}"] == pytest.approx(np.percentile(values, q))
+
+
+def test_appended_rows_update_incrementally(store, history_csv):
+    history = make_history("2025-01-01", 90)
+    # Cut mid-week and mid-month so the last periods are partial before the append
+    dates = pd.to_datetime(history["date"])
+    write_csv(history_csv, history[dates < "2025-03-13"])
+    rollups = RollupStore(store)
+    for period in PERIODS:
+        rollups.get(period)
+    reduced = rollups.rows_reduced
+
+    write_csv(history_csv, history)
+    for period in PERIODS:
+        _, table = rollups.get(period)
+        _, rebuilt = RollupStore(store).get(period)
+        assert_tables_equal(table, rebuilt)
+
+    assert rollups.full_builds == 1
+    assert rollups.incremental_updates == 1
+    # Only the periods from the first appended row on were reduced again
+    first_new = np.datetime64("2025-03-13", "D")
+    expected = sum(int((dates >= period_starts(first_new, period)).sum()) for period in PERIODS)
+    assert rollups.rows_reduced - reduced == expected
+
+
+def test_edited_rows_rebuild(store, history_csv):
+    history = make_history("2025-01-01", 70)
+    rollups = RollupStore(store)
+    rollups.get("day")
+
+    history.loc[5, "aqi"] += 1
+    write_csv(history_csv, history)
+    _, table = rollups.get("day")
+    _, rebuilt = RollupStore(store).get("day")
+
+    assert_tables_equal(table, rebuilt)
+    assert rollups.full_builds == 2
+    assert rollups.incremental_updates == 0
+
+
+def test_new_station_rebuilds(store, history_csv):
+    history = make_history("2025-01-01", 70)
+    rollups = RollupStore(store)
+    rollups.get("week")
+
+    extra = history[history["city"] == "Delhi"].assign(city="Pune", lat=18.5204, lon=73.8567)
+    write_csv(history_csv, pd.concat([history, extra], ignore_index=True))
+    data, table = rollups.get("week")
+
+    assert data.stations == 4
+    assert rollups.full_builds == 2
+    assert_tables_equal(table, RollupStore(store).get("week")[1])